@@ -1,3 +1,4 @@
+import asyncio
 import os
 import time
 import random
@@ -6,9 +7,20 @@ from typing import List, Optional, Dict, Any
 import json
 import base64
 from pathlib import Path
+from rate_limiter import get_rate_limiter
+from client_pool import client_pool
+from retry_policy import (
+    CONTINUATION_PROMPT,
+    DEFAULT_STREAM_RESUME_MODE,
+    RetryPolicy,
+    StreamReset,
+    default_retry_policy,
+)
+from token_usage import UsageTracker, openai_usage
+from history_policy import HistoryPolicy, OpenAIMessageAdapter, default_history_policy
 
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI, OpenAI
 except ImportError:
     raise ImportError("請安裝 openai 套件: pip install openai")
 
@@ -31,6 +43,8 @@ class ChatGPTChatSession:
         model_name: str = "gpt-4o-mini",
         generation_config: Optional[Dict] = None,
         initial_history: Optional[List[Dict]] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        history_policy: Optional[HistoryPolicy] = None,
     ):
         """
         初始化對話 session。
@@ -40,6 +54,8 @@ class ChatGPTChatSession:
             model_name (str): 要使用的模型名稱，例如 'gpt-4o', 'gpt-4o-mini', 'gpt-4-turbo', 'gpt-3.5-turbo'
             generation_config (Optional[Dict]): 模型的生成設定，對應 OpenAI 的參數
             initial_history (Optional[List[Dict]]): 用於開始對話的初始歷史紀錄
+            retry_policy (Optional[RetryPolicy]): 呼叫失敗時的重試策略，預設使用共用的 default_retry_policy
+            history_policy (Optional[HistoryPolicy]): 送出前整理對話歷史的策略，預設使用共用的 default_history_policy
         """
 
         system_instruction_text = """小說產生原則
@@ -53,10 +69,24 @@ class ChatGPTChatSession:
 使用繁體中文產生小說
         """
 
-        # 初始化 OpenAI client
-        self.client = OpenAI(api_key=api_key)
+        # 初始化 OpenAI client（同步 client 同一把金鑰共用連線池，非同步 client 各自建立）
+        self.client = client_pool.openai(api_key)
+        self.async_client = client_pool.openai(api_key, is_async=True)
         
         self.model_name = model_name
+        self.rate_limiter = get_rate_limiter("openai", model_name)
+        self.retry_policy = retry_policy or default_retry_policy
+        # 每次重試時呼叫，參數為 retry_policy 產生的事件 dict
+        self.on_retry = None
+        # 串流中途失敗時要接續 ("continue") 還是整段重來 ("reset")
+        self.stream_resume_mode = DEFAULT_STREAM_RESUME_MODE
+        # 每次送出前依 token 預算整理對話歷史
+        self.history_policy = history_policy or default_history_policy
+        self.history_adapter = OpenAIMessageAdapter(self)
+        self.last_total_tokens = 0
+        # 最近一次呼叫的 usage，以及逐輪的 token 用量與累計
+        self.last_usage = None
+        self.usage_tracker = UsageTracker("openai", model_name)
         
         # 設定默認的生成參數
         self.default_generation_config = {
@@ -192,22 +222,40 @@ class ChatGPTChatSession:
         self.printLog(f"檔案處理完成，共處理 {len(processed_files)} 個檔案")
         return processed_files
 
-    def send_message(self, prompt: str, uploaded_files: Optional[List[Dict]] = None):
-        """
-        將 prompt 和選擇性的檔案傳送給 ChatGPT 模型，並取得回應。
-        這個方法會利用 session 的歷史紀錄來進行有上下文的對話。
+    def _record_usage(self, rate_entry, usage):
+        """記錄一次成功呼叫的用量：更新配額計數與 usage_tracker。"""
+        if usage is None:
+            return
+        self.last_usage = usage
+        self.last_total_tokens = usage.total_tokens
+        self.rate_limiter.record(rate_entry, usage.total_tokens)
+        self.usage_tracker.record(openai_usage(usage))
 
-        Args:
-            prompt (str): 使用者的文字輸入
-            uploaded_files (Optional[List[Dict]]): 使用者上傳的檔案列表 (如果有的話)
+    def _apply_history_policy(self):
+        """送出前套用 history_policy，整理 self.messages。"""
+        trimmed = self.history_policy.apply(self.messages, self.history_adapter)
+        if trimmed is not self.messages:
+            self.printLog(f"對話歷史已整理：{len(self.messages)} 則 -> {len(trimmed)} 則")
+            self.messages = trimmed
 
-        Returns:
-            str: 來自 ChatGPT 模型的回應文字，或是一則錯誤訊息
-        """
-        if not prompt and not uploaded_files:
-            return "錯誤：請提供文字提示或上傳檔案。"
+    def record_exchange(self, prompt: str, uploaded_files: Optional[List[Dict]], response_text: str):
+        """不呼叫模型，直接把一組提問與回應寫進歷史（回應快取命中時使用）。"""
+        self.messages.append(self._user_message(prompt, uploaded_files))
+        self.messages.append({"role": "assistant", "content": response_text})
 
-        # 構建訊息內容
+    def cache_identity(self) -> Dict:
+        """回應快取的鍵所需的內容：模型、生成設定、系統訊息與目前的歷史。"""
+        system_message = next((msg for msg in self.messages if msg["role"] == "system"), None)
+        return {
+            "provider": "openai",
+            "model": self.model_name,
+            "config": self.generation_config,
+            "system_instruction": system_message["content"] if system_message else "",
+            "history": [msg for msg in self.messages if msg["role"] != "system"],
+        }
+
+    def _user_message(self, prompt: str, uploaded_files: Optional[List[Dict]] = None) -> Dict:
+        """把文字與檔案內容組成一則 user 訊息。"""
         message_content = []
         
         # 添加文字內容
@@ -221,25 +269,43 @@ class ChatGPTChatSession:
         if uploaded_files:
             message_content.extend(uploaded_files)
 
-        # 將使用者訊息加入歷史
-        user_message = {
+        return {
             "role": "user",
             "content": message_content if len(message_content) > 1 else prompt
         }
-        self.messages.append(user_message)
 
-        max_retries = 5
+    def send_message(self, prompt: str, uploaded_files: Optional[List[Dict]] = None):
+        """
+        將 prompt 和選擇性的檔案傳送給 ChatGPT 模型，並取得回應。
+        這個方法會利用 session 的歷史紀錄來進行有上下文的對話。
+
+        Args:
+            prompt (str): 使用者的文字輸入
+            uploaded_files (Optional[List[Dict]]): 使用者上傳的檔案列表 (如果有的話)
+
+        Returns:
+            str: 來自 ChatGPT 模型的回應文字，或是一則錯誤訊息
+        """
+        if not prompt and not uploaded_files:
+            return "錯誤：請提供文字提示或上傳檔案。"
+
+        self._apply_history_policy()
+        self.messages.append(self._user_message(prompt, uploaded_files))
 
-        for attempt in range(max_retries):
+        retry = self.retry_policy.begin("openai", self.model_name, self.on_retry)
+
+        while True:
             current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
             self.printLog(f"\n正在向 ChatGPT 傳送訊息，{current_datetime}...")
             
             try:
+                rate_entry = self.rate_limiter.acquire(self.estimate_tokens(prompt))
                 response = self.client.chat.completions.create(
                     model=self.model_name,
                     messages=self.messages,
                     **self.generation_config
                 )
+                self._record_usage(rate_entry, response.usage)
                 
                 # 取得回應內容
                 assistant_message_content = response.choices[0].message.content
@@ -256,98 +322,235 @@ class ChatGPTChatSession:
                 return assistant_message_content
                 
             except Exception as e:
-                error_message = str(e)
                 log_time = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-                
-                # 檢查是否是可重試的錯誤
-                retryable_errors = [
-                    "rate_limit_exceeded", 
-                    "server_error", 
-                    "timeout",
-                    "internal_server_error",
-                    "service_unavailable",
-                    "insufficient_quota"
-                ]
-                
-                is_retryable = any(error_type in error_message.lower() for error_type in retryable_errors)
-                
-                if is_retryable and attempt < max_retries - 1:
+                delay = retry.next_delay(e)
+                if delay is not None:
                     self.printLog(
-                        f"[{log_time}]呼叫 ChatGPT API 時發生可重試錯誤 (第 {attempt + 1} 次失敗): {e}",
+                        f"[{log_time}]呼叫 ChatGPT API 時發生可重試錯誤 (第 {retry.attempt} 次失敗): {e}",
                         True,
                     )
-                    # 指數退避邏輯
-                    wait_time = min(5 * (2 ** attempt), 60)  # 最大等待 60 秒
-                    self.printLog(f"將在 {wait_time} 秒後重試...", True)
-                    time.sleep(wait_time)
+                    self.printLog(f"將在 {delay:.1f} 秒後重試...", True)
+                    time.sleep(delay)
+                elif retry.exhausted:
+                    self.printLog(f"[{log_time}]已達到最大重試次數或時限，放棄操作。", True)
+                    return f"呼叫 ChatGPT API 失敗，已重試 {retry.attempt} 次後放棄。最後錯誤：{e}"
                 else:
-                    if attempt >= max_retries - 1:
-                        self.printLog(f"[{log_time}]已達到最大重試次數，放棄操作。", True)
-                        return f"呼叫 ChatGPT API 失敗，已重試 {max_retries} 次後放棄。最後錯誤：{e}"
-                    else:
-                        self.printLog(f"[{log_time}]發生不可重試的錯誤: {e}", True)
-                        return f"呼叫 ChatGPT API 時發生錯誤：{e}"
+                    self.printLog(f"[{log_time}]發生不可重試的錯誤: {e}", True)
+                    return f"呼叫 ChatGPT API 時發生錯誤：{e}"
 
     def send_message_stream(self, prompt: str, uploaded_files: Optional[List[Dict]] = None):
         """
         以串流方式發送訊息，實時接收回應。
+        串流中途失敗時依 stream_resume_mode 接續生成，或先 yield StreamReset 再整段重來。
         
         Args:
             prompt (str): 使用者的文字輸入
             uploaded_files (Optional[List[Dict]]): 使用者上傳的檔案列表
             
         Yields:
-            str: 串流回應的文字片段
+            Union[str, StreamReset]: 串流回應的文字片段，或重來的標記
         """
         if not prompt and not uploaded_files:
             yield "錯誤：請提供文字提示或上傳檔案。"
             return
 
-        # 構建訊息內容
-        message_content = []
-        
-        if prompt:
-            message_content.append({
-                "type": "text",
-                "text": prompt
-            })
-        
-        if uploaded_files:
-            message_content.extend(uploaded_files)
+        self._apply_history_policy()
+        self.messages.append(self._user_message(prompt, uploaded_files))
 
-        user_message = {
-            "role": "user",
-            "content": message_content if len(message_content) > 1 else prompt
-        }
-        self.messages.append(user_message)
+        retry = self.retry_policy.begin("openai", self.model_name, self.on_retry)
+        collected_content = ""
 
-        try:
+        while True:
+            try:
+                current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+                self.printLog(f"\n正在向 ChatGPT 傳送串流訊息，{current_datetime}...")
+                
+                messages = self.messages
+                if collected_content:
+                    # 接續生成：帶上已收到的部分回應，請模型從中斷處往下寫
+                    messages = self.messages + [
+                        {"role": "assistant", "content": collected_content},
+                        {"role": "user", "content": CONTINUATION_PROMPT},
+                    ]
+                
+                rate_entry = self.rate_limiter.acquire(self.estimate_tokens(prompt))
+                response = self.client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    stream=True,
+                    # 最後一個 chunk 會附上整次請求的 usage（choices 為空）
+                    stream_options={"include_usage": True},
+                    **self.generation_config
+                )
+                
+                call_usage = None
+                for chunk in response:
+                    if chunk.usage is not None:
+                        call_usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content is not None:
+                        content = chunk.choices[0].delta.content
+                        collected_content += content
+                        yield content
+
+                self._record_usage(rate_entry, call_usage)
+                # 將完整回應加入歷史（接續生成的內容也合併成同一則）
+                assistant_message = {
+                    "role": "assistant",
+                    "content": collected_content
+                }
+                self.messages.append(assistant_message)
+                return
+                
+            except Exception as e:
+                delay = retry.next_delay(e)
+                if delay is None:
+                    yield f"串流傳送時發生錯誤：{e}"
+                    return
+                log_time = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+                self.printLog(
+                    f"[{log_time}]ChatGPT 串流發生可重試錯誤 (第 {retry.attempt} 次失敗): {e}",
+                    True,
+                )
+                if collected_content and self.stream_resume_mode == "reset":
+                    collected_content = ""
+                    yield StreamReset()
+                self.printLog(f"將在 {delay:.1f} 秒後重試...", True)
+                time.sleep(delay)
+
+    async def upload_files_async(self, file_paths: List[str]) -> List[Dict]:
+        """upload_files 的 asyncio 版本；檔案只在本機處理，放到執行緒中避免卡住事件迴圈。"""
+        return await asyncio.to_thread(self.upload_files, file_paths)
+
+    async def send_message_async(self, prompt: str, uploaded_files: Optional[List[Dict]] = None):
+        """
+        send_message 的 asyncio 版本，使用 AsyncOpenAI，等待重試時不會佔住執行緒。
+
+        Returns:
+            str: 來自 ChatGPT 模型的回應文字，或是一則錯誤訊息
+        """
+        if not prompt and not uploaded_files:
+            return "錯誤：請提供文字提示或上傳檔案。"
+
+        await asyncio.to_thread(self._apply_history_policy)
+        self.messages.append(self._user_message(prompt, uploaded_files))
+
+        retry = self.retry_policy.begin("openai", self.model_name, self.on_retry)
+
+        while True:
             current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-            self.printLog(f"\n正在向 ChatGPT 傳送串流訊息，{current_datetime}...")
-            
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=self.messages,
-                stream=True,
-                **self.generation_config
-            )
-            
-            collected_content = ""
-            for chunk in response:
-                if chunk.choices[0].delta.content is not None:
-                    content = chunk.choices[0].delta.content
-                    collected_content += content
-                    yield content
-            
-            # 將完整回應加入歷史
-            assistant_message = {
-                "role": "assistant",
-                "content": collected_content
-            }
-            self.messages.append(assistant_message)
+            self.printLog(f"\n正在向 ChatGPT 傳送訊息（非同步），{current_datetime}...")
             
-        except Exception as e:
-            yield f"串流傳送時發生錯誤：{e}"
+            try:
+                rate_entry = await self.rate_limiter.acquire_async(self.estimate_tokens(prompt))
+                response = await self.async_client.chat.completions.create(
+                    model=self.model_name,
+                    messages=self.messages,
+                    **self.generation_config
+                )
+                self._record_usage(rate_entry, response.usage)
+                
+                assistant_message_content = response.choices[0].message.content
+                self.messages.append({
+                    "role": "assistant",
+                    "content": assistant_message_content
+                })
+                
+                current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+                self.printLog(f"\nChatGPT 已回傳訊息，{current_datetime}...")
+                return assistant_message_content
+                
+            except Exception as e:
+                log_time = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+                delay = retry.next_delay(e)
+                if delay is not None:
+                    self.printLog(
+                        f"[{log_time}]呼叫 ChatGPT API 時發生可重試錯誤 (第 {retry.attempt} 次失敗): {e}",
+                        True,
+                    )
+                    self.printLog(f"將在 {delay:.1f} 秒後重試...", True)
+                    await asyncio.sleep(delay)
+                elif retry.exhausted:
+                    self.printLog(f"[{log_time}]已達到最大重試次數或時限，放棄操作。", True)
+                    return f"呼叫 ChatGPT API 失敗，已重試 {retry.attempt} 次後放棄。最後錯誤：{e}"
+                else:
+                    self.printLog(f"[{log_time}]發生不可重試的錯誤: {e}", True)
+                    return f"呼叫 ChatGPT API 時發生錯誤：{e}"
+
+    async def send_message_stream_async(self, prompt: str, uploaded_files: Optional[List[Dict]] = None):
+        """
+        以串流方式發送訊息的 asyncio 版本，用法為 async for。
+        串流中途失敗時依 stream_resume_mode 接續生成，或先 yield StreamReset 再整段重來。
+
+        Yields:
+            Union[str, StreamReset]: 串流回應的文字片段，或重來的標記
+        """
+        if not prompt and not uploaded_files:
+            yield "錯誤：請提供文字提示或上傳檔案。"
+            return
+
+        await asyncio.to_thread(self._apply_history_policy)
+        self.messages.append(self._user_message(prompt, uploaded_files))
+
+        retry = self.retry_policy.begin("openai", self.model_name, self.on_retry)
+        collected_content = ""
+
+        while True:
+            try:
+                current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+                self.printLog(f"\n正在向 ChatGPT 傳送串流訊息（非同步），{current_datetime}...")
+                
+                messages = self.messages
+                if collected_content:
+                    messages = self.messages + [
+                        {"role": "assistant", "content": collected_content},
+                        {"role": "user", "content": CONTINUATION_PROMPT},
+                    ]
+                
+                rate_entry = await self.rate_limiter.acquire_async(self.estimate_tokens(prompt))
+                response = await self.async_client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    stream=True,
+                    # 最後一個 chunk 會附上整次請求的 usage（choices 為空）
+                    stream_options={"include_usage": True},
+                    **self.generation_config
+                )
+                
+                call_usage = None
+                async for chunk in response:
+                    if chunk.usage is not None:
+                        call_usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content is not None:
+                        content = chunk.choices[0].delta.content
+                        collected_content += content
+                        yield content
+
+                self._record_usage(rate_entry, call_usage)
+                self.messages.append({
+                    "role": "assistant",
+                    "content": collected_content
+                })
+                return
+                
+            except Exception as e:
+                delay = retry.next_delay(e)
+                if delay is None:
+                    yield f"串流傳送時發生錯誤：{e}"
+                    return
+                log_time = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+                self.printLog(
+                    f"[{log_time}]ChatGPT 串流發生可重試錯誤 (第 {retry.attempt} 次失敗): {e}",
+                    True,
+                )
+                if collected_content and self.stream_resume_mode == "reset":
+                    collected_content = ""
+                    yield StreamReset()
+                self.printLog(f"將在 {delay:.1f} 秒後重試...", True)
+                await asyncio.sleep(delay)
+
+    def estimate_tokens(self, prompt: str) -> int:
+        """粗估下一次請求的 token 數：上一輪的總用量（含歷史）加上新的 prompt。"""
+        return self.last_total_tokens + len(prompt or "")
 
     @property
     def history(self) -> List[Dict]:
@@ -380,14 +583,28 @@ class ChatGPTChatSession:
         except Exception as e:
             self.printLog(f"載入對話歷史時發生錯誤: {e}")
 
-    def get_token_usage(self):
+    def usage_summary(self) -> Optional[Dict]:
+        """整理最近一次呼叫的 token 使用量，欄位與 GeminiChatSession.usage_summary 相同。"""
+        if self.last_usage is None:
+            return None
+        usage = openai_usage(self.last_usage)
+        return {
+            "prompt": usage["input"],
+            "cached": usage["cached"],
+            "fresh": usage["input"] - usage["cached"],
+            "output": usage["output"],
+            "thinking": usage["thinking"],
+        }
+
+    def get_token_usage(self) -> Dict:
         """
-        取得最近一次 API 呼叫的 token 使用量資訊。
-        注意：這需要在 send_message 方法中儲存 response 物件才能實現。
+        取得這個 session 的 token 使用量：最近一次呼叫 (last)、逐次紀錄 (turns) 與累計 (summary)。
         """
-        # 這個方法需要修改 send_message 來儲存最後的 response
-        # 暫時返回提示訊息
-        return "Token 使用量資訊需要在 send_message 方法中實現"
+        return {
+            "last": self.usage_tracker.last,
+            "turns": list(self.usage_tracker.turns),
+            "summary": self.usage_tracker.summary(),
+        }
 
     def set_system_message(self, system_message: str):
         """
@@ -1,13 +1,87 @@
+import asyncio
 import os
 import time
 import random
 from datetime import datetime
 from google import genai
 from google.genai import types
-from google.api_core import exceptions
-from typing import List, Optional, Any, Generator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Any, AsyncGenerator, Generator, Tuple, Union
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
-import google.api_core.exceptions as google_exceptions
+from file_registry import RemoteFileRegistry, remote_file_registry, state_name
+from rate_limiter import get_rate_limiter
+from client_pool import client_pool
+from system_instruction import system_instruction
+from token_usage import UsageTracker, gemini_usage, hash_file, hash_text, token_count_cache
+from history_policy import (
+    SUMMARY_ACK,
+    SUMMARY_PREFIX,
+    HistoryAdapter,
+    HistoryPolicy,
+    default_history_policy,
+)
+from retry_policy import (
+    CONTINUATION_PROMPT,
+    DEFAULT_STREAM_RESUME_MODE,
+    RetryPolicy,
+    StreamReset,
+    default_retry_policy,
+)
+from context_cache import (
+    CACHE_LOST_STATUS,
+    CACHE_TTL,
+    ContextCacheRegistry,
+    cache_key,
+    context_cache_registry,
+    min_cache_tokens,
+)
+
+# 同時上傳的檔案數上限
+UPLOAD_MAX_WORKERS = 4
+# 等待檔案從 PROCESSING 變成 ACTIVE 的最長秒數
+ACTIVE_WAIT_TIMEOUT = 600
+# 沒有 count_tokens 結果時，以檔案大小粗估 token 數（UTF-8 中文約 3 bytes 一字、一字約一 token）
+BYTES_PER_TOKEN = 3
+
+
+def _file_state(file_obj: Any) -> str:
+    return state_name(getattr(file_obj, "state", None))
+
+
+class GeminiHistoryAdapter(HistoryAdapter):
+    """讓 history_policy 處理 Gemini 的 types.Content 歷史。"""
+
+    provider = "gemini"
+
+    def __init__(self, session):
+        self.session = session
+
+    def role(self, item: types.Content) -> str:
+        return item.role
+
+    def text(self, item: types.Content) -> str:
+        return "".join(part.text for part in item.parts or [] if part.text)
+
+    def file_keys(self, item: types.Content) -> set:
+        return {
+            part.file_data.file_uri for part in item.parts or [] if part.file_data is not None
+        }
+
+    def summary_items(self, summary: str) -> List[types.Content]:
+        return [
+            types.Content(role="user", parts=[types.Part.from_text(text=SUMMARY_PREFIX + summary)]),
+            types.Content(role="model", parts=[types.Part.from_text(text=SUMMARY_ACK)]),
+        ]
+
+    def summarize(self, prompt: str) -> str:
+        def call():
+            response = self.session.client.models.generate_content(
+                model=self.session.model_name, contents=prompt
+            )
+            usage = response.usage_metadata
+            return response.text or "", usage.total_token_count if usage else None
+
+        return self._call_limited(call, len(prompt))
 
 
 class GeminiChatSession:
@@ -26,28 +100,14 @@ class GeminiChatSession:
         model_name: str,
         generation_config: Optional[genai.types.GenerationConfig] = None,
         initial_history: Optional[List] = None,
+        file_registry: Optional[RemoteFileRegistry] = None,
+        context_caches: Optional[ContextCacheRegistry] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        history_policy: Optional[HistoryPolicy] = None,
     ):
 
-        system_instruction_path = os.path.join(
-            os.path.dirname(__file__), "SystemInstruction.txt"
-        )
-        if os.path.exists(system_instruction_path):
-            with open(system_instruction_path, "r", encoding="utf-8") as f:
-                system_instruction_text = f.read()
-        else:
-            # 如果 SystemInstruction.txt 不存在，則建立並寫入預設內容
-            system_instruction_text = """小說產生原則
-沒有字數限制，但是要在保證文章品質的情況下盡可能的輸出更多文字與延長篇幅，你需要寫得非常詳細，且避免重複和無聊内容。
-盡可能的像人與人之間的對話，包含對話和聲音描寫，描寫心理變化和感受，使用通俗易懂的語言，且要有一定對話內容與連續性。
-角色之間的互動更具臨場感。若角色之間有衝突或情感波動，務必鋪陳心理變化與反應過程，讓讀者能感受到角色內心的拉扯與真實性。
-避免過度文藝化表達，使用直白具體的描述方式，甚至允許部分粗俗描述方式。
-場景要夠震撼，多細節才能顯得真實，給人身臨其境的感受。
-故事要符合邏輯。所有內容融為一體,不分點輸出,但可以分段，不要自作主張地分章節，我需要連續的文章，上下的對話可以貫通的那種。
-只需要產生我要求的小說內容，不要提供其他多餘回復或建議內容
-使用繁體中文產生小說"""
-
-            with open(system_instruction_path, "w", encoding="utf-8") as f:
-                f.write(system_instruction_text)
+        # 系統指令由共用快取提供，檔案修改後會自動重新讀取
+        system_instruction_text = system_instruction.get()
 
         # 調整安全設定
         safety_settings = [
@@ -86,69 +146,388 @@ class GeminiChatSession:
             # safety_settings = safety_settings
         )
 
-        self.client = genai.Client()
+        self.model_name = model_name
+        self.system_instruction_text = system_instruction_text
+        self.chat_config = config
+        self.cached_content = None
+        # 放進內容快取的檔案與改用快取前的設定，快取在遠端失效時還原
+        self.cached_files = []
+        self.uncached_config = None
+        # 內容快取的鍵（由模型、系統指令與檔案內容決定），回應快取用它代表已放進快取的檔案
+        self.cached_content_key = None
+        # 最近一次呼叫的 usage_metadata
+        self.last_usage = None
+        # 逐輪的 token 用量與累計
+        self.usage_tracker = UsageTracker("gemini", model_name)
+        # 已上傳檔案的 URI -> token 數（preflight_tokens 算出後記下，估算請求大小時使用）
+        self.file_tokens = {}
+
+        # 共用的 client，保留 keep-alive 連線；非同步 client 綁定事件迴圈，每個 session 各自建立
+        self.client = client_pool.gemini()
+        self.async_client = client_pool.gemini_async()
+        self.file_registry = file_registry or remote_file_registry
+        self.context_caches = context_caches or context_cache_registry
+        self.rate_limiter = get_rate_limiter("gemini", model_name)
+        self.retry_policy = retry_policy or default_retry_policy
+        # 每次重試時呼叫，參數為 retry_policy 產生的事件 dict
+        self.on_retry = None
+        # 串流中途失敗時要接續 ("continue") 還是整段重來 ("reset")
+        self.stream_resume_mode = DEFAULT_STREAM_RESUME_MODE
+        # 每次送出前依 token 預算整理對話歷史
+        self.history_policy = history_policy or default_history_policy
+        self.history_adapter = GeminiHistoryAdapter(self)
         self.chat = self.client.chats.create(
             model=model_name, config=config, history=initial_history or []
         )
         self.printLog("對話 session 已成功啟動。")
 
-    def upload_files(self, file_paths: List[str]) -> List[Any]:
+    def _rebuild_chat(self, history: Optional[List] = None):
+        """以目前的設定重新建立 chat，保留指定的對話歷史。"""
+        if history is None:
+            history = self.chat.get_history()
+        self.chat = self.client.chats.create(
+            model=self.model_name, config=self.chat_config, history=history
+        )
+
+    def _apply_history_policy(self):
+        """送出前套用 history_policy；歷史有變動時才重建 chat。"""
+        history = self.chat.get_history()
+        trimmed = self.history_policy.apply(history, self.history_adapter)
+        if trimmed is not history:
+            self.printLog(f"對話歷史已整理：{len(history)} 則 -> {len(trimmed)} 則")
+            self._rebuild_chat(trimmed)
+
+    def use_context_cache(
+        self, file_paths: List[str], files: List[Any], ttl: int = CACHE_TTL
+    ) -> bool:
+        """
+        把系統指令與來源檔案放進 Gemini 的顯式快取，之後的訊息就不必再附加這些檔案。
+        相同模型、系統指令與檔案內容的快取會直接沿用；內容太小（未達模型的最低 token 數）則不建立。
+
+        Args:
+            file_paths (List[str]): 來源檔案的本機路徑，用來計算快取鍵。
+            files (List[Any]): 對應的已上傳檔案物件（順序與 file_paths 相同）。
+            ttl (int): 新建快取的存活秒數。
+
+        Returns:
+            bool: 是否已改用快取。
+        """
+        if not files:
+            return False
+
+        try:
+            digests = [self.file_registry.file_digest(path) for path in file_paths]
+            key = cache_key(self.model_name, self.system_instruction_text, digests)
+            cache_name = self.context_caches.lookup(key)
+
+            if cache_name is not None:
+                self.printLog(f"沿用既有的內容快取 {cache_name}")
+            else:
+                contents = [
+                    types.Content(
+                        role="user",
+                        parts=[
+                            types.Part.from_uri(file_uri=f.uri, mime_type=f.mime_type)
+                            for f in files
+                        ],
+                    )
+                ]
+                token_count = self.client.models.count_tokens(
+                    model=self.model_name, contents=contents
+                ).total_tokens
+                if token_count < min_cache_tokens(self.model_name):
+                    self.printLog(
+                        f"來源檔案只有 {token_count} tokens，未達快取下限，不建立快取。"
+                    )
+                    return False
+
+                cache = self.client.caches.create(
+                    model=self.model_name,
+                    config=types.CreateCachedContentConfig(
+                        display_name=f"route_{key[:16]}",
+                        system_instruction=self.system_instruction_text,
+                        contents=contents,
+                        ttl=f"{ttl}s",
+                    ),
+                )
+                cache_name = cache.name
+                self.context_caches.register(
+                    key, cache_name, cache.expire_time, self.model_name
+                )
+                self.printLog(f"已建立內容快取 {cache_name}（{token_count} tokens）")
+        except Exception as e:
+            print(f"建立內容快取失敗，改為每次附加檔案：{e}")
+            return False
+
+        # 使用快取時系統指令已在快取內，不能再另外指定
+        self.cached_content = cache_name
+        self.cached_content_key = key
+        self.cached_files = list(files)
+        self.uncached_config = self.chat_config
+        self.chat_config = types.GenerateContentConfig(
+            cached_content=cache_name,
+            temperature=self.chat_config.temperature,
+        )
+        self._rebuild_chat()
+        return True
+
+    def _context_cache_lost(self, error: Exception) -> bool:
+        """
+        錯誤是否代表使用中的內容快取在遠端已不存在或無權使用（過期、被刪除）。
+        只有錯誤內容指向這個 cachedContents/... 資源時才算，其他資源（例如過期的檔案 URI）的 404 / 403 不算。
+        """
+        if self.cached_content is None:
+            return False
+        status = getattr(error, "status", None) or ""
+        code = getattr(error, "code", None)
+        if status not in CACHE_LOST_STATUS and code not in (403, 404):
+            return False
+        text = f"{error} {getattr(error, 'message', '') or ''} {getattr(error, 'details', '') or ''}"
+        return self.cached_content in text
+
+    def _drop_context_cache(self, request_content: List) -> List:
+        """
+        移除失效的內容快取：刪掉本機紀錄、改回原本的設定重建 chat，
+        並把原本在快取中的檔案附加回這次的請求，回傳新的請求內容。
+        """
+        self.printLog(f"內容快取 {self.cached_content} 已失效，改為直接附加檔案後重試。", True)
+        self.context_caches.forget(self.cached_content_key)
+        files = self.cached_files
+        self.chat_config = self.uncached_config
+        self.cached_content = None
+        self.cached_content_key = None
+        self.cached_files = []
+        self.uncached_config = None
+        self._rebuild_chat()
+        return request_content + [f for f in files if f not in request_content]
+
+    def _upload_one(self, path: str) -> Any:
+        """上傳單一檔案（登錄表或遠端已有相同內容時直接沿用），失敗時拋出例外。"""
+        # 先查本機的遠端檔案登錄表，內容相同且未到期就直接沿用
+        file_name = os.path.basename(path)
+        digest = self.file_registry.file_digest(path)
+
+        file_obj = self.file_registry.lookup(path, digest)
+        if file_obj is not None:
+            print(f"取得先前上傳的「{file_name}」")
+            return file_obj
+
+        # 登錄表沒有紀錄時，才列出遠端檔案（同一批只列一次），依雜湊比對
+        file_obj = self.file_registry.find_remote(self.client, path, digest)
+        if file_obj is not None:
+            print(f"取得先前上傳的「{file_name}」(遠端比對)")
+        else:
+            print(f"找不到之前上傳的「{file_name}」，開始上傳新的檔案。")
+            uploadFileConfig = {"display_name": file_name}
+            file_obj = self.client.files.upload(file=path, config=uploadFileConfig)
+
+        self.file_registry.register(path, digest, file_obj)
+        return file_obj
+
+    def upload_files_iter(
+        self, file_paths: List[str], max_workers: int = UPLOAD_MAX_WORKERS
+    ) -> Generator[Tuple[str, Any, Optional[Exception]], None, None]:
+        """
+        以有上限的執行緒池同時上傳多個檔案，每完成一個就產出一次結果。
+
+        Yields:
+            Tuple[str, Any, Optional[Exception]]: (本機路徑, 檔案物件或 None, 錯誤或 None)
+        """
+        if not file_paths:
+            return
+        workers = max(1, min(max_workers, len(file_paths)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._upload_one, path): path for path in file_paths}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    yield path, future.result(), None
+                except Exception as e:
+                    print(f"檔案上傳失敗：{path}，錯誤：{e}")
+                    yield path, None, e
+
+    def wait_until_active_iter(
+        self, files: List[Any], timeout: float = ACTIVE_WAIT_TIMEOUT
+    ) -> Generator[Tuple[Any, str], None, None]:
+        """
+        輪詢檔案狀態直到全部變成 ACTIVE（或失敗、逾時），間隔採指數退避。
+        每個檔案狀態有變化時產出一次 (檔案物件, 狀態名稱)。
+        """
+        pending = {}
+        for file_obj in files:
+            state = _file_state(file_obj)
+            if state == "ACTIVE" or not getattr(file_obj, "name", None):
+                yield file_obj, state or "ACTIVE"
+            else:
+                pending[file_obj.name] = file_obj
+
+        delay = 1.0
+        deadline = time.monotonic() + timeout
+        while pending:
+            if time.monotonic() >= deadline:
+                for file_obj in pending.values():
+                    yield file_obj, "TIMEOUT"
+                return
+
+            time.sleep(delay)
+            delay = min(delay * 1.5, 10.0)
+
+            for name in list(pending):
+                try:
+                    latest = self.client.files.get(name=name)
+                except Exception as e:
+                    print(f"查詢檔案狀態失敗：{name}，錯誤：{e}")
+                    continue
+                state = _file_state(latest)
+                if state == _file_state(pending[name]):
+                    pending[name] = latest
+                    continue
+
+                self.file_registry.update_state(latest)
+                if state in ("ACTIVE", "FAILED"):
+                    del pending[name]
+                else:
+                    pending[name] = latest
+                yield latest, state
+
+    def upload_files(
+        self, file_paths: List[str], max_workers: int = UPLOAD_MAX_WORKERS
+    ) -> List[Any]:
         """
         上傳本地檔案到 Google Gemini API，回傳可用於對話的檔案物件列表。
+        檔案會同時上傳，並等到全部變成 ACTIVE 才回傳。
 
         Args:
             file_paths (List[str]): 要上傳的本地檔案路徑清單。
+            max_workers (int): 同時上傳的檔案數上限。
 
         Returns:
-            List[Any]: 上傳後的檔案物件列表，可傳給 send_message 的 uploaded_files 參數。
+            List[Any]: 上傳後的檔案物件列表（順序與 file_paths 相同），可傳給 send_message 的 uploaded_files 參數。
         """
+        results = {}
+        for path, file_obj, error in self.upload_files_iter(file_paths, max_workers):
+            if file_obj is not None:
+                results[path] = file_obj
+
+        print("\n--- 所有檔案上傳請求已提交，開始等待後端處理 ---")
+        active = {}
+        for file_obj, state in self.wait_until_active_iter(list(results.values())):
+            print(f"「{getattr(file_obj, 'display_name', file_obj)}」狀態：{state}")
+            if state == "ACTIVE":
+                active[getattr(file_obj, "name", None)] = file_obj
+
         uploaded_files = []
         for path in file_paths:
-            try:
-                # 新寫法，取得已上傳檔案的資訊
-                # 將檔案上傳到google
-                file_name = os.path.basename(path)
-
-                # 列出專案擁有的 File 中繼資料。
-                lstFiles = self.client.files.list()
-                if lstFiles:
-                    lstFiles = [
-                        item
-                        for item in lstFiles
-                        if getattr(item, "display_name", None) == file_name
-                    ]
-                    if lstFiles:
-                        # 檢查 state 是否為 ACTIVE；state 可能是物件（有 name 屬性）或字串
-                        def _is_active(item):
-                            state = getattr(item, "state", None)
-                            if state is None:
-                                return False
-                            name = getattr(state, "name", None)
-                            if name is not None:
-                                return name == "ACTIVE"
-                            return str(state).upper() == "ACTIVE"
-
-                        lstFiles = [item for item in lstFiles if _is_active(item)]
-                    else:
-                        lstFiles = None
-                else:
-                    lstFiles = None
+            file_obj = results.get(path)
+            if file_obj is None:
+                continue
+            file_obj = active.get(getattr(file_obj, "name", None))
+            if file_obj is not None:
+                uploaded_files.append(file_obj)
+        return uploaded_files
+
+    async def _upload_one_async(self, path: str) -> Any:
+        """_upload_one 的 asyncio 版本：雜湊與登錄表查詢放到執行緒，上傳使用非同步 client。"""
+        file_name = os.path.basename(path)
+        digest = await asyncio.to_thread(self.file_registry.file_digest, path)
+
+        file_obj = self.file_registry.lookup(path, digest)
+        if file_obj is not None:
+            print(f"取得先前上傳的「{file_name}」")
+            return file_obj
+
+        file_obj = await asyncio.to_thread(
+            self.file_registry.find_remote, self.client, path, digest
+        )
+        if file_obj is not None:
+            print(f"取得先前上傳的「{file_name}」(遠端比對)")
+        else:
+            print(f"找不到之前上傳的「{file_name}」，開始上傳新的檔案。")
+            uploadFileConfig = {"display_name": file_name}
+            file_obj = await self.async_client.files.upload(file=path, config=uploadFileConfig)
+
+        await asyncio.to_thread(self.file_registry.register, path, digest, file_obj)
+        return file_obj
+
+    async def wait_until_active_async(
+        self, files: List[Any], timeout: float = ACTIVE_WAIT_TIMEOUT
+    ) -> dict:
+        """
+        wait_until_active_iter 的 asyncio 版本。
 
-                if not lstFiles == None:
-                    print(f"取得先前上傳的「{file_name}」")
-                    uploaded_files.append(lstFiles[0])
+        Returns:
+            dict: 檔案名稱 -> 最終的檔案物件（狀態可能是 ACTIVE、FAILED 或仍在處理中）。
+        """
+        results = {}
+        pending = {}
+        for file_obj in files:
+            state = _file_state(file_obj)
+            if state == "ACTIVE" or not getattr(file_obj, "name", None):
+                results[getattr(file_obj, "name", None)] = file_obj
+            else:
+                pending[file_obj.name] = file_obj
+
+        delay = 1.0
+        deadline = time.monotonic() + timeout
+        while pending and time.monotonic() < deadline:
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, 10.0)
+
+            for name in list(pending):
+                try:
+                    latest = await self.async_client.files.get(name=name)
+                except Exception as e:
+                    print(f"查詢檔案狀態失敗：{name}，錯誤：{e}")
+                    continue
+                state = _file_state(latest)
+                if state != _file_state(pending[name]):
+                    self.file_registry.update_state(latest)
+                    print(f"「{getattr(latest, 'display_name', name)}」狀態：{state}")
+                if state in ("ACTIVE", "FAILED"):
+                    results[name] = latest
+                    del pending[name]
                 else:
-                    print(f"找不到之前上傳的「{file_name}」，開始上傳新的檔案。")
-                    uploadFileConfig = {"display_name": file_name}
-                    file_obj = self.client.files.upload(
-                        file=path, config=uploadFileConfig
-                    )
-                    uploaded_files.append(file_obj)
+                    pending[name] = latest
 
-            except Exception as e:
-                print(f"檔案上傳失敗：{path}，錯誤：{e}")
+        results.update(pending)
+        return results
+
+    async def upload_files_async(
+        self, file_paths: List[str], max_workers: int = UPLOAD_MAX_WORKERS
+    ) -> List[Any]:
+        """
+        upload_files 的 asyncio 版本：以 max_workers 為上限同時上傳，等全部變成 ACTIVE 後
+        依 file_paths 的順序回傳檔案物件。
+        """
+        if not file_paths:
+            return []
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+
+        async def upload(path):
+            async with semaphore:
+                return await self._upload_one_async(path)
+
+        uploaded = await asyncio.gather(
+            *(upload(path) for path in file_paths), return_exceptions=True
+        )
+        results = {}
+        for path, file_obj in zip(file_paths, uploaded):
+            if isinstance(file_obj, Exception):
+                print(f"檔案上傳失敗：{path}，錯誤：{file_obj}")
+            else:
+                results[path] = file_obj
 
         print("\n--- 所有檔案上傳請求已提交，開始等待後端處理 ---")
+        final = await self.wait_until_active_async(list(results.values()))
+
+        uploaded_files = []
+        for path in file_paths:
+            file_obj = results.get(path)
+            if file_obj is None:
+                continue
+            file_obj = final.get(getattr(file_obj, "name", None))
+            if file_obj is not None and _file_state(file_obj) in ("ACTIVE", ""):
+                uploaded_files.append(file_obj)
         return uploaded_files
 
     def send_message(self, prompt: str, uploaded_files: Optional[List] = None):
@@ -170,54 +549,131 @@ class GeminiChatSession:
         if not prompt and not uploaded_files:
             return "錯誤：請提供文字提示或上傳檔案。"
 
-        max_retries = 5
+        self._apply_history_policy()
+        retry = self.retry_policy.begin("gemini", self.model_name, self.on_retry)
 
-        for attempt in range(max_retries):
+        while True:
             current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
             self.printLog(f"\n正在向 Gemini 傳送訊息，{current_datetime}...")
             try:
                 # 對於多輪對話，我們使用 chat.send_message() 而非 model.generate_content()
+                rate_entry = self.rate_limiter.acquire(self.estimate_tokens(prompt, request_content[1:]))
                 response = self.chat.send_message(
                     request_content, config=self.generation_config
                 )
+                self._record_usage(rate_entry, response.usage_metadata)
                 current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
                 self.printLog(f"\nGemini 已回傳訊息，{current_datetime}...")
                 return response.text
-            except (
-                exceptions.InternalServerError,
-                exceptions.DeadlineExceeded,
-                google_exceptions.ResourceExhausted,
-            ) as e:
-                log_time = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-                self.printLog(
-                    f"[{log_time}]呼叫 API 時發生可重試錯誤 (第 {attempt + 1} 次失敗): {e}",
-                    True,
+            except Exception as e:
+                if self._context_cache_lost(e):
+                    request_content = self._drop_context_cache(request_content)
+                    continue
+                delay = self._retry_delay(retry, e)
+                if delay is None:
+                    return self._give_up_message(retry, e)
+                time.sleep(delay)
+
+    def _record_usage(self, rate_entry, usage_metadata):
+        """記錄一次成功呼叫的用量：更新 last_usage、配額計數與 usage_tracker。"""
+        if usage_metadata is None:
+            return
+        self.last_usage = usage_metadata
+        self.rate_limiter.record(rate_entry, usage_metadata.total_token_count)
+        self.usage_tracker.record(gemini_usage(usage_metadata))
+
+    def _retry_delay(self, retry, error: Exception) -> Optional[float]:
+        """記錄一次失敗，回傳重試前的等待秒數；不再重試時回傳 None。"""
+        log_time = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        delay = retry.next_delay(error)
+        if delay is not None:
+            self.printLog(
+                f"[{log_time}]呼叫 API 時發生可重試錯誤 (第 {retry.attempt} 次失敗): {error}",
+                True,
+            )
+            self.printLog(f"將在 {delay:.1f} 秒後重試...", True)
+        elif retry.exhausted:
+            self.printLog(f"[{log_time}]已達到最大重試次數或時限，放棄操作。", True)
+        else:
+            print("=====發生未知錯誤=====")
+            print(error)
+        return delay
+
+    def _give_up_message(self, retry, error: Exception) -> str:
+        if retry.exhausted:
+            return f"呼叫 Google API 失敗，已重試 {retry.attempt} 次後放棄。最後錯誤：{error}"
+        return f"生成回應時發生未預期的錯誤：{error}"
+
+    def _user_content(self, request_content: List) -> types.Content:
+        """把 send_message 的輸入（文字與已上傳檔案）轉成一則 user Content。"""
+        parts = []
+        for item in request_content:
+            if isinstance(item, str):
+                if item:
+                    parts.append(types.Part.from_text(text=item))
+            elif isinstance(item, types.Part):
+                parts.append(item)
+            else:
+                parts.append(
+                    types.Part.from_uri(file_uri=item.uri, mime_type=item.mime_type)
                 )
-                if attempt < max_retries - 1:
-                    if hasattr(e, "retry_delay") and e.retry_delay is not None:
-                        print(f" {e.retry_delay}")
+        return types.Content(role="user", parts=parts)
+
+    def _continuation_contents(self, request_content: List, partial: str) -> List:
+        """接續生成用的內容：原本的歷史、這次的提問、已收到的部分回應，再加上接續指示。"""
+        return self.chat.get_history() + [
+            self._user_content(request_content),
+            types.Content(role="model", parts=[types.Part.from_text(text=partial)]),
+            types.Content(role="user", parts=[types.Part.from_text(text=CONTINUATION_PROMPT)]),
+        ]
 
-                    self.printLog(f"將在 10 秒後重試...", True)
-                    time.sleep(10)
-                else:
-                    self.printLog("[{log_time}]已達到最大重試次數，放棄操作。", True)
-                    return f"呼叫 Google API 失敗，已重試 {max_retries} 次後放棄。最後錯誤：{e}"
-            except Exception as e:
-                print("=====發生未知錯誤=====")
-                print(e)
-                return f"生成回應時發生未預期的錯誤：{e}"
-            
-    def send_message_stream(self, prompt: str, uploaded_files: Optional[List] = None) -> Generator[str, None, None]:
+    def _record_turn(self, request_content: List, response_text: str):
+        """把「提問 + 完整回應」當成一輪寫回歷史（接續生成合併前後兩段時使用）。"""
+        self._rebuild_chat(
+            self.chat.get_history()
+            + [
+                self._user_content(request_content),
+                types.Content(role="model", parts=[types.Part.from_text(text=response_text)]),
+            ]
+        )
+
+    def record_exchange(self, prompt: str, uploaded_files: Optional[List], response_text: str):
+        """不呼叫模型，直接把一組提問與回應寫進歷史（回應快取命中時使用）。"""
+        request_content = [prompt]
+        if uploaded_files:
+            request_content.extend(uploaded_files)
+        self._record_turn(request_content, response_text)
+
+    def cache_identity(self) -> dict:
+        """回應快取的鍵所需的內容：模型、生成設定、系統指令與目前的歷史。"""
+        return {
+            "provider": "gemini",
+            "model": self.model_name,
+            "config": {
+                "temperature": self.chat_config.temperature,
+                "generation_config": self.generation_config,
+                "cached_files": self.cached_content_key,
+            },
+            "system_instruction": self.system_instruction_text,
+            "history": self.serialize_history(),
+        }
+
+    def send_message_stream(self, prompt: str, uploaded_files: Optional[List] = None) -> Generator[Union[str, StreamReset], None, None]:
         """
         使用串流方式將 prompt 和選擇性的檔案傳送給模型，實時產生回應。
         這個方法會利用 session 的歷史紀錄來進行有上下文的對話。
 
+        串流中途失敗時依 stream_resume_mode 處理：
+        "continue" 會請模型從中斷處接續，已送出的片段仍然有效；
+        "reset" 會先 yield 一個 StreamReset，呼叫端應丟棄已收到的內容，再從頭重新生成。
+        兩種方式最後都只會在對話歷史中留下一組完整的提問與回應。
+
         Args:
             prompt (str): 使用者的文字輸入。
             uploaded_files (Optional[List]): 使用者上傳的檔案列表 (如果有的話)。
 
         Yields:
-            str: 逐步從 Gemini 模型接收的回應文字片段。
+            Union[str, StreamReset]: 逐步從 Gemini 模型接收的回應文字片段，或重來的標記。
 
         Example:
             for chunk in session.send_message_stream("寫一個故事"):
@@ -231,57 +687,328 @@ class GeminiChatSession:
             yield "錯誤：請提供文字提示或上傳檔案。"
             return
 
-        max_retries = 5
+        self._apply_history_policy()
+        retry = self.retry_policy.begin("gemini", self.model_name, self.on_retry)
+        # 目前這次回應已經送出的文字
+        partial = ""
 
-        for attempt in range(max_retries):
+        while True:
             current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-            self.printLog(f"\n正在向 Gemini 傳送訊息（串流模式），{current_datetime}...")
-            try:
-                # 使用 stream_generate_content 來啟動串流模式
-                response_stream = self.chat.send_message_stream(
-                    request_content, config=self.generation_config
+            continuing = bool(partial)
+            if continuing:
+                self.printLog(
+                    f"\n向 Gemini 要求從第 {len(partial)} 字接續生成，{current_datetime}..."
                 )
+            else:
+                self.printLog(f"\n正在向 Gemini 傳送訊息（串流模式），{current_datetime}...")
+            try:
+                rate_entry = self.rate_limiter.acquire(self.estimate_tokens(prompt, request_content[1:]))
+                if continuing:
+                    # 接續生成不經過 chat，避免把中斷的半段回應記進歷史
+                    response_stream = self.client.models.generate_content_stream(
+                        model=self.model_name,
+                        contents=self._continuation_contents(request_content, partial),
+                        config=self.generation_config or self.chat_config,
+                    )
+                else:
+                    # 使用 stream_generate_content 來啟動串流模式
+                    response_stream = self.chat.send_message_stream(
+                        request_content, config=self.generation_config
+                    )
                 
                 current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
                 self.printLog(f"\nGemini 開始串流回應，{current_datetime}...")
                 
                 # 逐段產生回應文字
+                call_usage = None
                 for chunk in response_stream:
                     # print(chunk)
                     # print("-----chunk end-----")
+                    # usage_metadata 在最後一個 chunk 才是完整的總數
+                    if chunk.usage_metadata is not None:
+                        call_usage = chunk.usage_metadata
                     if chunk.text:
+                        partial += chunk.text
                         yield chunk.text
                 
+                self._record_usage(rate_entry, call_usage)
+                if continuing:
+                    self._record_turn(request_content, partial)
                 current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
                 self.printLog(f"\nGemini 串流已完成，{current_datetime}...")
                 return
                 
-            except (
-                exceptions.InternalServerError,
-                exceptions.DeadlineExceeded,
-                google_exceptions.ResourceExhausted,
-            ) as e:
-                log_time = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-                self.printLog(
-                    f"[{log_time}]呼叫 API 時發生可重試錯誤 (第 {attempt + 1} 次失敗): {e}",
-                    True,
+            except Exception as e:
+                if self._context_cache_lost(e):
+                    request_content = self._drop_context_cache(request_content)
+                    continue
+                delay = self._retry_delay(retry, e)
+                if delay is None:
+                    yield self._give_up_message(retry, e)
+                    return
+                if partial and self.stream_resume_mode == "reset":
+                    partial = ""
+                    yield StreamReset()
+                time.sleep(delay)
+
+    def _async_chat(self):
+        """以目前的歷史建立一個非同步 chat；完成後再用 _rebuild_chat 把結果同步回 self.chat。"""
+        return self.async_client.chats.create(
+            model=self.model_name, config=self.chat_config, history=self.chat.get_history()
+        )
+
+    async def send_message_async(self, prompt: str, uploaded_files: Optional[List] = None):
+        """
+        send_message 的 asyncio 版本，使用 client.aio，等待重試時不會佔住執行緒。
+        對話歷史與同步方法共用。
+
+        Returns:
+            str: 來自 Gemini 模型的回應文字，或是一則錯誤訊息。
+        """
+        request_content = [prompt]
+        if uploaded_files:
+            request_content.extend(uploaded_files)
+
+        if not prompt and not uploaded_files:
+            return "錯誤：請提供文字提示或上傳檔案。"
+
+        await asyncio.to_thread(self._apply_history_policy)
+        retry = self.retry_policy.begin("gemini", self.model_name, self.on_retry)
+
+        while True:
+            current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+            self.printLog(f"\n正在向 Gemini 傳送訊息（非同步），{current_datetime}...")
+            try:
+                rate_entry = await self.rate_limiter.acquire_async(self.estimate_tokens(prompt, request_content[1:]))
+                chat = self._async_chat()
+                response = await chat.send_message(
+                    request_content, config=self.generation_config
                 )
-                if attempt < max_retries - 1:
-                    if hasattr(e, "retry_delay") and e.retry_delay is not None:
-                        print(f" {e.retry_delay}")
+                self._record_usage(rate_entry, response.usage_metadata)
+                self._rebuild_chat(chat.get_history())
+                current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+                self.printLog(f"\nGemini 已回傳訊息，{current_datetime}...")
+                return response.text
+            except Exception as e:
+                if self._context_cache_lost(e):
+                    request_content = self._drop_context_cache(request_content)
+                    continue
+                delay = self._retry_delay(retry, e)
+                if delay is None:
+                    return self._give_up_message(retry, e)
+                await asyncio.sleep(delay)
+
+    async def send_message_stream_async(
+        self, prompt: str, uploaded_files: Optional[List] = None
+    ) -> AsyncGenerator[Union[str, StreamReset], None]:
+        """
+        send_message_stream 的 asyncio 版本，用法為 async for。
+        中途失敗時的接續 / 重來行為與同步版本相同。
+
+        Example:
+            async for chunk in session.send_message_stream_async("寫一個故事"):
+                print(chunk, end="", flush=True)
+        """
+        request_content = [prompt]
+        if uploaded_files:
+            request_content.extend(uploaded_files)
+
+        if not prompt and not uploaded_files:
+            yield "錯誤：請提供文字提示或上傳檔案。"
+            return
 
-                    self.printLog(f"將在 10 秒後重試...", True)
-                    time.sleep(10)
+        await asyncio.to_thread(self._apply_history_policy)
+        retry = self.retry_policy.begin("gemini", self.model_name, self.on_retry)
+        partial = ""
+
+        while True:
+            current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+            continuing = bool(partial)
+            self.printLog(f"\n正在向 Gemini 傳送訊息（非同步串流），{current_datetime}...")
+            try:
+                rate_entry = await self.rate_limiter.acquire_async(self.estimate_tokens(prompt, request_content[1:]))
+                chat = None
+                if continuing:
+                    response_stream = await self.async_client.models.generate_content_stream(
+                        model=self.model_name,
+                        contents=self._continuation_contents(request_content, partial),
+                        config=self.generation_config or self.chat_config,
+                    )
                 else:
-                    self.printLog("[{log_time}]已達到最大重試次數，放棄操作。", True)
-                    yield f"呼叫 Google API 失敗，已重試 {max_retries} 次後放棄。最後錯誤：{e}"
-                    return
-            except Exception as e:
-                print("=====發生未知錯誤=====")
-                print(e)
-                yield f"生成回應時發生未預期的錯誤：{e}"
+                    chat = self._async_chat()
+                    response_stream = await chat.send_message_stream(
+                        request_content, config=self.generation_config
+                    )
+
+                call_usage = None
+                async for chunk in response_stream:
+                    if chunk.usage_metadata is not None:
+                        call_usage = chunk.usage_metadata
+                    if chunk.text:
+                        partial += chunk.text
+                        yield chunk.text
+
+                self._record_usage(rate_entry, call_usage)
+                if continuing:
+                    self._record_turn(request_content, partial)
+                else:
+                    self._rebuild_chat(chat.get_history())
+                current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+                self.printLog(f"\nGemini 串流已完成，{current_datetime}...")
                 return
+
+            except Exception as e:
+                if self._context_cache_lost(e):
+                    request_content = self._drop_context_cache(request_content)
+                    continue
+                delay = self._retry_delay(retry, e)
+                if delay is None:
+                    yield self._give_up_message(retry, e)
+                    return
+                if partial and self.stream_resume_mode == "reset":
+                    partial = ""
+                    yield StreamReset()
+                await asyncio.sleep(delay)
+
+    def _file_token_estimate(self, file_obj: Any) -> int:
+        """單一附加檔案的 token 數：有 preflight 的計數就直接用，否則依檔案大小粗估。"""
+        tokens = self.file_tokens.get(getattr(file_obj, "uri", None))
+        if tokens is not None:
+            return tokens
+        return (getattr(file_obj, "size_bytes", None) or 0) // BYTES_PER_TOKEN
+
+    def estimate_tokens(self, prompt: str, uploaded_files: Optional[List] = None) -> int:
+        """粗估下一次請求的 token 數：上一輪的總用量（含歷史）加上新的 prompt 與這次附加的檔案。"""
+        previous = 0
+        if self.last_usage is not None:
+            previous = self.last_usage.total_token_count or 0
+        files = sum(self._file_token_estimate(f) for f in uploaded_files or [])
+        return previous + len(prompt or "") + files
+
+    def estimate_wait(self, prompt: str, uploaded_files: Optional[List] = None) -> float:
+        """預估送出 prompt（與附加的檔案）前需要為了配額等待幾秒。"""
+        return self.rate_limiter.estimate_wait(self.estimate_tokens(prompt, uploaded_files))
+
+    def usage_summary(self) -> Optional[dict]:
+        """整理最近一次呼叫的 token 使用量：快取命中與新計費的輸入 token 分開列出。"""
+        usage = self.last_usage
+        if usage is None:
+            return None
+        usage = gemini_usage(usage)
+        return {
+            "prompt": usage["input"],
+            "cached": usage["cached"],
+            "fresh": usage["input"] - usage["cached"],
+            "output": usage["output"],
+            "thinking": usage["thinking"],
+        }
+
+    def count_tokens(self, contents) -> int:
+        """呼叫 count_tokens API 計算 contents（文字或已上傳的檔案）的 token 數。"""
+        return self.client.models.count_tokens(
+            model=self.model_name, contents=contents
+        ).total_tokens
+
+    def preflight_tokens(self, files: List[Tuple[str, Any]], prompts: List[str]) -> dict:
+        """
+        執行前估算路線的輸入 token，結果依內容雜湊快取。
+
+        Args:
+            files (List[Tuple[str, Any]]): (本機路徑, 已上傳的檔案物件)。
+            prompts (List[str]): 依序要送出的文字指令。
+
+        Returns:
+            dict: files / prompts 為各自的 token 數；estimated_input 為整個執行的輸入 token 下限
+                  （每個指令都會重送檔案與先前的指令，尚未計入模型回應）。
+        """
+        file_tokens = 0
+        for path, file_obj in files:
+            tokens = token_count_cache.get_or_count(
+                "gemini", self.model_name, hash_file(path),
+                lambda: self.count_tokens([file_obj]),
+            )
+            self.file_tokens[file_obj.uri] = tokens
+            file_tokens += tokens
+        prompt_tokens = []
+        for prompt in prompts:
+            prompt_tokens.append(
+                token_count_cache.get_or_count(
+                    "gemini", self.model_name, hash_text(prompt),
+                    lambda: self.count_tokens(prompt),
+                )
+            )
+        system_tokens = token_count_cache.get_or_count(
+            "gemini", self.model_name, hash_text(self.system_instruction_text),
+            lambda: self.count_tokens(self.system_instruction_text),
+        )
+        estimated_input = 0
+        sent = 0
+        for tokens in prompt_tokens:
+            sent += tokens
+            estimated_input += system_tokens + file_tokens + sent
+        return {
+            "system": system_tokens,
+            "files": file_tokens,
+            "prompts": sum(prompt_tokens),
+            "estimated_input": estimated_input,
+        }
+
     @property
     def history(self) -> List:
         """返回目前的對話歷史紀錄。"""
         return self.chat.get_history()
+
+    def serialize_history(self) -> List[dict]:
+        """把對話歷史轉成可存成 JSON 的 list（history_*.txt 與檢查點使用的格式）。"""
+        history_to_save = []
+        for message in self.chat.get_history():
+            message_dict = {"role": message.role, "parts": []}
+            for part in message.parts or []:
+                if part.text is not None:
+                    message_dict["parts"].append({"type": "text", "text": part.text})
+                elif part.file_data is not None:
+                    # FileDataPart 包含 mime_type 和 uri
+                    message_dict["parts"].append(
+                        {
+                            "type": "file_data",
+                            "mime_type": part.file_data.mime_type,
+                            "uri": part.file_data.file_uri,
+                        }
+                    )
+                else:
+                    print(f"警告：發現未知類型的對話部分，已跳過：{type(part)}")
+            history_to_save.append(message_dict)
+        return history_to_save
+
+    @staticmethod
+    def deserialize_history(data: List[dict], uri_map: Optional[dict] = None) -> List:
+        """
+        serialize_history 的反向操作，可直接當成 initial_history。
+
+        Args:
+            data (List[dict]): serialize_history 產生的 list。
+            uri_map (Optional[dict]): 舊檔案 URI -> 新檔案 URI，用於檔案重新上傳後的對應。
+        """
+        uri_map = uri_map or {}
+        history = []
+        for message in data:
+            parts = []
+            for part in message.get("parts", []):
+                if part.get("type") == "text":
+                    parts.append(types.Part.from_text(text=part["text"]))
+                elif part.get("type") == "file_data":
+                    parts.append(
+                        types.Part.from_uri(
+                            file_uri=uri_map.get(part["uri"], part["uri"]),
+                            mime_type=part["mime_type"],
+                        )
+                    )
+            history.append(types.Content(role=message["role"], parts=parts))
+        return history
+
+    def remap_file_uris(self, uri_map: dict):
+        """檔案重新上傳、URI 改變時，把歷史中的舊 URI 換成新的。"""
+        uri_map = {old: new for old, new in uri_map.items() if old != new}
+        if not uri_map:
+            return
+        self._rebuild_chat(self.deserialize_history(self.serialize_history(), uri_map))
@@ -0,0 +1,306 @@
+import asyncio
+import glob
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, Generator, List, Optional, Tuple, Union
+
+from retry_policy import DEFAULT_STREAM_RESUME_MODE, StreamReset
+from token_usage import UsageTracker
+
+# 回放的節奏（可用環境變數調整）：每個片段的字數、片段之間的秒數、第一個片段前的秒數
+REPLAY_CHUNK_CHARS = int(os.getenv("REPLAY_CHUNK_CHARS", "40"))
+REPLAY_CHUNK_INTERVAL = float(os.getenv("REPLAY_CHUNK_INTERVAL", "0.05"))
+REPLAY_FIRST_CHUNK_DELAY = float(os.getenv("REPLAY_FIRST_CHUNK_DELAY", "0"))
+REPLAY_MODEL = "replay"
+
+
+def is_replay_model(model_name: Optional[str]) -> bool:
+    return model_name == REPLAY_MODEL
+
+
+def latest_recording(history_dir: str) -> Optional[str]:
+    """路線 history 資料夾中最新的 history_*.txt。"""
+    recordings = glob.glob(os.path.join(history_dir, "history_*.txt"))
+    return max(recordings, key=os.path.getmtime) if recordings else None
+
+
+class ReplayFile:
+    """代替 Gemini 已上傳檔案的物件，只提供 detail 會用到的欄位。"""
+
+    def __init__(self, path: str):
+        self.display_name = os.path.basename(path)
+        self.name = f"files/replay-{self.display_name}"
+        self.uri = f"replay://{self.display_name}"
+        self.mime_type = "text/plain"
+        self.state = "ACTIVE"
+
+
+def _as_dict(message: Any) -> Dict:
+    """把 types.Content 或 serialize_history 的 dict 統一成 dict 格式。"""
+    if isinstance(message, dict):
+        return message
+    parts = []
+    for part in message.parts or []:
+        if getattr(part, "text", None) is not None:
+            parts.append({"type": "text", "text": part.text})
+        elif getattr(part, "file_data", None) is not None:
+            parts.append(
+                {
+                    "type": "file_data",
+                    "mime_type": part.file_data.mime_type,
+                    "uri": part.file_data.file_uri,
+                }
+            )
+    return {"role": message.role, "parts": parts}
+
+
+def _text_of(message: Dict) -> str:
+    return "".join(part.get("text", "") for part in message.get("parts", []) if part.get("type") == "text")
+
+
+class ReplayChatSession:
+    """
+    與 GeminiChatSession 介面相同的回放 session。
+    回應取自先前執行存下的 history_*.txt，依設定的節奏串流輸出，不連網也不消耗配額，
+    可以用來跑完整的 runbyid 流程，並把程式本身的耗時與模型延遲分開量測。
+    """
+
+    def printLog(self, obj: Any, mustShow: bool = True):
+        showLog = False
+        if mustShow or showLog:
+            print(obj)
+
+    def __init__(
+        self,
+        model_name: str = REPLAY_MODEL,
+        initial_history: Optional[List] = None,
+        recording_path: Optional[str] = None,
+        chunk_chars: int = REPLAY_CHUNK_CHARS,
+        chunk_interval: float = REPLAY_CHUNK_INTERVAL,
+        first_chunk_delay: float = REPLAY_FIRST_CHUNK_DELAY,
+    ):
+        """
+        Args:
+            model_name (str): 模型名稱，只用於紀錄與指標。
+            initial_history (Optional[List]): 接續執行時的歷史（types.Content 或 dict 皆可）。
+            recording_path (Optional[str]): 要回放的 history_*.txt。
+            chunk_chars (int): 每個串流片段的字數。
+            chunk_interval (float): 片段之間的秒數。
+            first_chunk_delay (float): 第一個片段前的秒數（模擬首個片段延遲）。
+        """
+        if not recording_path or not os.path.exists(recording_path):
+            raise FileNotFoundError(f"找不到要回放的對話紀錄：{recording_path}")
+
+        self.model_name = model_name
+        self.recording_path = recording_path
+        self.chunk_chars = max(1, chunk_chars)
+        self.chunk_interval = chunk_interval
+        self.first_chunk_delay = first_chunk_delay
+        self.on_retry = None
+        self.stream_resume_mode = DEFAULT_STREAM_RESUME_MODE
+        self.last_usage = None
+        self.usage_tracker = UsageTracker("replay", model_name)
+        # 回放時模擬的模型耗時（秒），執行總時間扣掉它就是程式本身的耗時
+        self.model_seconds = 0.0
+
+        with open(recording_path, "r", encoding="utf-8") as f:
+            recorded = json.load(f)
+        # 錄製的輪次：(使用者文字, 模型回應)
+        self._turns: List[Tuple[str, str]] = []
+        for message in recorded:
+            if message.get("role") == "user":
+                self._turns.append((_text_of(message), None))
+            elif message.get("role") == "model" and self._turns:
+                prompt, response = self._turns[-1]
+                self._turns[-1] = (prompt, (response or "") + _text_of(message))
+        self._used = set()
+
+        self._history: List[Dict] = [_as_dict(message) for message in initial_history or []]
+        # 接續執行時，已經在歷史中的輪次視為用過
+        for message in self._history:
+            if message["role"] == "user":
+                self._take(_text_of(message))
+        self.printLog(
+            f"回放 session 已啟動：{os.path.basename(recording_path)}，共 {len(self._turns)} 則錄製的回應。"
+        )
+
+    def _take(self, prompt: str) -> Optional[str]:
+        """取出與 prompt 相同的下一則未用過的錄製回應；找不到時依序取下一則。"""
+        candidates = [i for i in range(len(self._turns)) if i not in self._used]
+        if not candidates:
+            return None
+        index = next((i for i in candidates if self._turns[i][0] == prompt), candidates[0])
+        self._used.add(index)
+        return self._turns[index][1] or ""
+
+    def _record(self, prompt: str, uploaded_files: Optional[List], response: str):
+        parts = [{"type": "text", "text": prompt}]
+        for file_obj in uploaded_files or []:
+            parts.append({"type": "file_data", "mime_type": file_obj.mime_type, "uri": file_obj.uri})
+        input_chars = sum(len(_text_of(message)) for message in self._history) + len(prompt)
+        self._history.append({"role": "user", "parts": parts})
+        self._history.append({"role": "model", "parts": [{"type": "text", "text": response}]})
+        # 以字數當作 token 數，讓用量與上限的流程照常運作
+        self.last_usage = {
+            "input": input_chars,
+            "cached": 0,
+            "output": len(response),
+            "thinking": 0,
+            "total": input_chars + len(response),
+        }
+        self.usage_tracker.record(self.last_usage)
+
+    def _exhausted_message(self) -> str:
+        # 使用 detail 會判定為錯誤的字串，讓執行在這裡停止
+        return f"生成回應時發生未預期的錯誤：{os.path.basename(self.recording_path)} 沒有更多錄製的回應。"
+
+    def _pieces(self, text: str) -> List[str]:
+        return [text[i : i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)]
+
+    # --- 檔案 ---
+    def upload_files_iter(self, file_paths: List[str]) -> Generator[Tuple[str, Any, Optional[Exception]], None, None]:
+        for path in file_paths:
+            yield path, ReplayFile(path), None
+
+    def wait_until_active_iter(self, files: List[Any]) -> Generator[Tuple[Any, str], None, None]:
+        for file_obj in files:
+            yield file_obj, "ACTIVE"
+
+    def upload_files(self, file_paths: List[str]) -> List[ReplayFile]:
+        return [ReplayFile(path) for path in file_paths]
+
+    async def upload_files_async(self, file_paths: List[str]) -> List[ReplayFile]:
+        return self.upload_files(file_paths)
+
+    def use_context_cache(self, file_paths: List[str], files: List[Any], ttl: int = 0) -> bool:
+        return False
+
+    def remap_file_uris(self, uri_map: dict):
+        for message in self._history:
+            for part in message["parts"]:
+                if part.get("type") == "file_data" and part["uri"] in uri_map:
+                    part["uri"] = uri_map[part["uri"]]
+
+    # --- 送出 ---
+    def send_message(self, prompt: str, uploaded_files: Optional[List] = None):
+        """回傳錄製的完整回應（等待時間與串流相同，方便比較兩種模式）。"""
+        if not prompt and not uploaded_files:
+            return "錯誤：請提供文字提示或上傳檔案。"
+        response = self._take(prompt)
+        if response is None:
+            return self._exhausted_message()
+        delay = self.first_chunk_delay + self.chunk_interval * len(self._pieces(response))
+        time.sleep(delay)
+        self.model_seconds += delay
+        self._record(prompt, uploaded_files, response)
+        return response
+
+    def send_message_stream(self, prompt: str, uploaded_files: Optional[List] = None) -> Generator[Union[str, StreamReset], None, None]:
+        """依 chunk_chars / chunk_interval 的節奏串流錄製的回應。"""
+        if not prompt and not uploaded_files:
+            yield "錯誤：請提供文字提示或上傳檔案。"
+            return
+        response = self._take(prompt)
+        if response is None:
+            yield self._exhausted_message()
+            return
+        current_datetime = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        self.printLog(f"\n回放錄製的回應（{len(response)} 字），{current_datetime}...")
+        time.sleep(self.first_chunk_delay)
+        self.model_seconds += self.first_chunk_delay
+        for piece in self._pieces(response):
+            yield piece
+            time.sleep(self.chunk_interval)
+            self.model_seconds += self.chunk_interval
+        self._record(prompt, uploaded_files, response)
+
+    async def send_message_async(self, prompt: str, uploaded_files: Optional[List] = None):
+        if not prompt and not uploaded_files:
+            return "錯誤：請提供文字提示或上傳檔案。"
+        response = self._take(prompt)
+        if response is None:
+            return self._exhausted_message()
+        delay = self.first_chunk_delay + self.chunk_interval * len(self._pieces(response))
+        await asyncio.sleep(delay)
+        self.model_seconds += delay
+        self._record(prompt, uploaded_files, response)
+        return response
+
+    async def send_message_stream_async(
+        self, prompt: str, uploaded_files: Optional[List] = None
+    ) -> AsyncGenerator[Union[str, StreamReset], None]:
+        if not prompt and not uploaded_files:
+            yield "錯誤：請提供文字提示或上傳檔案。"
+            return
+        response = self._take(prompt)
+        if response is None:
+            yield self._exhausted_message()
+            return
+        await asyncio.sleep(self.first_chunk_delay)
+        self.model_seconds += self.first_chunk_delay
+        for piece in self._pieces(response):
+            yield piece
+            await asyncio.sleep(self.chunk_interval)
+            self.model_seconds += self.chunk_interval
+        self._record(prompt, uploaded_files, response)
+
+    # --- 用量與歷史 ---
+    def estimate_tokens(self, prompt: str, uploaded_files: Optional[List] = None) -> int:
+        previous = self.last_usage["total"] if self.last_usage else 0
+        return previous + len(prompt or "")
+
+    def estimate_wait(self, prompt: str, uploaded_files: Optional[List] = None) -> float:
+        return 0.0
+
+    def usage_summary(self) -> Optional[dict]:
+        usage = self.last_usage
+        if usage is None:
+            return None
+        return {
+            "prompt": usage["input"],
+            "cached": usage["cached"],
+            "fresh": usage["input"] - usage["cached"],
+            "output": usage["output"],
+            "thinking": usage["thinking"],
+        }
+
+    def preflight_tokens(self, files: List[Tuple[str, Any]], prompts: List[str]) -> dict:
+        """以字數估算，格式與 GeminiChatSession.preflight_tokens 相同。"""
+        file_tokens = sum(os.path.getsize(path) for path, _ in files if os.path.exists(path))
+        estimated_input = 0
+        sent = 0
+        for prompt in prompts:
+            sent += len(prompt)
+            estimated_input += file_tokens + sent
+        return {
+            "system": 0,
+            "files": file_tokens,
+            "prompts": sent,
+            "estimated_input": estimated_input,
+        }
+
+    @property
+    def history(self) -> List[Dict]:
+        return list(self._history)
+
+    def serialize_history(self) -> List[dict]:
+        return [
+            {"role": message["role"], "parts": [dict(part) for part in message["parts"]]}
+            for message in self._history
+        ]
+
+    @staticmethod
+    def deserialize_history(data: List[dict], uri_map: Optional[dict] = None) -> List[dict]:
+        uri_map = uri_map or {}
+        history = []
+        for message in data:
+            parts = []
+            for part in message.get("parts", []):
+                part = dict(part)
+                if part.get("type") == "file_data":
+                    part["uri"] = uri_map.get(part["uri"], part["uri"])
+                parts.append(part)
+            history.append({"role": message["role"], "parts": parts})
+        return history
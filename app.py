@@ -1,12 +1,14 @@
-import json
 from flask import (
     Flask,
     render_template,
 )
 import os
-from history import history_Blueprint
+from history import history_Blueprint, startSearchSync
 from detail import detail_Blueprint
 from backup import backup_Blueprint
+from route_catalog import route_catalog
+from client_pool import client_pool
+import metrics
 
 # 加入這行來允許 HTTP 連線 (僅限開發環境使用)
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
@@ -25,19 +27,21 @@ app.register_blueprint(history_Blueprint, url_prefix="/history")
 app.register_blueprint(detail_Blueprint, url_prefix="/detail")
 app.register_blueprint(backup_Blueprint, url_prefix="/backup")
 
+# 網頁請求計時與 Prometheus 的 /metrics
+metrics.init_app(app)
+
+# 先建立共用的 API client 並暖機連線，第一次執行時不必再等握手
+client_pool.prewarm()
+
+# 全文索引在背景補齊手動加入或刪除的檔案，搜尋時不必等待
+startSearchSync()
+
 
 @app.route("/")
 def index():
     """載入資料"""
-    data_path = "data.json"
-    try:
-        with open(data_path, "r", encoding="utf-8") as f:
-            jsondata = json.load(f)
-    except FileNotFoundError:
-        print(f"錯誤：找不到設定檔 {data_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"錯誤：{data_path} 格式不正確。")
+    jsondata = route_catalog.get_routes()
+    if jsondata is None:
         return None
 
     return render_template("index.html", jsondata=jsondata)
@@ -6,6 +6,7 @@ import os
 import json
 from datetime import datetime
 from config import Google_AI_STUDIO_BACKUP_DIR
+from search_index import search_index
 import os
 import io
 import json
@@ -229,6 +230,9 @@ def doDownload():
     except Exception as e:
         return (jsonify({"error": f"寫入檔案時發生錯誤: {str(e)}"}), 200)
 
+    # 加入全文檢索
+    search_index.index_file(dest_file_path, "backup", GoogleDriveFileNam)
+
     return (jsonify({"content": content}), 200)
 
 
@@ -0,0 +1,387 @@
+# 壓力與延遲測試
+# 以 N 個並行用戶端打網頁端點（/、/history/*），同時以 M 個用戶端反覆執行路線 (/detail/runbyid)，
+# 統計吞吐量、p50 / p99 延遲、SSE 事件間隔，並取樣伺服器行程的 RSS 與執行緒數，結果寫成 JSON 方便比較版本。
+#
+# 用法（搭配 bench/stub_server.py，不消耗真正的配額）：
+#   python bench/load_driver.py --launch --route-id <路線ID> --clients 8 --run-clients 2 --duration 60
+# 已經在跑的伺服器：
+#   python bench/load_driver.py --base-url http://127.0.0.1:5001 --server-pid 12345 --route-id <路線ID>
+# 與先前的結果比較：
+#   python bench/load_driver.py ... --compare bench/results/20250101_120000.json
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+# 路線執行送出的事件中，代表模型輸出的類型
+OUTPUT_EVENT_TYPES = ("stream", "data")
+FINAL_EVENT_TYPES = ("done", "error", "cancelled")
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 4)
+
+
+def describe(values: List[float]) -> Dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": round(max(values), 4) if values else None,
+        "mean": round(sum(values) / len(values), 4) if values else None,
+    }
+
+
+class Recorder:
+    """各端點的延遲、錯誤與 SSE 統計（多執行緒共用）。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.sse_gaps: List[float] = []
+        self.first_event: List[float] = []
+        self.first_output: List[float] = []
+        self.run_results: Dict[str, int] = {}
+
+    def add(self, name: str, seconds: float, ok: bool):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def add_run(self, first_event, first_output, gaps, final_type):
+        with self.lock:
+            if first_event is not None:
+                self.first_event.append(first_event)
+            if first_output is not None:
+                self.first_output.append(first_output)
+            self.sse_gaps.extend(gaps)
+            self.run_results[final_type] = self.run_results.get(final_type, 0) + 1
+
+
+class ProcessSampler(threading.Thread):
+    """每隔 interval 秒讀取 /proc/<pid>/status 的 VmRSS 與 Threads（僅 Linux）。"""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.rss_mb: List[float] = []
+        self.threads: List[int] = []
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/status", "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        self.rss_mb.append(int(line.split()[1]) / 1024)
+                    elif line.startswith("Threads:"):
+                        self.threads.append(int(line.split()[1]))
+        except OSError:
+            pass
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self) -> Dict:
+        self._stop_event.set()
+        self.join()
+        return {
+            "pid": self.pid,
+            "rss_mb": describe(self.rss_mb),
+            "threads": describe([float(count) for count in self.threads]),
+        }
+
+
+def request(base_url: str, method: str, path: str, body: Optional[Dict] = None, timeout: float = 30):
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    req = urllib.request.Request(
+        base_url + path,
+        data=data,
+        method=method,
+        headers={"Content-Type": "application/json"} if data else {},
+    )
+    return urllib.request.urlopen(req, timeout=timeout)
+
+
+def timed(recorder: Recorder, name: str, base_url: str, method: str, path: str, body=None):
+    started = time.perf_counter()
+    ok = True
+    payload = None
+    try:
+        with request(base_url, method, path, body) as response:
+            payload = response.read()
+    except (urllib.error.URLError, OSError) as e:
+        ok = False
+        payload = str(e).encode("utf-8")
+    recorder.add(name, time.perf_counter() - started, ok)
+    return ok, payload
+
+
+def web_scenarios(args, first_filename: Optional[str]):
+    """網頁用戶端依序輪流打的端點。"""
+    scenarios = [("index", "GET", "/", None), ("history_page", "GET", "/history/", None)]
+    if args.route_id:
+        scenarios.append(("history_list", "POST", "/history/getHistoryFileList", {"id": args.route_id}))
+        scenarios.append(
+            ("history_page", "POST", "/history/getHistoryFileList", {"id": args.route_id, "limit": 20})
+        )
+        if first_filename:
+            scenarios.append(
+                (
+                    "history_content",
+                    "POST",
+                    "/history/getTxtContent",
+                    {"id": args.route_id, "filename": first_filename},
+                )
+            )
+    return scenarios
+
+
+def web_client(args, recorder: Recorder, deadline: float, scenarios):
+    index = 0
+    while time.monotonic() < deadline:
+        name, method, path, body = scenarios[index % len(scenarios)]
+        timed(recorder, name, args.base_url, method, path, body)
+        index += 1
+
+
+def run_once(args, recorder: Recorder, client_id: int, run_no: int):
+    """執行一次路線並讀完 SSE，記錄首個事件、首個輸出與事件間隔。"""
+    body = {
+        "id": args.route_id,
+        "model": args.model,
+        "runMode": args.run_mode,
+        "token": f"bench_{client_id}_{run_no}",
+    }
+    started = time.perf_counter()
+    first_event = first_output = None
+    last_event_at = None
+    gaps = []
+    final_type = "disconnected"
+    try:
+        with request(args.base_url, "POST", "/detail/runbyid", body, timeout=args.run_timeout) as response:
+            for raw in response:
+                line = raw.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                now = time.perf_counter()
+                if first_event is None:
+                    first_event = now - started
+                if last_event_at is not None:
+                    gaps.append(now - last_event_at)
+                last_event_at = now
+                event = json.loads(line[len("data:"):])
+                if first_output is None and event.get("type") in OUTPUT_EVENT_TYPES:
+                    first_output = now - started
+                if event.get("type") in FINAL_EVENT_TYPES:
+                    final_type = event["type"]
+                    break
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        print(f"路線執行失敗（用戶端 {client_id}）：{e}")
+    recorder.add("runbyid", time.perf_counter() - started, final_type == "done")
+    recorder.add_run(first_event, first_output, gaps, final_type)
+
+
+def run_client(args, recorder: Recorder, deadline: float, client_id: int):
+    run_no = 0
+    while time.monotonic() < deadline and (not args.runs or run_no < args.runs):
+        run_once(args, recorder, client_id, run_no)
+        run_no += 1
+
+
+def wait_for(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=2).close()
+            return True
+        except urllib.error.HTTPError:
+            return True
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.3)
+    return False
+
+
+def launch(args) -> List[subprocess.Popen]:
+    """啟動假 LLM 伺服器與 app（非 debug 模式、單一行程，方便取樣 RSS）。"""
+    stub = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "stub_server.py"), "--port", str(args.stub_port)]
+        + args.stub_args.split(),
+        cwd=REPO_DIR,
+    )
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    env = dict(os.environ)
+    env.setdefault("GOOGLE_API_KEY", "stub-key")
+    env["GEMINI_BASE_URL"] = stub_url
+    env["OPENAI_BASE_URL"] = stub_url + "/v1"
+    env["GROK_BASE_URL"] = stub_url + "/v1"
+    # 測試時不受免費方案的速率限制影響
+    env.setdefault("JOB_MAX_WORKERS", str(max(2, args.run_clients)))
+    port = args.base_url.rsplit(":", 1)[-1].strip("/")
+    app = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)",
+        ],
+        cwd=REPO_DIR,
+        env=env,
+    )
+    if not wait_for(stub_url + "/stub/stats") or not wait_for(args.base_url + "/"):
+        for process in (app, stub):
+            process.terminate()
+        raise SystemExit("啟動測試用伺服器逾時")
+    args.server_pid = app.pid
+    return [app, stub]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def first_history_file(args) -> Optional[str]:
+    if not args.route_id:
+        return None
+    try:
+        with request(args.base_url, "POST", "/history/getHistoryFileList", {"id": args.route_id}) as response:
+            files = json.loads(response.read())
+    except (urllib.error.URLError, OSError, ValueError):
+        return None
+    complete = [item["filename"] for item in files if not item.get("incomplete")]
+    return complete[0] if complete else None
+
+
+def compare(current: Dict, previous_path: str):
+    """印出與先前結果的 p50 / p99 差異。"""
+    with open(previous_path, "r", encoding="utf-8") as f:
+        previous = json.load(f)
+    print(f"\n與 {previous_path}（{previous['meta'].get('commit')}）比較：")
+    for name, stats in current["endpoints"].items():
+        old = previous.get("endpoints", {}).get(name)
+        if not old:
+            continue
+        for key in ("p50", "p99", "throughput_rps"):
+            if stats.get(key) is None or old.get(key) is None:
+                continue
+            change = (stats[key] - old[key]) / old[key] * 100 if old[key] else 0
+            print(f"  {name:16s} {key:15s} {old[key]:>10} -> {stats[key]:>10} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="網頁與路線執行的壓力 / 延遲測試")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5001")
+    parser.add_argument("--clients", type=int, default=4, help="網頁端點的並行用戶端數")
+    parser.add_argument("--run-clients", type=int, default=1, help="反覆執行路線的並行用戶端數（需要 --route-id）")
+    parser.add_argument("--duration", type=float, default=30, help="測試秒數")
+    parser.add_argument("--runs", type=int, default=0, help="每個路線用戶端最多執行幾次，0 為不限")
+    parser.add_argument("--route-id", help="要執行與查詢歷史的路線 ID")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--run-mode", default="stream", help='"stream" 或 ""（一般模式）')
+    parser.add_argument("--run-timeout", type=float, default=600)
+    parser.add_argument("--server-pid", type=int, help="要取樣 RSS 與執行緒數的伺服器 PID")
+    parser.add_argument("--launch", action="store_true", help="自動啟動假 LLM 伺服器與 app")
+    parser.add_argument("--stub-port", type=int, default=8090)
+    parser.add_argument("--stub-args", default="", help='傳給 stub_server.py 的參數，例如 "--ttft 1 --rate-429 0.05"')
+    parser.add_argument("--output", help="結果 JSON 路徑，預設為 bench/results/<時間>.json")
+    parser.add_argument("--compare", help="要比較的先前結果 JSON")
+    args = parser.parse_args()
+
+    processes = launch(args) if args.launch else []
+    try:
+        recorder = Recorder()
+        sampler = ProcessSampler(args.server_pid) if args.server_pid else None
+        if sampler:
+            sampler.start()
+
+        scenarios = web_scenarios(args, first_history_file(args))
+        started = time.monotonic()
+        deadline = started + args.duration
+        threads = [
+            threading.Thread(target=web_client, args=(args, recorder, deadline, scenarios), daemon=True)
+            for _ in range(args.clients)
+        ]
+        if args.route_id:
+            threads += [
+                threading.Thread(target=run_client, args=(args, recorder, deadline, i), daemon=True)
+                for i in range(args.run_clients)
+            ]
+        print(f"開始測試：網頁用戶端 {args.clients}、路線用戶端 {args.run_clients if args.route_id else 0}，{args.duration} 秒")
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        endpoints = {}
+        for name, values in recorder.latencies.items():
+            stats = describe(values)
+            stats["errors"] = recorder.errors.get(name, 0)
+            stats["throughput_rps"] = round(len(values) / elapsed, 3)
+            endpoints[name] = stats
+
+        result = {
+            "meta": {
+                "commit": git_commit(),
+                "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "elapsed": round(elapsed, 2),
+                "python": platform.python_version(),
+                "args": {key: value for key, value in vars(args).items() if key != "compare"},
+            },
+            "endpoints": endpoints,
+            "sse": {
+                "first_event": describe(recorder.first_event),
+                "first_output": describe(recorder.first_output),
+                "inter_event_gap": describe(recorder.sse_gaps),
+                "results": recorder.run_results,
+            },
+            "process": sampler.stop() if sampler else None,
+        }
+    finally:
+        for process in processes:
+            process.terminate()
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    for name, stats in endpoints.items():
+        print(
+            f"{name:16s} {stats['count']:6d} 次  {stats['throughput_rps']:8.2f} rps  "
+            f"p50 {stats['p50']}s  p99 {stats['p99']}s  錯誤 {stats['errors']}"
+        )
+    print(f"結果已儲存至: {output}")
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+# 壓力測試用的假 LLM 伺服器
+# 模擬 Gemini (google-genai) 與 OpenAI 相容 (ChatGPT / Grok) 的 API，不消耗真正的配額。
+# 可調整首個片段延遲、輸出速度、回應長度，以及注入錯誤、串流中斷與 429。
+#
+# 用法：
+#   python bench/stub_server.py --port 8090 --ttft 0.5 --tps 80 --tokens 400 --rate-429 0.05
+# 讓 app 連到這裡：
+#   GEMINI_BASE_URL=http://127.0.0.1:8090 OPENAI_BASE_URL=http://127.0.0.1:8090/v1 GROK_BASE_URL=http://127.0.0.1:8090/v1
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+FILLER = "她推開門，雨聲一下子灌進屋裡，他抬起頭，兩人就這樣對望了很久。"
+# 每個串流片段包含的 token 數
+CHUNK_TOKENS = 8
+
+
+class StubConfig:
+    def __init__(self, args):
+        self.ttft = args.ttft
+        self.tps = args.tps
+        self.tokens = args.tokens
+        self.error_rate = args.error_rate
+        self.rate_429 = args.rate_429
+        self.midstream_error_rate = args.midstream_error_rate
+        self.retry_delay = args.retry_delay
+        self.file_processing = args.file_processing
+
+
+class StubState:
+    """上傳的檔案與呼叫次數（給 /stub/stats 查看）。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.counts = {}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+def _now_iso(offset: float = 0) -> str:
+    moment = datetime.now(timezone.utc) + timedelta(seconds=offset)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _response_text(tokens: int) -> str:
+    # 中文約一字一 token
+    return (FILLER * (tokens // len(FILLER) + 1))[:tokens]
+
+
+def _estimate_tokens(body: bytes) -> int:
+    return max(1, len(body.decode("utf-8", errors="ignore")) // 2)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: StubConfig = None
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    # --- 共用輸出 ---
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status: int, obj, headers=None):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_chunked(self, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, text: str):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _abort_stream(self):
+        """模擬串流中途斷線。"""
+        self.close_connection = True
+        self.wfile.flush()
+
+    def _injected_error(self, provider: str) -> bool:
+        """依設定的機率回傳 429 或 500；有回傳錯誤時回傳 True。"""
+        roll = random.random()
+        if roll < self.config.rate_429:
+            self.state.count("429")
+            if provider == "gemini":
+                self._send_json(
+                    429,
+                    {
+                        "error": {
+                            "code": 429,
+                            "message": "Resource has been exhausted (stub).",
+                            "status": "RESOURCE_EXHAUSTED",
+                            "details": [
+                                {
+                                    "@type": "type.googleapis.com/google.rpc.RetryInfo",
+                                    "retryDelay": f"{self.config.retry_delay}s",
+                                }
+                            ],
+                        }
+                    },
+                )
+            else:
+                self._send_json(
+                    429,
+                    {"error": {"message": "Rate limit reached (stub).", "type": "rate_limit_error"}},
+                    headers={"Retry-After": str(self.config.retry_delay)},
+                )
+            return True
+        if roll < self.config.rate_429 + self.config.error_rate:
+            self.state.count("500")
+            self._send_json(
+                500,
+                {"error": {"code": 500, "message": "Internal error (stub).", "status": "INTERNAL"}},
+            )
+            return True
+        return False
+
+    def _chunks(self):
+        """依 ttft / tps 的節奏產生回應片段。"""
+        text = _response_text(self.config.tokens)
+        time.sleep(self.config.ttft)
+        interval = CHUNK_TOKENS / self.config.tps if self.config.tps > 0 else 0
+        for start in range(0, len(text), CHUNK_TOKENS):
+            yield text[start : start + CHUNK_TOKENS]
+            if interval:
+                time.sleep(interval)
+
+    def _midstream_failure(self) -> bool:
+        return random.random() < self.config.midstream_error_rate
+
+    # --- 路由 ---
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/stub/stats":
+            with self.state.lock:
+                return self._send_json(200, {"counts": dict(self.state.counts), "files": len(self.state.files)})
+        if re.fullmatch(r"/v1beta/models", path):
+            return self._send_json(200, {"models": [{"name": "models/gemini-2.5-flash"}]})
+        match = re.fullmatch(r"/v1beta/(files/[^/]+)", path)
+        if match:
+            return self._gemini_get_file(match.group(1))
+        if path == "/v1/models":
+            return self._send_json(200, {"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model"}]})
+        self._send_json(404, {"error": {"message": f"stub: unknown path {path}"}})
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        path = parsed.path
+        body = self._read_body()
+
+        match = re.fullmatch(r"/v1beta/models/([^/:]+):(\w+)", path)
+        if match:
+            model, method = match.groups()
+            self.state.count(f"gemini:{method}")
+            if method == "streamGenerateContent":
+                return self._gemini_stream(model, body)
+            if method == "generateContent":
+                return self._gemini_generate(model, body)
+            if method == "countTokens":
+                return self._send_json(200, {"totalTokens": _estimate_tokens(body)})
+        if path == "/v1beta/cachedContents":
+            self.state.count("gemini:cachedContents")
+            request_body = json.loads(body or b"{}")
+            return self._send_json(
+                200,
+                {
+                    "name": f"cachedContents/{uuid.uuid4().hex[:12]}",
+                    "model": request_body.get("model"),
+                    "createTime": _now_iso(),
+                    "expireTime": _now_iso(3600),
+                    "usageMetadata": {"totalTokenCount": _estimate_tokens(body)},
+                },
+            )
+        if path == "/upload/v1beta/files":
+            return self._gemini_upload_start(body)
+        match = re.fullmatch(r"/upload/v1beta/files/([^/]+)", path)
+        if match:
+            return self._gemini_upload_finalize(match.group(1), body)
+        if path == "/v1/chat/completions":
+            self.state.count("openai:chat")
+            return self._openai_chat(json.loads(body or b"{}"))
+        self._send_json(404, {"error": {"message": f"stub: unknown path {path}"}})
+
+    # --- Gemini ---
+    def _gemini_usage(self, body: bytes, output_tokens: int) -> dict:
+        prompt_tokens = _estimate_tokens(body)
+        return {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        }
+
+    def _gemini_chunk(self, text: str, finish: bool = False, usage: dict = None) -> dict:
+        candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+        if finish:
+            candidate["finishReason"] = "STOP"
+        chunk = {"candidates": [candidate], "modelVersion": "stub"}
+        if usage:
+            chunk["usageMetadata"] = usage
+        return chunk
+
+    def _gemini_generate(self, model: str, body: bytes):
+        if self._injected_error("gemini"):
+            return
+        text = "".join(self._chunks())
+        self._send_json(200, self._gemini_chunk(text, True, self._gemini_usage(body, len(text))))
+
+    def _gemini_stream(self, model: str, body: bytes):
+        if self._injected_error("gemini"):
+            return
+        fail = self._midstream_failure()
+        self._start_chunked("text/event-stream")
+        sent = 0
+        for index, piece in enumerate(self._chunks()):
+            if fail and index == 3:
+                self.state.count("midstream_abort")
+                return self._abort_stream()
+            sent += len(piece)
+            self._write_chunk(f"data: {json.dumps(self._gemini_chunk(piece), ensure_ascii=False)}\r\n\r\n")
+        final = self._gemini_chunk("", True, self._gemini_usage(body, sent))
+        self._write_chunk(f"data: {json.dumps(final, ensure_ascii=False)}\r\n\r\n")
+        self._end_chunked()
+
+    def _file_resource(self, file_id: str) -> dict:
+        with self.state.lock:
+            info = self.state.files[file_id]
+        ready = time.monotonic() - info["uploaded"] >= self.config.file_processing
+        host = self.headers.get("Host", "127.0.0.1")
+        return {
+            "name": f"files/{file_id}",
+            "displayName": info["display_name"],
+            "mimeType": info["mime_type"],
+            "sizeBytes": str(info["size"]),
+            "createTime": info["create_time"],
+            "expirationTime": _now_iso(48 * 3600),
+            "uri": f"http://{host}/v1beta/files/{file_id}",
+            "state": "ACTIVE" if ready else "PROCESSING",
+        }
+
+    def _gemini_upload_start(self, body: bytes):
+        """可續傳上傳的第一步：回傳上傳網址。"""
+        self.state.count("gemini:upload")
+        metadata = json.loads(body or b"{}").get("file", {})
+        file_id = uuid.uuid4().hex[:12]
+        with self.state.lock:
+            self.state.files[file_id] = {
+                "display_name": metadata.get("displayName", file_id),
+                "mime_type": self.headers.get("X-Goog-Upload-Header-Content-Type", "text/plain"),
+                "size": 0,
+                "uploaded": None,
+                "create_time": _now_iso(),
+            }
+        host = self.headers.get("Host", "127.0.0.1")
+        self.send_response(200)
+        self.send_header("X-Goog-Upload-URL", f"http://{host}/upload/v1beta/files/{file_id}")
+        self.send_header("X-Goog-Upload-Status", "active")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _gemini_upload_finalize(self, file_id: str, body: bytes):
+        with self.state.lock:
+            info = self.state.files.get(file_id)
+            if info is not None:
+                info["size"] += len(body)
+                info["uploaded"] = time.monotonic()
+        if info is None:
+            return self._send_json(404, {"error": {"code": 404, "message": "file not found", "status": "NOT_FOUND"}})
+        self._send_json(200, {"file": self._file_resource(file_id)}, headers={"X-Goog-Upload-Status": "final"})
+
+    def _gemini_get_file(self, name: str):
+        file_id = name.split("/", 1)[1]
+        with self.state.lock:
+            exists = file_id in self.state.files
+        if not exists:
+            return self._send_json(404, {"error": {"code": 404, "message": "file not found", "status": "NOT_FOUND"}})
+        self._send_json(200, self._file_resource(file_id))
+
+    # --- OpenAI 相容 ---
+    def _openai_usage(self, request_body: dict, output_tokens: int) -> dict:
+        prompt_tokens = _estimate_tokens(json.dumps(request_body, ensure_ascii=False).encode("utf-8"))
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": output_tokens,
+            "total_tokens": prompt_tokens + output_tokens,
+        }
+
+    def _openai_chat(self, request_body: dict):
+        if self._injected_error("openai"):
+            return
+        model = request_body.get("model", "stub")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        if not request_body.get("stream"):
+            text = "".join(self._chunks())
+            return self._send_json(
+                200,
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                    ],
+                    "usage": self._openai_usage(request_body, len(text)),
+                },
+            )
+
+        def event(choices, usage=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+            }
+            if usage is not None:
+                chunk["usage"] = usage
+            return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+        fail = self._midstream_failure()
+        self._start_chunked("text/event-stream")
+        sent = 0
+        for index, piece in enumerate(self._chunks()):
+            if fail and index == 3:
+                self.state.count("midstream_abort")
+                return self._abort_stream()
+            sent += len(piece)
+            self._write_chunk(
+                event([{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}])
+            )
+        self._write_chunk(event([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (request_body.get("stream_options") or {}).get("include_usage"):
+            self._write_chunk(event([], self._openai_usage(request_body, sent)))
+        self._write_chunk("data: [DONE]\n\n")
+        self._end_chunked()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="壓力測試用的假 Gemini / OpenAI 伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--ttft", type=float, default=0.5, help="首個片段前的延遲秒數")
+    parser.add_argument("--tps", type=float, default=80, help="每秒輸出的 token 數，0 為不限速")
+    parser.add_argument("--tokens", type=int, default=400, help="每則回應的 token 數")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回傳 500 的機率")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="回傳 429 的機率")
+    parser.add_argument("--midstream-error-rate", type=float, default=0.0, help="串流中途斷線的機率")
+    parser.add_argument("--retry-delay", type=int, default=1, help="429 建議的重試秒數")
+    parser.add_argument("--file-processing", type=float, default=1.0, help="上傳後維持 PROCESSING 的秒數")
+    args = parser.parse_args()
+
+    StubHandler.config = StubConfig(args)
+    StubHandler.state = StubState()
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    print(f"假 LLM 伺服器已啟動：http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
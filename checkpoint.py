@@ -0,0 +1,257 @@
+# 路線執行的檢查點
+# 每完成一個指令就記錄：下一個要執行的指令位置、已完成回應在回應檔中的長度、
+# 序列化的對話歷史與檔案 URI。
+# 執行中斷（配額、PROHIBITED_CONTENT、網路）後，可以從檢查點重建 GeminiChatSession，
+# 從失敗的指令接著跑，不必把前面已經有的回應重新生成一次。
+# 檔案位置：<路線資料夾>/checkpoints/
+#   <檢查點編號>.json            檢查點本身（不含歷史，每次整份改寫，內容很小）
+#   <檢查點編號>.history.jsonl   對話歷史，一行一則訊息，每個指令完成後只附加新的訊息
+#   index.json                  各檢查點的狀態摘要，詳細頁只讀這個檔，不必載入歷史
+# 標記為 done / resumed 的檢查點不會再被接續，直接刪除。
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from file_registry import ManifestLock
+
+CHECKPOINT_DIR = "checkpoints"
+INDEX_NAME = "index.json"
+HISTORY_SUFFIX = ".history.jsonl"
+
+RUNNING = "running"
+FAILED = "failed"
+DONE = "done"
+RESUMED = "resumed"
+# 可以接續的狀態；running 代表行程在執行中當掉，同樣可以接續
+# （執行在背景工作中仍在進行時不算，由 latest_resumable 的 in_use 判斷）
+RESUMABLE_STATES = (RUNNING, FAILED)
+# 不會再被接續的狀態，標記後就刪除
+FINISHED_STATES = (DONE, RESUMED)
+
+
+def _message_hash(message: Dict) -> str:
+    return hashlib.sha1(
+        json.dumps(message, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def summary(checkpoint: Dict) -> Dict:
+    """給前端顯示用的摘要（不含回應與歷史內容），也是 index.json 中每個項目的內容。"""
+    return {
+        "id": checkpoint["id"],
+        "job_id": checkpoint.get("job_id"),
+        "status": checkpoint.get("status"),
+        "model": checkpoint.get("model"),
+        "next_index": checkpoint.get("next_index"),
+        "completed": checkpoint.get("completed", 0),
+        "updated_at": checkpoint.get("updated_at"),
+    }
+
+
+class CheckpointStore:
+    """
+    檢查點本身與索引都先寫暫存檔再原子地取代；歷史以附加的方式寫入。
+    多個 worker 以 checkpoints/index.json.lock 檔案鎖共用索引。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (路線資料夾, 檢查點編號) -> 已寫入歷史的 {"count", "first", "last"}（首尾訊息的雜湊）
+        self._written: Dict[tuple, Dict] = {}
+
+    def _dir(self, route_dir: str) -> str:
+        return os.path.join(route_dir, CHECKPOINT_DIR)
+
+    def _path(self, route_dir: str, checkpoint_id: str) -> str:
+        return os.path.join(self._dir(route_dir), f"{checkpoint_id}.json")
+
+    def _history_path(self, route_dir: str, checkpoint_id: str) -> str:
+        return os.path.join(self._dir(route_dir), f"{checkpoint_id}{HISTORY_SUFFIX}")
+
+    def _index_path(self, route_dir: str) -> str:
+        return os.path.join(self._dir(route_dir), INDEX_NAME)
+
+    def _write_json(self, path: str, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    # --- 歷史 ---
+    def _write_history(self, route_dir: str, checkpoint: Dict, history: List[Dict]):
+        """
+        只附加上次寫入之後新增的訊息；歷史被整理過（開頭或已寫入的最後一則不同）時才整份重寫。
+        """
+        key = (route_dir, checkpoint["id"])
+        path = self._history_path(route_dir, checkpoint["id"])
+        written = self._written.get(key)
+        count = written["count"] if written else 0
+        appendable = (
+            written is not None
+            and os.path.exists(path)
+            and len(history) >= count
+            and (count == 0 or (
+                _message_hash(history[0]) == written["first"]
+                and _message_hash(history[count - 1]) == written["last"]
+            ))
+        )
+        if appendable:
+            new_messages = history[count:]
+            mode = "a"
+        else:
+            new_messages = history
+            mode = "w"
+        with open(path, mode, encoding="utf-8") as f:
+            for message in new_messages:
+                f.write(json.dumps(message, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._written[key] = {
+            "count": len(history),
+            "first": _message_hash(history[0]) if history else None,
+            "last": _message_hash(history[-1]) if history else None,
+        }
+        # 檢查點記錄的歷史則數為準，之後附加到一半當掉時多出的行會被忽略
+        checkpoint["history_count"] = len(history)
+
+    def _read_history(self, route_dir: str, checkpoint: Dict) -> List[Dict]:
+        path = self._history_path(route_dir, checkpoint["id"])
+        count = checkpoint.get("history_count", 0)
+        history = []
+        if count and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if len(history) >= count:
+                        break
+                    history.append(json.loads(line))
+        return history
+
+    # --- 索引 ---
+    def _read_index(self, route_dir: str) -> Dict[str, Dict]:
+        path = self._index_path(route_dir)
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"讀取檢查點索引 {path} 失敗，將重新建立：{e}")
+        return self._rebuild_index(route_dir)
+
+    def _rebuild_index(self, route_dir: str) -> Dict[str, Dict]:
+        """從各檢查點檔重建索引（索引遺失或由舊版本升級時）。"""
+        index = {}
+        checkpoint_dir = self._dir(route_dir)
+        if not os.path.isdir(checkpoint_dir):
+            return index
+        for fname in os.listdir(checkpoint_dir):
+            if fname.endswith(".json") and fname != INDEX_NAME:
+                checkpoint = self._load_header(route_dir, fname[: -len(".json")])
+                if checkpoint is not None:
+                    index[checkpoint["id"]] = summary(checkpoint)
+        return index
+
+    def _update_index(self, route_dir: str, checkpoint: Dict, remove: bool = False):
+        with ManifestLock(self._index_path(route_dir) + ".lock"):
+            index = self._read_index(route_dir)
+            if remove:
+                index.pop(checkpoint["id"], None)
+            else:
+                index[checkpoint["id"]] = summary(checkpoint)
+            self._write_json(self._index_path(route_dir), index)
+
+    # --- 對外介面 ---
+    def save(self, route_dir: str, checkpoint: Dict, history: Optional[List[Dict]] = None):
+        """更新檢查點；有傳入 history 時一併寫入（只附加新的訊息）。"""
+        checkpoint["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        os.makedirs(self._dir(route_dir), exist_ok=True)
+        with self._lock:
+            if history is not None:
+                self._write_history(route_dir, checkpoint, history)
+            header = {k: v for k, v in checkpoint.items() if k != "history"}
+            self._write_json(self._path(route_dir, checkpoint["id"]), header)
+        self._update_index(route_dir, checkpoint)
+
+    def _load_header(self, route_dir: str, checkpoint_id: str) -> Optional[Dict]:
+        path = self._path(route_dir, os.path.basename(checkpoint_id))
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"讀取檢查點 {path} 失敗：{e}")
+            return None
+
+    def load(self, route_dir: str, checkpoint_id: str) -> Optional[Dict]:
+        """讀取完整的檢查點（含歷史），接續執行時使用。"""
+        checkpoint = self._load_header(route_dir, checkpoint_id)
+        if checkpoint is None:
+            return None
+        # 舊版本的檢查點把歷史直接存在檔案內
+        if "history" not in checkpoint:
+            try:
+                checkpoint["history"] = self._read_history(route_dir, checkpoint)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"讀取檢查點歷史失敗：{e}")
+                return None
+        return checkpoint
+
+    def list_checkpoints(self, route_dir: str) -> List[Dict]:
+        """回傳路線所有檢查點的摘要（新到舊），只讀取索引。"""
+        if not os.path.isdir(self._dir(route_dir)):
+            return []
+        with ManifestLock(self._index_path(route_dir) + ".lock"):
+            index_missing = not os.path.exists(self._index_path(route_dir))
+            index = self._read_index(route_dir)
+            if index_missing:
+                self._write_json(self._index_path(route_dir), index)
+        return sorted(index.values(), key=lambda c: c.get("updated_at") or "", reverse=True)
+
+    def latest_resumable(
+        self, route_dir: str, in_use: Optional[Callable[[Dict], bool]] = None
+    ) -> Optional[Dict]:
+        """
+        最近一個可以接續、且至少完成一個指令的檢查點摘要。
+        in_use 判斷檢查點所屬的執行是否仍在進行，仍在進行的 running 檢查點不能接續。
+        """
+        for checkpoint in self.list_checkpoints(route_dir):
+            if checkpoint.get("status") not in RESUMABLE_STATES or not checkpoint.get("completed"):
+                continue
+            if checkpoint.get("status") == RUNNING and in_use is not None and in_use(checkpoint):
+                continue
+            return checkpoint
+        return None
+
+    def mark(self, route_dir: str, checkpoint: Dict, status: str):
+        checkpoint["status"] = status
+        if status in FINISHED_STATES:
+            self.delete(route_dir, checkpoint)
+            return
+        self.save(route_dir, checkpoint)
+        if status != RUNNING:
+            # 執行已結束，不會再附加歷史
+            with self._lock:
+                self._written.pop((route_dir, checkpoint["id"]), None)
+
+    def delete(self, route_dir: str, checkpoint: Dict):
+        """刪除檢查點與它的歷史，並從索引移除。"""
+        with self._lock:
+            self._written.pop((route_dir, checkpoint["id"]), None)
+            for path in (
+                self._path(route_dir, checkpoint["id"]),
+                self._history_path(route_dir, checkpoint["id"]),
+            ):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        self._update_index(route_dir, checkpoint, remove=True)
+
+
+# 全域共用的實例
+checkpoint_store = CheckpointStore()
@@ -0,0 +1,108 @@
+# 行程內共用的 API client
+# 每個 ChatSession 都自己建立 genai.Client / OpenAI 會各自開一組 HTTP 連線池，
+# 每次執行的第一個請求都要重新做 TCP + TLS 握手。這裡依「供應商 + API 金鑰 + base_url」
+# 共用同一個 client，保留 keep-alive 連線，並可在 app 啟動時先行暖機。
+# 只共用同步 client；非同步 client 的連線綁在建立它的事件迴圈上，迴圈關閉後就不能再用，
+# 因此每次都建立新的，由各個 session 自己持有。
+# base_url 可用環境變數覆蓋（GEMINI_BASE_URL、OPENAI_BASE_URL、GROK_BASE_URL），方便接到測試用的伺服器。
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+GROK_BASE_URL = "https://api.x.ai/v1"
+
+
+class ClientPool:
+    """
+    以 (供應商, API 金鑰, base_url) 為鍵的同步 client 登錄表。
+    """
+
+    def __init__(self):
+        self._clients: Dict[Tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key: Tuple, factory):
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = factory()
+                self._clients[key] = client
+            return client
+
+    def _gemini_factory(self, api_key: Optional[str], base_url: Optional[str]):
+        from google import genai
+        from google.genai import types
+
+        api_key = api_key or os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
+        base_url = base_url or os.getenv("GEMINI_BASE_URL")
+
+        def factory():
+            http_options = types.HttpOptions(base_url=base_url) if base_url else None
+            return genai.Client(api_key=api_key, http_options=http_options)
+
+        return ("gemini", api_key, base_url), factory
+
+    def gemini(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        """共用的 google.genai Client（同步呼叫用）。"""
+        key, factory = self._gemini_factory(api_key, base_url)
+        return self._get(key, factory)
+
+    def gemini_async(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        """新建的 google.genai 非同步 client（Client.aio），不共用。"""
+        _, factory = self._gemini_factory(api_key, base_url)
+        return factory().aio
+
+    def openai(
+        self,
+        api_key: str,
+        base_url: Optional[str] = None,
+        provider: str = "openai",
+        is_async: bool = False,
+    ):
+        """
+        共用的 OpenAI client（Grok 也是走 OpenAI 相容介面）；is_async 時回傳新建的 AsyncOpenAI，不共用。
+        """
+        from openai import AsyncOpenAI, OpenAI
+
+        if base_url is None:
+            if provider == "grok":
+                base_url = os.getenv("GROK_BASE_URL", GROK_BASE_URL)
+            else:
+                base_url = os.getenv("OPENAI_BASE_URL")
+
+        if is_async:
+            return AsyncOpenAI(api_key=api_key, base_url=base_url)
+        return self._get((provider, api_key, base_url), lambda: OpenAI(api_key=api_key, base_url=base_url))
+
+    def prewarm(self, background: bool = True):
+        """
+        先建立 client 並送出一個輕量請求，讓連線在第一次執行前就準備好。
+        只暖機有設定金鑰的供應商；失敗只印出訊息，不影響啟動。
+        """
+
+        def warm():
+            if os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY"):
+                try:
+                    client = self.gemini()
+                    next(iter(client.models.list(config={"page_size": 1})), None)
+                    print("Gemini client 已完成暖機。")
+                except Exception as e:
+                    print(f"Gemini client 暖機失敗：{e}")
+            for provider, env_name in (("openai", "OPENAI_API_KEY"), ("grok", "XAI_API_KEY")):
+                api_key = os.getenv(env_name)
+                if not api_key:
+                    continue
+                try:
+                    self.openai(api_key, provider=provider).models.list()
+                    print(f"{provider} client 已完成暖機。")
+                except Exception as e:
+                    print(f"{provider} client 暖機失敗：{e}")
+
+        if background:
+            threading.Thread(target=warm, name="client-prewarm", daemon=True).start()
+        else:
+            warm()
+
+
+# 全域共用的實例
+client_pool = ClientPool()
@@ -0,0 +1,114 @@
+# Gemini 顯式快取 (cached contents) 的登錄表
+# 以「模型 + 系統指令雜湊 + 來源檔案雜湊」為鍵，記錄已建立的快取名稱與到期時間，
+# 同一條路線重跑時可以直接沿用，不必每次都重新付費送出整本小說。
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from file_registry import ManifestLock
+
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), "context_caches.json")
+# 新建快取的存活秒數
+CACHE_TTL = 3600
+# 距離到期不足這個時間的快取就不再沿用
+EXPIRY_MARGIN = timedelta(minutes=10)
+# 送出時回傳這些狀態代表快取在遠端已失效（提前過期或被刪除），需改回直接附加檔案
+CACHE_LOST_STATUS = ("NOT_FOUND", "PERMISSION_DENIED")
+# 各模型建立顯式快取所需的最少 token 數
+MIN_CACHE_TOKENS = {
+    "flash": 1024,
+    "pro": 4096,
+}
+DEFAULT_MIN_CACHE_TOKENS = 4096
+
+
+def min_cache_tokens(model_name: str) -> int:
+    """依模型名稱取得建立快取的最低 token 數。"""
+    for keyword, tokens in MIN_CACHE_TOKENS.items():
+        if keyword in model_name:
+            return tokens
+    return DEFAULT_MIN_CACHE_TOKENS
+
+
+def cache_key(model_name: str, system_instruction: str, digests: List[bytes]) -> str:
+    """快取鍵：模型、系統指令與來源檔案（依順序）的雜湊組合。"""
+    h = hashlib.sha256()
+    h.update(model_name.encode("utf-8"))
+    h.update(hashlib.sha256(system_instruction.encode("utf-8")).digest())
+    for digest in digests:
+        h.update(digest)
+    return h.hexdigest()
+
+
+class ContextCacheRegistry:
+    """
+    本機記錄的顯式快取清單，多個 worker 以檔案鎖共用。
+    """
+
+    def __init__(self, manifest_path: str = MANIFEST_PATH):
+        self.manifest_path = manifest_path
+        self.lock_path = f"{manifest_path}.lock"
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"讀取快取清單 {self.manifest_path} 失敗，將重新建立：{e}")
+            return {}
+
+    def _save(self, manifest: Dict[str, Dict]):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def lookup(self, key: str) -> Optional[str]:
+        """回傳尚未到期的快取名稱，沒有則回傳 None。"""
+        with self._lock:
+            entry = self._load().get(key)
+        if not entry:
+            return None
+        expires_at = datetime.fromisoformat(entry["expire_time"])
+        if expires_at - EXPIRY_MARGIN <= datetime.now(timezone.utc):
+            return None
+        return entry["name"]
+
+    def register(self, key: str, name: str, expire_time: Optional[datetime], model: str):
+        if expire_time is None:
+            expire_time = datetime.now(timezone.utc) + timedelta(seconds=CACHE_TTL)
+        elif expire_time.tzinfo is None:
+            expire_time = expire_time.replace(tzinfo=timezone.utc)
+
+        with self._lock, ManifestLock(self.lock_path):
+            manifest = self._load()
+            # 順便清掉已過期的紀錄
+            now = datetime.now(timezone.utc)
+            manifest = {
+                k: v
+                for k, v in manifest.items()
+                if datetime.fromisoformat(v["expire_time"]) > now
+            }
+            manifest[key] = {
+                "name": name,
+                "model": model,
+                "expire_time": expire_time.isoformat(),
+            }
+            self._save(manifest)
+
+    def forget(self, key: str):
+        """快取在遠端已失效時移除紀錄。"""
+        with self._lock, ManifestLock(self.lock_path):
+            manifest = self._load()
+            if manifest.pop(key, None) is not None:
+                self._save(manifest)
+
+
+# 全域共用的實例
+context_cache_registry = ContextCacheRegistry()
@@ -9,6 +9,27 @@ from config import RESPONSE_FILES_DIR, RUN_DIR_PATH_three, TEMP_FOLDER
 import base64
 import mimetypes
 from GeminiChatSession import GeminiChatSession
+from ReplayChatSession import ReplayChatSession, is_replay_model, latest_recording
+from route_catalog import route_catalog
+from route_store import route_store
+from route_journal import route_journal, JournalError, EDITABLE_FIELDS
+from retry_policy import StreamReset
+from job_engine import job_engine
+from event_stream import gzip_stream, stream_v1, stream_v2
+from response_writer import PARTIAL_SUFFIX, ResponseWriter
+from token_usage import TokenBudget, hash_file, write_usage_file
+from response_cache import RESPONSE_CACHE_ENABLED, CachedChatSession
+from response_index import response_index
+from search_index import search_index
+import metrics
+from checkpoint import (
+    DONE as CHECKPOINT_DONE,
+    FAILED as CHECKPOINT_FAILED,
+    RESUMED as CHECKPOINT_RESUMED,
+    RUNNING as CHECKPOINT_RUNNING,
+    checkpoint_store,
+    summary as checkpoint_summary,
+)
 
 
 # 創建一個 Blueprint 物件
@@ -20,21 +41,8 @@ def detail():
     id = request.args.get("id")
 
     """載入資料"""
-    data_path = "data.json"
-    try:
-        with open(data_path, "r", encoding="utf-8") as f:
-            jsonarray = json.load(f)
-    except FileNotFoundError:
-        print(f"錯誤：找不到設定檔 {data_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"錯誤：{data_path} 格式不正確。")
-        return None
-
-    jsonarray = list(filter(lambda item: item["id"] == id, jsonarray))
-    if jsonarray:
-        jsondata = jsonarray[0]
-    else:
+    jsondata = route_catalog.get_route(id)
+    if jsondata is None:
         jsondata = []
 
     if isinstance(jsondata, dict):
@@ -140,18 +148,6 @@ def doSave():
     except Exception as e:
         return jsonify({"error": f"解析 JSON 失敗: {e}"}), 400
 
-    """載入資料"""
-    data_path = "data.json"
-    try:
-        with open(data_path, "r", encoding="utf-8") as f:
-            jsonarray = json.load(f)
-    except FileNotFoundError:
-        print(f"錯誤：找不到設定檔 {data_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"錯誤：{data_path} 格式不正確。")
-        return None
-
     dir = data["dir"]
     if dir:
         for item in data["prompts"]:
@@ -179,68 +175,246 @@ def doSave():
                 else:
                     print(f"錯誤: 來源檔案不存在於 {src_file_path}")
 
-    id = data["id"]
-    if not id == "":
-        for item in jsonarray:
-            if item["id"] == id:
-                item["name"] = data["name"]
-                item["dir"] = data["dir"]
-                item["prompts"] = data["prompts"]
-    else:
-        all_ids = [int(item["id"]) for item in jsonarray]
-        # 使用 max() 函式找出最大的 id
-        max_id = max(all_ids)
-        # print(f"jsonarray 中最大的 ID 是: {max_id}")
-        new_item = {}
-        new_item["id"] = str(max_id + 1)
-        new_item["name"] = data["name"]
-        new_item["dir"] = data["dir"]
-        new_item["prompts"] = data["prompts"]
-        jsonarray.append(new_item)
-
+    # 只在一個交易內更新這一條路線，id 為空時由資料庫配發新的 id
+    route = {
+        "id": data["id"],
+        "name": data["name"],
+        "dir": data["dir"],
+        "prompts": data["prompts"],
+    }
     try:
-        with open(data_path, "w", encoding="utf-8") as f:
-            json.dump(jsonarray, f, indent=2, ensure_ascii=False)
-    except FileNotFoundError:
-        print(f"錯誤：找不到設定檔 {data_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"錯誤：{data_path} 格式不正確。")
-        return None
+        # 整條路線覆蓋前，先把這條路線尚未壓縮的增量異動寫回，避免被重複套用
+        if route["id"]:
+            route_journal.compact(route["id"])
+        route_store.save_route(route)
+    except Exception as e:
+        print(f"儲存路線時發生錯誤: {e}")
+        return jsonify({"error": f"儲存失敗: {e}"}), 500
 
     # 回傳 JSON 回應給前端
     return (jsonify({"message": "檔案已成功儲存"}), 200)
 
 
+def doPromptChange(route_id, op):
+    """寫入單一 prompt 的增量異動，回傳給前端的 (response, status)。"""
+    route = route_catalog.get_route(route_id)
+    if route is None:
+        return jsonify({"error": "找不到路線"}), 404
+
+    try:
+        op = route_journal.append(route, op)
+    except JournalError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"寫入 prompt 異動時發生錯誤: {e}")
+        return jsonify({"error": f"儲存失敗: {e}"}), 500
+
+    return (jsonify({"message": "異動已儲存", "prompts": len(route["prompts"])}), 200)
+
+
+# 新增單一 prompt，body: {"prompt": {...}, "index": 選填}
+@detail_Blueprint.route("/routes/<route_id>/prompts", methods=["POST"])
+def addPrompt(route_id):
+    data = request.get_json(silent=True) or {}
+    prompt = data.get("prompt")
+    if not isinstance(prompt, dict):
+        return jsonify({"error": "缺少 prompt 內容"}), 400
+    index = data.get("index")
+    if index is not None:
+        try:
+            index = int(index)
+        except (TypeError, ValueError):
+            return jsonify({"error": "index 必須是整數"}), 400
+    return doPromptChange(route_id, {"op": "add", "index": index, "prompt": prompt})
+
+
+# 編輯單一 prompt（內容、是否送出等），body 只需帶有異動的欄位
+@detail_Blueprint.route("/routes/<route_id>/prompts/<int:index>", methods=["PATCH"])
+def editPrompt(route_id, index):
+    data = request.get_json(silent=True) or {}
+    fields = {key: data[key] for key in EDITABLE_FIELDS if key in data}
+    if not fields:
+        return jsonify({"error": "沒有可更新的欄位"}), 400
+    return doPromptChange(route_id, {"op": "edit", "index": index, "fields": fields})
+
+
+# 刪除單一 prompt
+@detail_Blueprint.route("/routes/<route_id>/prompts/<int:index>", methods=["DELETE"])
+def deletePrompt(route_id, index):
+    return doPromptChange(route_id, {"op": "delete", "index": index})
+
+
+# 調整 prompt 順序，body: {"from": 原索引, "to": 新索引}
+@detail_Blueprint.route("/routes/<route_id>/prompts/reorder", methods=["POST"])
+def reorderPrompt(route_id):
+    data = request.get_json(silent=True) or {}
+    try:
+        src, dst = int(data["from"]), int(data["to"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "缺少 from / to 索引"}), 400
+    return doPromptChange(route_id, {"op": "move", "from": src, "to": dst})
+
+
+def submitRouteJob(request_data):
+    """把路線執行交給背景工作引擎，回傳 Job。"""
+    return job_engine.submit(
+        lambda job: gemini_task_generator(request_data, job),
+        meta={
+            "provider": routeProvider(request_data.get("model")),
+            "route_id": request_data.get("id"),
+            "model": request_data.get("model"),
+            "runMode": request_data.get("runMode"),
+            "token": request_data.get("token"),
+            "resumeFrom": request_data.get("resumeFrom"),
+            "useCache": request_data.get("useCache"),
+            "forceFresh": request_data.get("forceFresh"),
+        },
+    )
+
+
+def routeProvider(model):
+    """路線執行使用的供應商：model 為 "replay" 時回放錄製的對話，其餘為 Gemini。"""
+    return "replay" if is_replay_model(model) else "gemini"
+
+
+def lastEventId():
+    """斷線重連時，瀏覽器以 Last-Event-ID 標頭（或 lastEventId 參數）告知收到的最後一筆事件。"""
+    value = request.headers.get("Last-Event-ID") or request.args.get("lastEventId")
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
 @detail_Blueprint.route("/runbyid", methods=["POST"])
 def runbyid():
-    # 使用 stream_with_context 來串流回應
+    # 舊的介面：送出工作後直接訂閱它的事件串流
+    # 連線中斷只會停止訂閱，工作本身會在背景繼續執行
+    job = submitRouteJob(request.get_json())
     return Response(
-        stream_with_context(gemini_task_generator(request.get_json())),
+        stream_with_context(stream_v1(job)),
         mimetype="text/event-stream",
+        headers={"X-Job-Id": job.id},
     )
 
 
-def gemini_task_generator(request_data):
+@detail_Blueprint.route("/jobs", methods=["POST"])
+def createJob():
+    job = submitRouteJob(request.get_json())
+    return jsonify(job.to_dict()), 202
+
+
+@detail_Blueprint.route("/jobs", methods=["GET"])
+def listJobs():
+    return jsonify([job.to_dict() for job in job_engine.list_jobs()])
+
+
+@detail_Blueprint.route("/jobs/<job_id>", methods=["GET"])
+def getJob(job_id):
+    job = job_engine.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "找不到工作"}), 404
+    return jsonify(job.to_dict())
+
+
+@detail_Blueprint.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancelJob(job_id):
+    job = job_engine.cancel(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "找不到工作"}), 404
+    return jsonify(job.to_dict())
+
+
+@detail_Blueprint.route("/jobs/<job_id>/events", methods=["GET"])
+def jobEvents(job_id):
+    job = job_engine.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "找不到工作"}), 404
+    # ?v=2 使用精簡格式（合併片段、UTF-8、固定資料只送一次），可再搭配 gzip
+    headers = {}
+    if request.args.get("v") == "2":
+        body = stream_v2(job, lastEventId())
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            body = gzip_stream(body)
+            headers["Content-Encoding"] = "gzip"
+    else:
+        body = stream_v1(job, lastEventId())
+    return Response(
+        stream_with_context(body),
+        mimetype="text/event-stream",
+        headers=headers,
+    )
+
+
+@detail_Blueprint.route("/routes/<route_id>/checkpoint", methods=["GET"])
+def getCheckpoint(route_id):
+    """回傳路線最近一次可以接續的檢查點摘要，沒有則回傳 null。"""
+    route = route_catalog.get_route(route_id)
+    if route is None:
+        return jsonify({"status": "error", "message": "找不到路線"}), 404
+    checkpoint = checkpoint_store.latest_resumable(
+        os.path.join(RUN_DIR_PATH_three, route["dir"]), in_use=checkpointInUse
+    )
+    return jsonify(checkpoint_summary(checkpoint) if checkpoint else None)
+
+
+def checkpointInUse(checkpoint):
+    """檢查點所屬的工作是否還在執行（關閉分頁後工作仍會在背景繼續），是的話不能接續。"""
+    if checkpoint.get("status") != CHECKPOINT_RUNNING or not checkpoint.get("job_id"):
+        return False
+    job = job_engine.get(checkpoint["job_id"])
+    return job is not None and not job.finished
+
+
+# 回應中出現這些字串就視為錯誤，停止執行
+ERROR_MARKERS = (
+    "PROHIBITED_CONTENT",
+    "GenerateRequestsPerMinutePerProjectPerModel",
+    "GenerateRequestsPerDayPerProjectPerModel",
+    "生成回應時發生未預期的錯誤",
+    "呼叫 Google API 失敗",
+)
+
+
+def hasErrorMarker(text):
+    return any(marker in text for marker in ERROR_MARKERS)
+
+
+def gemini_task_generator(request_data, job=None):
+    """執行一條路線；執行期間計入 active_runs，並把指標的 route 標籤設為這條路線。"""
+    run_id = request_data.get("id")
+    model = request_data.get("model")
+    labels = metrics.llm_labels(routeProvider(model), model, run_id)
+    with metrics.route_scope(run_id):
+        metrics.active_runs.labels(**labels).inc()
+        try:
+            yield from runGeminiTask(request_data, job)
+        finally:
+            metrics.active_runs.labels(**labels).dec()
+
+
+def runGeminiTask(request_data, job=None):
 
     run_id = request_data.get("id")
     run_model = request_data.get("model")
+    provider = routeProvider(run_model)
     run_Mode = request_data.get("runMode")
     token = request_data.get("token")
 
-    def stream_log(message_type, content, showlog=True, prompttoken=""):
+    def stream_log(message_type, content, showlog=True, prompttoken="", detail=None):
         """輔助函式，用於格式化並傳送串流訊息"""
-        log_entry = json.dumps(
-            {
-                "type": message_type,
-                "content": content,
-                "token": token,
-                "prompttoken": prompttoken,
-            }
-        )
+        log_entry = {
+            "type": message_type,
+            "content": content,
+            "token": token,
+            "prompttoken": prompttoken,
+        }
+        if detail is not None:
+            # 結構化的附加資料（例如重試事件）
+            log_entry["detail"] = detail
         if showlog:
             print(content)
-        return f"data: {log_entry}\n\n"
+        return log_entry
 
     # # <-- 新增：檢查並設定 API Key -->
     # api_key = request_data.get("apiKey")  # <-- 新增：從請求中獲取 API Key
@@ -258,22 +432,29 @@ def gemini_task_generator(request_data):
     # # <-- 新增結束 -->
 
     """載入資料"""
-    data_path = "data.json"
-    try:
-        with open(data_path, "r", encoding="utf-8") as f:
-            jsonarray = json.load(f)
-    except FileNotFoundError:
-        print(f"錯誤：找不到設定檔 {data_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"錯誤：{data_path} 格式不正確。")
-        return None
-
-    jsonarray = list(filter(lambda item: item["id"] == run_id, jsonarray))
-    if jsonarray:
-        json_data = jsonarray[0]
+    json_data = route_catalog.get_route(run_id)
+    if json_data is None:
+        yield stream_log("error", f"找不到路線資料：{run_id}")
+        return
 
     dir_name = json_data["dir"]
+    route_dir = os.path.join(RUN_DIR_PATH_three, dir_name)
+    writer = None
+    # 單次執行的 token / 費用上限（maxTokens、maxCost，未指定時看環境變數）
+    budget = TokenBudget.from_request(request_data)
+
+    # 接續先前中斷的執行
+    resume_from = None
+    if request_data.get("resumeFrom"):
+        resume_from = checkpoint_store.load(route_dir, request_data["resumeFrom"])
+        if resume_from is None:
+            yield stream_log("error", f"找不到檢查點：{request_data['resumeFrom']}")
+            return
+        if checkpointInUse(resume_from):
+            yield stream_log(
+                "error", f"檢查點 {resume_from['id']} 所屬的執行仍在進行中，無法接續。"
+            )
+            return
 
     try:
         start_time = time.perf_counter()
@@ -283,12 +464,274 @@ def gemini_task_generator(request_data):
         #     temperature=2,
         # )
 
-        chat_session = GeminiChatSession(model_name=run_model)
+        session_class = ReplayChatSession if provider == "replay" else GeminiChatSession
+        initial_history = None
+        if resume_from is not None:
+            initial_history = session_class.deserialize_history(
+                resume_from["history"]
+            )
+        if provider == "replay":
+            # 回放先前存下的 history_*.txt（可用 replayFile 指定，預設為最新的一份）
+            history_dir = os.path.join(route_dir, "history")
+            replay_file = request_data.get("replayFile")
+            recording_path = (
+                os.path.join(history_dir, os.path.basename(replay_file))
+                if replay_file
+                else latest_recording(history_dir)
+            )
+            if recording_path is None or not os.path.exists(recording_path):
+                yield stream_log("error", "找不到可以回放的對話紀錄 (history_*.txt)。")
+                return
+            chat_session = ReplayChatSession(
+                model_name=run_model,
+                initial_history=initial_history,
+                recording_path=recording_path,
+            )
+            yield stream_log("status", f"回放對話紀錄：{os.path.basename(recording_path)}")
+        else:
+            chat_session = GeminiChatSession(
+                model_name=run_model, initial_history=initial_history
+            )
+        # 重試發生在 API 呼叫內部：在工作中執行時直接發布（job_engine 可跨執行緒發布），
+        # 前端在等待重試期間就看得到；沒有工作時先暫存，等能 yield 時再送出
+        retry_events = []
+
+        def on_retry(event):
+            metrics.retries.labels(**metrics.llm_labels(provider, run_model)).inc()
+            log_entry = stream_log(
+                "retry",
+                f"{event['model']} 呼叫失敗（{event['reason']}），第 {event['attempt']}/{event['max_attempts']} 次重試，等待 {event['delay']} 秒",
+                detail=event,
+            )
+            if job is not None:
+                job.publish(log_entry)
+            else:
+                retry_events.append(log_entry)
+
+        chat_session.on_retry = on_retry
+
+        def retry_logs():
+            while retry_events:
+                yield retry_events.pop(0)
+
+        def usage_logs():
+            usage = chat_session.usage_summary()
+            if not usage:
+                return
+            run_usage = chat_session.usage_tracker.summary()
+            cost = ""
+            if run_usage["cost"] is not None:
+                cost = f"，估算費用 ${run_usage['cost']:.4f}"
+            yield stream_log(
+                "usage",
+                f"輸入 {usage['prompt']} tokens（快取 {usage['cached']}、新計 {usage['fresh']}），輸出 {usage['output']} tokens（思考 {usage['thinking']}）；本次執行累計 {run_usage['totals']['total']} tokens{cost}",
+                detail={"turn": usage, "run": run_usage},
+            )
+
+        # 先把路線中所有要送出的檔案同時上傳，並等待全部變成 ACTIVE
+        upload_paths = {
+            os.path.join(RUN_DIR_PATH_three, dir_name, item["content"]): item["content"]
+            for item in json_data["prompts"]
+            if item["type"] == "file" and item.get("isSend", True) != False
+        }
+        uploaded_by_content = {}
+        if upload_paths:
+            upload_started = time.perf_counter()
+            yield stream_log("status", f"正在同時上傳 {len(upload_paths)} 個檔案...")
+            remote_to_content = {}
+            uploaded = []
+            for path, file_obj, error in chat_session.upload_files_iter(
+                list(upload_paths)
+            ):
+                content_name = upload_paths[path]
+                if file_obj is None:
+                    yield stream_log(
+                        "progress", f"檔案上傳失敗: {content_name}，錯誤：{error}"
+                    )
+                    continue
+                remote_to_content[getattr(file_obj, "name", None)] = content_name
+                uploaded.append(file_obj)
+                yield stream_log("progress", f"檔案上傳完成: {content_name}")
+
+            yield stream_log("status", "開始等待後端處理檔案...")
+            for file_obj, state in chat_session.wait_until_active_iter(uploaded):
+                content_name = remote_to_content.get(getattr(file_obj, "name", None))
+                yield stream_log("progress", f"檔案 {content_name} 狀態：{state}")
+                if state == "ACTIVE":
+                    uploaded_by_content[content_name] = file_obj
+            metrics.upload_duration.labels(
+                **metrics.llm_labels(provider, run_model)
+            ).observe(time.perf_counter() - upload_started)
+
+        if resume_from is not None:
+            # 檔案過期重新上傳後 URI 會改變，把檢查點歷史中的舊 URI 換成新的
+            chat_session.remap_file_uris(
+                {
+                    old_uri: uploaded_by_content[name].uri
+                    for name, old_uri in resume_from.get("files", {}).items()
+                    if name in uploaded_by_content
+                }
+            )
+
+        # 檔案都排在第一個文字指令之前時，把系統指令與檔案放進內容快取，
+        # 之後每個指令都不用再重送整本小說
+        files_cached = False
+        send_items = [
+            item for item in json_data["prompts"] if item.get("isSend", True) != False
+        ]
+        first_text = next(
+            (i for i, item in enumerate(send_items) if item["type"] != "file"),
+            len(send_items),
+        )
+        leading_files = [
+            item["content"] for item in send_items[:first_text] if item["type"] == "file"
+        ]
+        if (
+            leading_files
+            and len(leading_files)
+            == len([item for item in send_items if item["type"] == "file"])
+            and all(name in uploaded_by_content for name in leading_files)
+        ):
+            files_cached = chat_session.use_context_cache(
+                [
+                    os.path.join(RUN_DIR_PATH_three, dir_name, name)
+                    for name in leading_files
+                ],
+                [uploaded_by_content[name] for name in leading_files],
+            )
+            if files_cached:
+                yield stream_log("status", "來源檔案已放入內容快取。")
+
+        # 回應快取（useCache，未指定時看 RESPONSE_CACHE）；forceFresh 時一律重新生成並覆寫快取
+        use_cache = request_data.get("useCache")
+        if use_cache is None:
+            use_cache = RESPONSE_CACHE_ENABLED
+        if use_cache and provider != "replay":
+            chat_session = CachedChatSession(
+                chat_session,
+                force_fresh=bool(request_data.get("forceFresh")),
+                file_hashes={
+                    file_obj.uri: hash_file(
+                        os.path.join(RUN_DIR_PATH_three, dir_name, name)
+                    )
+                    for name, file_obj in uploaded_by_content.items()
+                },
+                should_store=lambda text: not hasErrorMarker(text),
+            )
+            yield stream_log(
+                "status",
+                "回應快取：強制重新生成。" if chat_session.force_fresh else "回應快取已啟用。",
+            )
+
+        def cache_logs():
+            """這次的回應是否取自回應快取；命中時沒有呼叫模型，不送用量。"""
+            if not isinstance(chat_session, CachedChatSession):
+                yield from usage_logs()
+                return
+            cached = chat_session.last_cached
+            metrics.response_cache_lookups.labels(
+                **metrics.llm_labels(provider, run_model), result="hit" if cached else "miss"
+            ).inc()
+            if cached:
+                yield stream_log("status", "已使用快取的回應。")
+            else:
+                yield from usage_logs()
+
+        # 執行前估算輸入 token；檔案與指令的計數依內容雜湊快取，重跑同一條路線不必重算
+        first_index = resume_from["next_index"] if resume_from is not None else 0
+        preflight = None
+        try:
+            preflight = chat_session.preflight_tokens(
+                [
+                    (os.path.join(RUN_DIR_PATH_three, dir_name, name), uploaded_by_content[name])
+                    for name in dict.fromkeys(
+                        item["content"] for item in send_items if item["type"] == "file"
+                    )
+                    if name in uploaded_by_content
+                ],
+                [
+                    item["content"]
+                    for index, item in enumerate(json_data["prompts"])
+                    if index >= first_index
+                    and item.get("isSend", True) != False
+                    and item["type"] != "file"
+                ],
+            )
+            yield stream_log(
+                "preflight",
+                f"預估輸入 token：系統指令 {preflight['system']}、檔案 {preflight['files']}、指令 {preflight['prompts']}，整個執行至少 {preflight['estimated_input']} tokens（不含模型回應）",
+                detail=preflight,
+            )
+        except Exception as e:
+            yield stream_log("status", f"預估 token 數失敗，略過：{e}")
+        if (
+            preflight is not None
+            and budget.max_tokens is not None
+            and preflight["estimated_input"] > budget.max_tokens
+        ):
+            yield stream_log(
+                "error",
+                f"預估輸入 {preflight['estimated_input']} tokens 已超過上限 {budget.max_tokens}，不執行。",
+            )
+            return
 
         uploaded_files_result = []
         run_cnt = 0
-        full_response_content = ""
-        for item in json_data["prompts"]:
+        # 回應邊生成邊寫到 .partial，全部完成後才改名成正式檔
+        now_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+        response_filename = f"response_{now_str}.txt"
+        final_path = os.path.join(
+            RUN_DIR_PATH_three, dir_name, RESPONSE_FILES_DIR, response_filename
+        )
+        writer = ResponseWriter(final_path)
+
+        checkpoint = {
+            "id": now_str,
+            "route_id": run_id,
+            "job_id": job.id if job is not None else None,
+            "model": run_model,
+            "runMode": run_Mode,
+            "status": CHECKPOINT_RUNNING,
+            "next_index": 0,
+            "completed": 0,
+            "response_file": final_path,
+            "response_bytes": 0,
+            "files": {name: f.uri for name, f in uploaded_by_content.items()},
+        }
+
+        def saveCheckpoint(next_index):
+            checkpoint["next_index"] = next_index
+            checkpoint["completed"] = writer.response_count
+            checkpoint["response_bytes"] = writer.completed_bytes
+            # 歷史只附加這次新增的訊息，不會每個指令都整份重寫
+            checkpoint_store.save(
+                route_dir, checkpoint, chat_session.serialize_history()
+            )
+
+        start_index = 0
+        if resume_from is not None:
+            # 先把先前完成的回應複製到新的回應檔，再從失敗的指令接著執行
+            source = resume_from["response_file"]
+            if not os.path.exists(source):
+                source = source + PARTIAL_SUFFIX
+            writer.prefill(
+                source, resume_from["response_bytes"], resume_from["completed"]
+            )
+            run_cnt = resume_from["completed"]
+            start_index = resume_from["next_index"]
+            saveCheckpoint(start_index)
+            checkpoint_store.mark(route_dir, resume_from, CHECKPOINT_RESUMED)
+            yield stream_log(
+                "status",
+                f"從第 {start_index + 1} 個指令接續執行，已完成 {run_cnt} 則回應。",
+            )
+
+        all_done = False
+        for index, item in enumerate(json_data["prompts"]):
+            if job is not None and job.cancel_requested:
+                yield stream_log("status", "工作已取消，停止執行。")
+                break
+
             if "isSend" in item:
                 isSend = item["isSend"]
             else:
@@ -297,77 +740,111 @@ def gemini_task_generator(request_data):
             if isSend == False:
                 continue
 
+            if index < start_index:
+                # 接續執行：之前的指令已在檢查點的歷史中，只需還原要附加的檔案
+                if (
+                    item["type"] == "file"
+                    and not files_cached
+                    and item["content"] in uploaded_by_content
+                ):
+                    uploaded_files_result.append(uploaded_by_content[item["content"]])
+                continue
+
             prompt_content = item["content"]
             type = item["type"]
             ts = str(int(time.time() * 1000))
             prompttoken = f"prompt_{run_id}_{run_cnt}_{ts[-4:]}"
 
             if type == "file":
-                # 判斷是檔案，上傳檔案，並寫到uploaded_files_result裡面
-                files_to_upload = [
-                    os.path.join(RUN_DIR_PATH_three, dir_name, prompt_content)
-                ]
-                yield stream_log("status", f"正在上傳檔案: {prompt_content}...")
-                lst_upload_files = chat_session.upload_files(files_to_upload)
-
-                if lst_upload_files and len(lst_upload_files) > 0:
-                    file_info = lst_upload_files[0]
+                # 判斷是檔案，取出事先上傳好的檔案，並寫到uploaded_files_result裡面
+                file_info = uploaded_by_content.get(prompt_content)
+                if files_cached:
+                    yield stream_log("status", f"檔案已在內容快取中: {prompt_content}")
+                elif file_info is not None:
                     uploaded_files_result.append(file_info)
-                    yield stream_log("status", "檔案上傳完成！")
+                    yield stream_log("status", f"已附加檔案: {prompt_content}")
                 else:
                     yield stream_log(
                         "status",
                         f"檔案上傳失敗或回傳為空，已跳過檔案: {prompt_content}",
                     )
             else:
+                # 送出前確認加上這次請求不會超過執行上限
+                over_budget = budget.exceeded(
+                    chat_session.usage_tracker.summary(),
+                    chat_session.estimate_tokens(prompt_content, uploaded_files_result),
+                )
+                if over_budget:
+                    yield stream_log("status", f"已達執行上限（{over_budget}），停止執行。")
+                    break
+
                 # 判斷是文字，送出執行
                 if run_Mode == "stream":
+                    wait = chat_session.estimate_wait(prompt_content, uploaded_files_result)
+                    if wait > 0:
+                        yield stream_log(
+                            "status", f"接近模型配額上限，約需等待 {wait:.0f} 秒..."
+                        )
                     yield stream_log("status", "正在發送訊息至 Gemini...(串流模式)")
+                    timer = metrics.PromptTimer(provider, run_model)
                     send_message_stream = chat_session.send_message_stream(
                         prompt=prompt_content, uploaded_files=uploaded_files_result
                     )
 
-                    response_text = ""
+                    response_len = 0
+                    errorResult = False
+                    tail = ""
                     for chunk in send_message_stream:
+                        yield from retry_logs()
+                        if isinstance(chunk, StreamReset):
+                            # 串流中途失敗且要從頭重來，丟棄這次已收到的內容
+                            writer.rollback_response()
+                            response_len = 0
+                            tail = ""
+                            yield stream_log("reset", "", False, prompttoken)
+                            continue
                         if chunk:
+                            timer.first_token()
                             chunk = chunk.replace("**", "")
-                            response_text += chunk
+                            writer.write(chunk)
+                            response_len += len(chunk)
+                            # 錯誤字串可能被切在兩個片段之間，連同前一段的結尾一起檢查
+                            errorResult = errorResult or hasErrorMarker(tail + chunk)
+                            tail = (tail + chunk)[-64:]
                             # 將單次回應即時傳到前端
                             yield stream_log("stream", chunk, False, prompttoken)
 
-                    if not response_text:
+                    yield from retry_logs()
+                    if response_len == 0:
                         yield stream_log("status", f"發生Response為空錯誤，停止執行。")
                         break
 
-                    errorResult = (
-                        "PROHIBITED_CONTENT" in response_text
-                        or "GenerateRequestsPerMinutePerProjectPerModel"
-                        in response_text
-                        or "GenerateRequestsPerDayPerProjectPerModel" in response_text
-                        or "生成回應時發生未預期的錯誤" in response_text
-                    )
-
                     if errorResult:
+                        writer.rollback_response()
                         yield stream_log("status", f"發生錯誤，停止執行。")
                         break
 
-                    full_response_content += (
-                        response_text
-                        + "\n\n====================回應分隔線====================\n\n"
-                    )
+                    writer.end_response()
+                    usage = chat_session.usage_summary() or {}
+                    timer.finish(usage.get("output", 0) + usage.get("thinking", 0))
                     run_cnt = run_cnt + 1
+                    saveCheckpoint(index + 1)
+                    yield from cache_logs()
 
-                    if not item == json_data["prompts"][-1]:
-                        yield stream_log("status", "處理完畢，暫停 10 秒...")
-                        time.sleep(10)
-                        yield stream_log("status", "暫停結束，繼續處理下一個指令。")
 
                 else:
                     # 判斷是文字，送出執行
+                    wait = chat_session.estimate_wait(prompt_content, uploaded_files_result)
+                    if wait > 0:
+                        yield stream_log(
+                            "status", f"接近模型配額上限，約需等待 {wait:.0f} 秒..."
+                        )
                     yield stream_log("status", "正在發送訊息至 Gemini...")
+                    timer = metrics.PromptTimer(provider, run_model)
                     response = chat_session.send_message(
                         prompt=prompt_content, uploaded_files=uploaded_files_result
                     )
+                    yield from retry_logs()
 
                     if response == None:
                         yield stream_log("status", f"發生Response None錯誤，停止執行。")
@@ -376,83 +853,57 @@ def gemini_task_generator(request_data):
                     response = response.replace("**", "")
                     yield stream_log("data", response, False)  # 將單次回應即時傳到前端
 
-                    errorResult = (
-                        "PROHIBITED_CONTENT" in response
-                        or "GenerateRequestsPerMinutePerProjectPerModel" in response
-                        or "GenerateRequestsPerDayPerProjectPerModel" in response
-                        or "生成回應時發生未預期的錯誤" in response
-                    )
-
-                    if errorResult:
+                    if hasErrorMarker(response):
                         yield stream_log("status", f"發生錯誤，停止執行。")
                         break
 
-                    full_response_content += (
-                        response
-                        + "\n\n====================回應分隔線====================\n\n"
-                    )
+                    writer.write(response)
+                    writer.end_response()
+                    usage = chat_session.usage_summary() or {}
+                    timer.finish(usage.get("output", 0) + usage.get("thinking", 0))
                     run_cnt = run_cnt + 1
+                    saveCheckpoint(index + 1)
+                    yield from cache_logs()
+        else:
+            all_done = True
+
+        if writer.response_count > 0:
+            # 中途停止的執行保留為 failed，之後可以從 next_index 接續
+            checkpoint_store.mark(
+                route_dir,
+                checkpoint,
+                CHECKPOINT_DONE if all_done else CHECKPOINT_FAILED,
+            )
 
-                    if not item == json_data["prompts"][-1]:
-                        yield stream_log("status", "處理完畢，暫停 10 秒...")
-                        time.sleep(10)
-                        yield stream_log("status", "暫停結束，繼續處理下一個指令。")
-
-        if run_cnt > 0 and not full_response_content.strip() == "":
+        if run_cnt > 0 and writer.response_count > 0:
             # --- 5. 儲存最終結果 ---
             yield stream_log("status", "所有指令處理完畢，正在儲存最終結果...")
-            now_str = datetime.now().strftime("%Y%m%d_%H%M%S")
-            response_filename = f"response_{now_str}.txt"
-            final_path = os.path.join(
-                RUN_DIR_PATH_three, dir_name, RESPONSE_FILES_DIR, response_filename
-            )
-
-            os.makedirs(os.path.dirname(final_path), exist_ok=True)
-            with open(final_path, "w", encoding="utf-8") as f:
-                f.write(full_response_content)
+            writer.commit()
             yield stream_log("status", f"回應已成功儲存至: {final_path}")
 
+            usage_file = write_usage_file(
+                final_path,
+                {
+                    "route_id": run_id,
+                    "model": run_model,
+                    "preflight": preflight,
+                    "budget": budget.to_dict(),
+                    "summary": chat_session.usage_tracker.summary(),
+                    "turns": chat_session.usage_tracker.turns,
+                },
+            )
+            yield stream_log("status", f"用量紀錄已儲存至: {usage_file}")
+            # 歷史清單的索引（檔名、大小、段數、token 等）
+            response_index.record(final_path)
+            # 全文檢索
+            search_index.index_file(final_path, "response", str(run_id))
+
             history_filename = f"history_{now_str}.txt"
             history_path = os.path.join(
                 RUN_DIR_PATH_three, dir_name, "history", history_filename
             )
 
-            history_to_save = []
-            for message in chat_session.history:
-                message_dict = {"role": message.role, "parts": []}
-                print(message.parts)
-                if message.parts != None:
-                    for parts in message.parts:
-                        # print("parts:", end="")
-                        # print(parts)
-                        # 檢查是否為 TextPart
-                        if parts.text != None:
-                            message_dict["parts"].append(
-                                {"type": "text", "text": parts.text}
-                            )
-                        elif parts.file_data != None:
-                            # FileDataPart 包含 mime_type 和 uri
-
-                            #  下面這邊要到 GeminiChatSession
-                            # file_id = parts.file_data.file_uri.split("/")[-1]
-                            # file_resource_name = f"files/{file_id}"
-                            # remote_file = chat_session.chat.files.get(name=file_resource_name)
-                            # print("remote_file.display_name:", end="")
-                            # print(remote_file.display_name)
-
-                            message_dict["parts"].append(
-                                {
-                                    "type": "file_data",
-                                    "mime_type": parts.file_data.mime_type,
-                                    "uri": parts.file_data.file_uri,
-                                }
-                            )
-                        else:
-                            print(
-                                f"警告：發現未知類型的對話部分，已跳過：{type(parts)}"
-                            )
-
-                history_to_save.append(message_dict)
+            history_to_save = chat_session.serialize_history()
 
             os.makedirs(os.path.dirname(history_path), exist_ok=True)
             with open(history_path, "w", encoding="utf-8") as f:
@@ -461,13 +912,37 @@ def gemini_task_generator(request_data):
             yield stream_log("status", f"對話已成功儲存至: {history_path}")
 
         else:
+            writer.discard()
             yield stream_log("status", f"發生錯誤，不執行儲存作業。")
 
+        if isinstance(chat_session, CachedChatSession):
+            yield stream_log(
+                "status",
+                f"回應快取命中 {chat_session.hits} 次、未命中 {chat_session.misses} 次。",
+            )
+
+        run_usage = chat_session.usage_tracker.summary()
+        yield stream_log(
+            "usage_total",
+            f"本次執行共呼叫 {run_usage['calls']} 次，累計 {run_usage['totals']['total']} tokens",
+            detail=run_usage,
+        )
+
         end_time = time.perf_counter()
         execution_time = end_time - start_time
+        if provider == "replay":
+            # 回放的模型時間是模擬出來的，其餘就是程式本身的耗時
+            yield stream_log(
+                "status",
+                f"模擬的模型時間 {chat_session.model_seconds:.2f} 秒，程式本身耗時 {execution_time - chat_session.model_seconds:.2f} 秒。",
+            )
         yield stream_log("done", f"所有任務完成！總執行時間: {execution_time:.2f} 秒。")
     except Exception as e:
         import traceback
 
         error_details = traceback.format_exc()
         yield stream_log("error", f"執行過程中發生未預期的錯誤: {e}\n{error_details}")
+    finally:
+        # 中途發生錯誤或被中斷時保留 .partial，歷史清單會顯示為未完成
+        if writer is not None:
+            writer.close()
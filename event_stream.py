@@ -0,0 +1,141 @@
+# 工作事件的 SSE 輸出格式
+# v1：每個事件一則訊息，欄位齊全（與舊版前端相容）。
+# v2：精簡格式，適合長篇串流：
+#   - 第一則為 "event: meta"，只送一次 job id 與 token 等固定資料
+#   - 之後每則 data 為 {"t": 類型, "c": 內容}，prompttoken 只在改變時以 "p" 帶出，附加資料為 "d"
+#   - 同一個指令連續的 stream 片段在 COALESCE_WINDOW 秒 / COALESCE_MAX_CHARS 字內合併成一則
+#   - JSON 不做 ASCII 跳脫，中文直接以 UTF-8 傳送
+#   - 用戶端接受 gzip 時以 gzip 壓縮整個串流（每則訊息後 sync flush）
+import json
+import time
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import metrics
+from job_engine import HEARTBEAT_INTERVAL
+
+COALESCE_WINDOW = 0.25
+COALESCE_MAX_CHARS = 2048
+KEEPALIVE = ": keepalive\n\n"
+
+
+def _compact(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def format_v1(event_id: Optional[int], event: Optional[Dict]) -> str:
+    """把事件 dict 轉成帶編號的 SSE 格式；None 代表心跳。"""
+    if event is None:
+        return KEEPALIVE
+    return f"id: {event_id}\ndata: {json.dumps(event)}\n\n"
+
+
+def _sse_client_gauge(job):
+    return metrics.sse_clients.labels(
+        **metrics.llm_labels(
+            job.meta.get("provider"), job.meta.get("model"), job.meta.get("route_id")
+        )
+    )
+
+
+def stream_v1(job, last_event_id: int = 0) -> Iterator[str]:
+    gauge = _sse_client_gauge(job)
+    gauge.inc()
+    try:
+        for event_id, event in job.subscribe(last_event_id):
+            yield format_v1(event_id, event)
+    finally:
+        gauge.dec()
+
+
+class V2Encoder:
+    """
+    把事件轉成 v2 訊息，並暫存可以合併的 stream 片段。
+    合併後的訊息以最後一個片段的編號為 id，斷線重連時不會重送或漏掉內容。
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW, max_chars: int = COALESCE_MAX_CHARS):
+        self.window = window
+        self.max_chars = max_chars
+        self._prompttoken = None
+        self._pending = None  # [最後編號, prompttoken, 文字片段 list, 字數, 開始時間]
+
+    def _message(self, event_id: int, event_type: str, content, prompttoken, detail=None) -> str:
+        payload = {"t": event_type, "c": content}
+        if prompttoken != self._prompttoken:
+            payload["p"] = prompttoken
+            self._prompttoken = prompttoken
+        if detail is not None:
+            payload["d"] = detail
+        return f"id: {event_id}\ndata: {_compact(payload)}\n\n"
+
+    def flush(self) -> List[str]:
+        if self._pending is None:
+            return []
+        event_id, prompttoken, parts, _, _ = self._pending
+        self._pending = None
+        return [self._message(event_id, "stream", "".join(parts), prompttoken)]
+
+    def add(self, event_id: int, event: Dict) -> List[str]:
+        event_type = event.get("type")
+        prompttoken = event.get("prompttoken", "")
+        content = event.get("content", "")
+
+        if event_type == "stream" and isinstance(content, str):
+            out = []
+            if self._pending is not None and self._pending[1] != prompttoken:
+                out = self.flush()
+            if self._pending is None:
+                self._pending = [event_id, prompttoken, [], 0, time.monotonic()]
+            self._pending[0] = event_id
+            self._pending[2].append(content)
+            self._pending[3] += len(content)
+            if (
+                self._pending[3] >= self.max_chars
+                or time.monotonic() - self._pending[4] >= self.window
+            ):
+                out.extend(self.flush())
+            return out
+
+        out = self.flush()
+        out.append(
+            self._message(event_id, event_type, content, prompttoken, event.get("detail"))
+        )
+        return out
+
+
+def stream_v2(job, last_event_id: int = 0) -> Iterator[str]:
+    yield f"event: meta\ndata: {_compact({'job': job.id, 'token': job.meta.get('token')})}\n\n"
+
+    encoder = V2Encoder()
+    last_sent = time.monotonic()
+    gauge = _sse_client_gauge(job)
+    gauge.inc()
+    try:
+        for event_id, event in job.subscribe(last_event_id, idle=COALESCE_WINDOW):
+            if event is None:
+                out = encoder.flush()
+                if not out and time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+                    out = [KEEPALIVE]
+            else:
+                out = encoder.add(event_id, event)
+            if out:
+                last_sent = time.monotonic()
+                yield "".join(out)
+
+        out = encoder.flush()
+        if out:
+            yield "".join(out)
+    finally:
+        gauge.dec()
+
+
+def gzip_stream(chunks: Iterable[str]) -> Iterator[bytes]:
+    """以 gzip 壓縮串流；每則訊息後 sync flush，讓瀏覽器能即時解壓顯示。"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,241 @@
+# 已上傳到 Gemini 的檔案登錄表
+# 在本機保存一份 manifest，記錄「本機路徑 + SHA-256」對應的遠端檔案名稱、狀態與到期時間。
+# 內容沒變的檔案直接沿用遠端檔案，不必呼叫 files.list()；
+# 同名但內容已改變的檔案會因為雜湊不同而重新上傳，不會誤用舊內容。
+# manifest 以檔案鎖保護，多個 gunicorn worker 可以共用。
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from google.genai import types
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), "remote_files.json")
+# 遠端檔案清單在記憶體中保留的秒數
+LIST_TTL = 300
+# 距離到期不足這個時間的遠端檔案就不再沿用（一次執行可能要跑很久）
+EXPIRY_MARGIN = timedelta(hours=2)
+
+
+class ManifestLock:
+    """跨行程的檔案鎖，保護 manifest 的讀寫。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fh = None
+
+    def __enter__(self):
+        self._fh = open(self.path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX)
+        else:
+            self._fh.seek(0)
+            msvcrt.locking(self._fh.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+            else:
+                self._fh.seek(0)
+                msvcrt.locking(self._fh.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._fh.close()
+
+
+def state_name(state: Any) -> str:
+    """state 可能是列舉（有 name 屬性）或字串，統一轉成大寫字串。"""
+    if state is None:
+        return ""
+    name = getattr(state, "name", None)
+    if name is not None:
+        return name
+    return str(state).upper()
+
+
+def _hash_matches(remote_hash: Optional[str], digest: bytes) -> bool:
+    """遠端的 sha256_hash 為 base64 字串，兼容幾種常見的編碼方式比對。"""
+    if not remote_hash:
+        return False
+    hex_digest = digest.hex()
+    candidates = {
+        hex_digest,
+        base64.b64encode(digest).decode("ascii"),
+        base64.b64encode(hex_digest.encode("ascii")).decode("ascii"),
+    }
+    return remote_hash in candidates
+
+
+class RemoteFileRegistry:
+    """
+    本機檔案與 Gemini 遠端檔案的對照表。
+    """
+
+    def __init__(self, manifest_path: str = MANIFEST_PATH, list_ttl: float = LIST_TTL):
+        self.manifest_path = manifest_path
+        self.lock_path = f"{manifest_path}.lock"
+        self.list_ttl = list_ttl
+        self._lock = threading.Lock()
+        self._manifest: Dict[str, Dict] = {}
+        self._manifest_mtime = None
+        self._remote_files: Optional[List[Any]] = None
+        self._remote_listed_at = 0.0
+
+    # --- manifest 讀寫 ---
+    def _load_manifest(self) -> Dict[str, Dict]:
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        if mtime != self._manifest_mtime:
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    self._manifest = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"讀取遠端檔案清單 {self.manifest_path} 失敗，將重新建立：{e}")
+                self._manifest = {}
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    def _save_manifest(self, manifest: Dict[str, Dict]):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest = manifest
+        self._manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+
+    # --- 本機檔案雜湊 ---
+    def file_digest(self, path: str) -> bytes:
+        """
+        計算檔案的 SHA-256。
+        大小與修改時間都沒變時，直接使用 manifest 中記錄的雜湊值。
+        """
+        key = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            entry = self._load_manifest().get(key)
+        if (
+            entry
+            and entry.get("size") == st.st_size
+            and entry.get("mtime_ns") == st.st_mtime_ns
+            and entry.get("sha256")
+        ):
+            return bytes.fromhex(entry["sha256"])
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+        return h.digest()
+
+    # --- 查詢 / 登錄 ---
+    def lookup(self, path: str, digest: bytes) -> Optional[types.File]:
+        """manifest 中有內容相同且尚未到期的遠端檔案就回傳，不會呼叫任何 API。"""
+        with self._lock:
+            entry = self._load_manifest().get(os.path.abspath(path))
+        if not entry or entry.get("sha256") != digest.hex():
+            return None
+        if state_name(entry.get("state")) == "FAILED":
+            return None
+
+        expiration = entry.get("expiration_time")
+        if expiration:
+            expires_at = datetime.fromisoformat(expiration)
+            if expires_at - EXPIRY_MARGIN <= datetime.now(timezone.utc):
+                return None
+
+        return types.File(
+            name=entry["name"],
+            display_name=entry.get("display_name"),
+            uri=entry.get("uri"),
+            mime_type=entry.get("mime_type"),
+            state=entry.get("state") or None,
+            expiration_time=expiration,
+        )
+
+    def register(self, path: str, digest: bytes, file_obj: Any):
+        """記錄（或更新）本機檔案對應的遠端檔案。"""
+        st = os.stat(path)
+        expiration = getattr(file_obj, "expiration_time", None)
+        if isinstance(expiration, datetime):
+            if expiration.tzinfo is None:
+                expiration = expiration.replace(tzinfo=timezone.utc)
+            expiration = expiration.isoformat()
+
+        entry = {
+            "sha256": digest.hex(),
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "name": getattr(file_obj, "name", None),
+            "display_name": getattr(file_obj, "display_name", None),
+            "uri": getattr(file_obj, "uri", None),
+            "mime_type": getattr(file_obj, "mime_type", None),
+            "state": state_name(getattr(file_obj, "state", None)),
+            "expiration_time": expiration,
+        }
+        with self._lock, ManifestLock(self.lock_path):
+            # 在鎖內重新讀取，保留其他 worker 剛寫入的紀錄
+            self._manifest_mtime = None
+            manifest = dict(self._load_manifest())
+            manifest[os.path.abspath(path)] = entry
+            self._save_manifest(manifest)
+
+    def update_state(self, file_obj: Any):
+        """檔案狀態改變（例如 PROCESSING -> ACTIVE）時更新 manifest。"""
+        name = getattr(file_obj, "name", None)
+        with self._lock, ManifestLock(self.lock_path):
+            self._manifest_mtime = None
+            manifest = dict(self._load_manifest())
+            changed = False
+            for entry in manifest.values():
+                if entry.get("name") == name:
+                    entry["state"] = state_name(getattr(file_obj, "state", None))
+                    changed = True
+            if changed:
+                self._save_manifest(manifest)
+
+    # --- 遠端清單 ---
+    def remote_files(self, client: Any, refresh: bool = False) -> List[Any]:
+        """取得遠端檔案清單；在 TTL 內重複使用同一份結果。"""
+        with self._lock:
+            expired = time.time() - self._remote_listed_at > self.list_ttl
+            if refresh or self._remote_files is None or expired:
+                self._remote_files = list(client.files.list())
+                self._remote_listed_at = time.time()
+            return self._remote_files
+
+    def find_remote(
+        self, client: Any, path: str, digest: bytes
+    ) -> Optional[Any]:
+        """在遠端清單中尋找同名、內容相同且可用的檔案。"""
+        file_name = os.path.basename(path)
+        for item in self.remote_files(client):
+            if getattr(item, "display_name", None) != file_name:
+                continue
+            if state_name(getattr(item, "state", None)) not in ("ACTIVE", "PROCESSING"):
+                continue
+            expiration = getattr(item, "expiration_time", None)
+            if isinstance(expiration, datetime):
+                if expiration.tzinfo is None:
+                    expiration = expiration.replace(tzinfo=timezone.utc)
+                if expiration - EXPIRY_MARGIN <= datetime.now(timezone.utc):
+                    continue
+            if _hash_matches(getattr(item, "sha256_hash", None), digest):
+                return item
+        return None
+
+
+# 全域共用的實例
+remote_file_registry = RemoteFileRegistry()
@@ -230,12 +230,7 @@ def main(config, prompt_files, uploaded_files):
         save_response(response, RESPONSE_PATH, "a")
         save_response("\n\n====================回應分隔線====================\n\n", RESPONSE_PATH, "a")
         cnt = cnt + 1
-        if prompt_file != prompt_files[-1]:
-            # 暫停 60 秒，避免token爆掉
-            # print("程式即將暫停 60 秒...")
-            if cnt % 2 == 0:
-                print(f"\n暫停 60 秒...")
-                time.sleep(60)
+        # 配額控制交由 GeminiChatSession 內的速率限制器處理，不再固定暫停
 
     # 計算時間差
     end_time = time.perf_counter()
@@ -1,10 +1,14 @@
-from flask import Blueprint, request, render_template, render_template_string
+from flask import Blueprint, request, render_template, render_template_string, Response, stream_with_context
 import requests
 import os
-import json
-from datetime import datetime
 from flask import jsonify
-from config import RESPONSE_FILES_DIR, RUN_DIR_PATH_three
+import time
+from config import Google_AI_STUDIO_BACKUP_DIR, RESPONSE_FILES_DIR, RUN_DIR_PATH_three
+from route_catalog import route_catalog
+from response_index import response_index
+from response_segments import response_reader
+from search_index import collect_files, search_index
+from token_usage import usage_path
 
 
 # 創建一個 Blueprint 物件
@@ -16,42 +20,25 @@ history_Blueprint = Blueprint("history", __name__)
 @history_Blueprint.route("/", methods=["GET"])
 def PageLoad():
     """載入資料"""
-    data_path = "data.json"
-    try:
-        with open(data_path, "r", encoding="utf-8") as f:
-            jsonarray = json.load(f)
-    except FileNotFoundError:
-        print(f"錯誤：找不到設定檔 {data_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"錯誤：{data_path} 格式不正確。")
+    jsonarray = route_catalog.get_routes()
+    if jsonarray is None:
         return None
 
     return render_template("history.html", jsondata=jsonarray)
 
 
 # 傳入ID，回傳先前產生的檔案清單
+# 可選參數：offset、limit（有指定 limit 時回傳 {"total", "offset", "items"} 分頁結果）、
+# sort（createtime / filename / size / chars / segments / tokens）、order（desc / asc）
 @history_Blueprint.route("/getHistoryFileList", methods=["POST"])
 def getHistoryFileList():
-    id = request.get_json().get("id")
+    data = request.get_json()
+    id = data.get("id")
 
     """載入資料"""
-    data_path = "data.json"
-    try:
-        with open(data_path, "r", encoding="utf-8") as f:
-            jsonarray = json.load(f)
-    except FileNotFoundError:
-        print(f"錯誤：找不到設定檔 {data_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"錯誤：{data_path} 格式不正確。")
-        return None
-
-    jsonarray = list(filter(lambda item: item["id"] == id, jsonarray))
-    if not jsonarray:
-        jsondata = []
-    else:
-        jsondata = jsonarray[0]
+    jsondata = route_catalog.get_route(id)
+    if jsondata is None:
+        return jsonify({"error": "找不到路線"}), 404
 
     dir = jsondata["dir"]
 
@@ -60,30 +47,22 @@ def getHistoryFileList():
         dir,
         RESPONSE_FILES_DIR,
     )
-    # 取得該資料夾下所有 txt 檔案
-    txt_files = []
-    if os.path.exists(history_path):
-        for fname in os.listdir(history_path):
-            if fname.lower().endswith(".txt"):
-                file_path = os.path.join(history_path, fname)
-                creation_time = os.path.getctime(file_path)
-                creation_datetime = datetime.fromtimestamp(creation_time)
-                txt_files.append(
-                    {
-                        "filename": fname,
-                        "createtime": creation_datetime.strftime("%Y-%m-%d %H:%M:%S"),
-                    }
-                )
-    # 按 createtime 由新到舊排序（最新在前）
+    # 清單取自 Response 的索引（執行中或中斷的 .txt.partial 標示為未完成），預設由新到舊
+    limit = data.get("limit")
     try:
-        txt_files.sort(
-            key=lambda x: datetime.strptime(x["createtime"], "%Y-%m-%d %H:%M:%S"),
-            reverse=True,
+        page = response_index.page(
+            history_path,
+            offset=max(int(data.get("offset") or 0), 0),
+            limit=None if limit is None else max(int(limit), 0),
+            sort=data.get("sort") or "createtime",
+            descending=(data.get("order") or "desc") != "asc",
         )
-    except Exception as e:
-        print(f"排序時發生錯誤: {e}")
+    except ValueError as e:
+        return jsonify({"error": f"參數錯誤: {e}"}), 400
 
-    return (jsonify(txt_files), 200)
+    if limit is None:
+        return (jsonify(page["items"]), 200)
+    return (jsonify(page), 200)
 
 
 # 取得之前產生的小說內容
@@ -92,37 +71,155 @@ def getTxtContent():
     id = request.get_json().get("id")
     filename = request.get_json().get("filename")
 
-    """載入資料"""
-    data_path = "data.json"
+    # 整份讀進記憶體，大檔案請改用 getTxtOutline / getTxtSegment / streamTxt
+    txt_file = responseFilePath(id, filename)
+    if txt_file is None:
+        return jsonify({"error": "檔案不存在"}), 404
+
     try:
-        with open(data_path, "r", encoding="utf-8") as f:
-            jsonarray = json.load(f)
-    except FileNotFoundError:
-        print(f"錯誤：找不到設定檔 {data_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"錯誤：{data_path} 格式不正確。")
+        with open(txt_file, "r", encoding="utf-8") as f:
+            content = f.read()
+    except Exception as e:
+        return jsonify({"error": f"讀取檔案時發生錯誤: {e}"}), 500
+
+    return (jsonify({"content": content}), 200)
+
+
+def responseFilePath(id, filename):
+    """路線 Response 資料夾中的回應檔路徑；路線或檔案不存在時回傳 None。"""
+    jsondata = route_catalog.get_route(id)
+    if jsondata is None or not filename:
         return None
+    # 只取檔名，避免讀到 Response 資料夾以外的檔案
+    txt_file = os.path.join(
+        RUN_DIR_PATH_three, jsondata["dir"], RESPONSE_FILES_DIR, os.path.basename(filename)
+    )
+    return txt_file if os.path.isfile(txt_file) else None
 
-    jsonarray = list(filter(lambda item: item["id"] == id, jsonarray))
-    if not jsonarray:
-        jsondata = []
-    else:
-        jsondata = jsonarray[0]
 
-    dir = jsondata["dir"]
+# 回應檔的分段資訊（每段的位元組與字元範圍），前端先載入第一段，其餘需要時再讀
+@history_Blueprint.route("/getTxtOutline", methods=["POST"])
+def getTxtOutline():
+    data = request.get_json()
+    txt_file = responseFilePath(data.get("id"), data.get("filename"))
+    if txt_file is None:
+        return jsonify({"error": "檔案不存在"}), 404
 
-    txt_file = os.path.join(RUN_DIR_PATH_three, dir, RESPONSE_FILES_DIR, filename)
-    if not os.path.exists(txt_file):
+    try:
+        outline = response_reader.outline(txt_file)
+    except Exception as e:
+        return jsonify({"error": f"讀取檔案時發生錯誤: {e}"}), 500
+
+    return (jsonify(outline), 200)
+
+
+# 取得回應檔的第 index 段（從 0 開始）
+@history_Blueprint.route("/getTxtSegment", methods=["POST"])
+def getTxtSegment():
+    data = request.get_json()
+    txt_file = responseFilePath(data.get("id"), data.get("filename"))
+    if txt_file is None:
         return jsonify({"error": "檔案不存在"}), 404
 
     try:
-        with open(txt_file, "r", encoding="utf-8") as f:
-            content = f.read()
+        segment = response_reader.read_segment(txt_file, int(data.get("index") or 0))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"參數錯誤: {e}"}), 400
     except Exception as e:
         return jsonify({"error": f"讀取檔案時發生錯誤: {e}"}), 500
+    if segment is None:
+        return jsonify({"error": "沒有這一段"}), 404
 
-    return (jsonify({"content": content}), 200)
+    return (jsonify(segment), 200)
+
+
+# 取得回應檔的一個範圍：unit 為 byte（預設）或 char，end 省略時讀到檔尾
+@history_Blueprint.route("/getTxtRange", methods=["POST"])
+def getTxtRange():
+    data = request.get_json()
+    txt_file = responseFilePath(data.get("id"), data.get("filename"))
+    if txt_file is None:
+        return jsonify({"error": "檔案不存在"}), 404
+
+    try:
+        end = data.get("end")
+        result = response_reader.read_range(
+            txt_file,
+            int(data.get("start") or 0),
+            None if end is None else int(end),
+            data.get("unit") or "byte",
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"參數錯誤: {e}"}), 400
+    except Exception as e:
+        return jsonify({"error": f"讀取檔案時發生錯誤: {e}"}), 500
+
+    return (jsonify(result), 200)
+
+
+# 以串流（chunked）回傳整個回應檔或其中一段，純文字格式
+# URL:/history/streamTxt?id=1&filename=response_xxx.txt&segment=0
+@history_Blueprint.route("/streamTxt", methods=["GET"])
+def streamTxt():
+    txt_file = responseFilePath(request.args.get("id"), request.args.get("filename"))
+    if txt_file is None:
+        return jsonify({"error": "檔案不存在"}), 404
+
+    segment = request.args.get("segment", type=int)
+    return Response(
+        stream_with_context(response_reader.iter_chunks(txt_file, segment)),
+        content_type="text/plain; charset=utf-8",
+    )
+
+
+def searchFiles():
+    """要建立全文索引的所有檔案（背景同步時呼叫）。"""
+    return collect_files(
+        route_catalog.get_routes(),
+        RUN_DIR_PATH_three,
+        RESPONSE_FILES_DIR,
+        Google_AI_STUDIO_BACKUP_DIR,
+    )
+
+
+def startSearchSync():
+    """啟動全文索引的背景同步：啟動時先補齊一次，之後定期執行。"""
+    search_index.start_background_sync(searchFiles)
+
+
+# 全文檢索所有路線的回應檔與 gaibackup 備份，依相關度回傳摘要
+# URL:/history/search?q=關鍵字&limit=20&offset=0&kind=response|backup&source=路線ID或備份名稱
+@history_Blueprint.route("/search", methods=["GET"])
+def search():
+    query = (request.args.get("q") or "").strip()
+    if not query:
+        return jsonify({"error": "請輸入要搜尋的文字"}), 400
+
+    started = time.perf_counter()
+    try:
+        # 寫入回應檔與下載備份時會即時更新索引，其他異動由背景同步補齊（見 startSearchSync）
+        results = search_index.search(
+            query,
+            limit=min(max(request.args.get("limit", 20, type=int), 1), 100),
+            offset=max(request.args.get("offset", 0, type=int), 0),
+            kind=request.args.get("kind"),
+            source=request.args.get("source"),
+        )
+    except Exception as e:
+        print(f"搜尋時發生錯誤: {e}")
+        return jsonify({"error": f"搜尋失敗: {e}"}), 500
+
+    return (
+        jsonify(
+            {
+                "query": query,
+                "results": results,
+                "syncing": search_index.syncing,
+                "took_ms": round((time.perf_counter() - started) * 1000, 2),
+            }
+        ),
+        200,
+    )
 
 
 @history_Blueprint.route("/doDeleteFile", methods=["POST"])
@@ -131,22 +228,9 @@ def doDeleteFile():
     files = request.get_json().get("files")
 
     """載入資料"""
-    data_path = "data.json"
-    try:
-        with open(data_path, "r", encoding="utf-8") as f:
-            jsonarray = json.load(f)
-    except FileNotFoundError:
-        print(f"錯誤：找不到設定檔 {data_path}")
-        return None
-    except json.JSONDecodeError:
-        print(f"錯誤：{data_path} 格式不正確。")
-        return None
-
-    jsonarray = list(filter(lambda item: item["id"] == id, jsonarray))
-    if not jsonarray:
-        jsondata = []
-    else:
-        jsondata = jsonarray[0]
+    jsondata = route_catalog.get_route(id)
+    if jsondata is None:
+        return jsonify({"error": "找不到路線"}), 404
 
     dir = jsondata["dir"]
 
@@ -162,11 +246,17 @@ def doDeleteFile():
                 file_path = os.path.join(history_path, fname)
                 try:
                     os.remove(file_path)
+                    search_index.remove_file(file_path)
+                    # 一併刪除這個回應檔的用量紀錄
+                    usage_file = usage_path(file_path)
+                    if os.path.exists(usage_file):
+                        os.remove(usage_file)
                     print(f"刪除 {file_path} 成功。")
                 except FileNotFoundError:
                     pass
                 except Exception as e:
                     print(f"刪除檔案 {file_path} 時發生錯誤: {e}")
                 continue
+        response_index.remove(history_path, files)
 
     return (jsonify(""), 200)
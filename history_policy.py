@@ -0,0 +1,303 @@
+# 對話歷史的長度管理
+# 每一輪都會把整段歷史重送給模型，長路線越跑越慢也越貴，最後還會超過 context 上限。
+# 這裡的策略在每次送出前依 token 預算整理歷史，三個 ChatSession 共用：
+#   - KeepAllPolicy：不處理（預設，與原本行為相同）
+#   - SlidingWindowPolicy：超過預算時從最舊的對話輪次開始丟棄
+#   - SummaryPolicy：丟棄的輪次改由模型寫成摘要放回歷史，摘要會快取起來重複使用
+# 系統指令與第一次附上來源檔案的輪次一律保留（pin），最近幾輪也不會被丟棄。
+# 路線會在之後的每個指令重複附上同一批檔案，重複附檔的輪次不算 pin，可以被丟棄。
+# 寫摘要的呼叫與一般送出一樣經過 session 的 rate_limiter 與 retry_policy。
+# 可用環境變數設定預設策略：
+#   HISTORY_POLICY=keep|window|summary、HISTORY_TOKEN_BUDGET=120000、HISTORY_KEEP_TURNS=2
+import hashlib
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+# 摘要輪次的開頭，用來辨識歷史中已有的摘要
+SUMMARY_PREFIX = "【先前對話摘要】"
+SUMMARY_ACK = "好的，我會依照這份摘要的內容接續創作。"
+SUMMARY_PROMPT = (
+    "請把以下小說創作的對話濃縮成摘要，保留人物、人物關係、已發生的劇情與伏筆、"
+    "目前的場景，以及使用者對內容與文風的要求。使用繁體中文，不超過 {limit} 字。\n\n{transcript}"
+)
+SUMMARY_CACHE_SIZE = 32
+
+
+class HistoryAdapter(ABC):
+    """
+    讓策略能處理各供應商的歷史格式。歷史是由 item 組成的 list，
+    item 可以是 Gemini 的 Content 或 OpenAI 的 message dict。
+    session 為所屬的 ChatSession，寫摘要時共用它的 rate_limiter、retry_policy 與 printLog。
+    """
+
+    provider = ""
+    session = None
+
+    def log(self, message: str):
+        if self.session is not None:
+            self.session.printLog(message, True)
+        else:
+            print(message)
+
+    def _call_limited(self, call: Callable[[], Tuple[str, int]], estimate: int) -> str:
+        """
+        經過 session 的 rate_limiter 與 retry_policy 呼叫 call()；call 回傳 (文字, 實際 token 數)。
+        不可重試或重試用完時拋出最後的錯誤。
+        """
+        session = self.session
+        retry = session.retry_policy.begin(self.provider, session.model_name, session.on_retry)
+        while True:
+            try:
+                rate_entry = session.rate_limiter.acquire(estimate)
+                text, tokens = call()
+                session.rate_limiter.record(rate_entry, tokens)
+                return text
+            except Exception as e:
+                delay = retry.next_delay(e)
+                if delay is None:
+                    raise
+                self.log(f"產生歷史摘要時發生可重試錯誤 (第 {retry.attempt} 次失敗): {e}，將在 {delay:.1f} 秒後重試...")
+                time.sleep(delay)
+
+    @abstractmethod
+    def role(self, item: Any) -> str:
+        """回傳 "system"、"user" 或 "model"。"""
+
+    @abstractmethod
+    def text(self, item: Any) -> str:
+        """item 的文字內容。"""
+
+    def file_keys(self, item: Any) -> Set[str]:
+        """item 附帶的檔案識別（URI 或內容雜湊），用來判斷是否第一次出現。"""
+        return set()
+
+    def tokens(self, item: Any) -> int:
+        """粗估 item 的 token 數（中文約一字一 token，故直接以字數估算）。"""
+        return len(self.text(item))
+
+    @abstractmethod
+    def summary_items(self, summary: str) -> List[Any]:
+        """把摘要包成一組 user / model 輪次。"""
+
+    @abstractmethod
+    def summarize(self, prompt: str) -> str:
+        """請模型依 prompt 寫出摘要。"""
+
+
+class OpenAIMessageAdapter(HistoryAdapter):
+    """ChatGPT / Grok 的 message dict。"""
+
+    def __init__(self, session, provider: str = "openai"):
+        self.session = session
+        self.provider = provider
+
+    def role(self, item: Dict) -> str:
+        return "model" if item["role"] == "assistant" else item["role"]
+
+    def text(self, item: Dict) -> str:
+        content = item.get("content")
+        if isinstance(content, str):
+            return content
+        return "\n".join(
+            part.get("text", "") for part in content or [] if part.get("type") == "text"
+        )
+
+    def file_keys(self, item: Dict) -> Set[str]:
+        # 附加了檔案的訊息 content 會是 list：圖片為 image_url，文字檔以「檔案名稱:」開頭
+        content = item.get("content")
+        if not isinstance(content, list):
+            return set()
+        keys = set()
+        for part in content:
+            if part.get("type") == "image_url" or part.get("text", "").startswith("檔案名稱:"):
+                data = json.dumps(part, ensure_ascii=False, sort_keys=True)
+                keys.add(hashlib.sha1(data.encode("utf-8")).hexdigest())
+        return keys
+
+    def summary_items(self, summary: str) -> List[Dict]:
+        return [
+            {"role": "user", "content": SUMMARY_PREFIX + summary},
+            {"role": "assistant", "content": SUMMARY_ACK},
+        ]
+
+    def summarize(self, prompt: str) -> str:
+        def call():
+            response = self.session.client.chat.completions.create(
+                model=self.session.model_name,
+                messages=[{"role": "user", "content": prompt}],
+            )
+            usage = response.usage
+            return response.choices[0].message.content or "", usage.total_tokens if usage else None
+
+        return self._call_limited(call, len(prompt))
+
+
+class HistoryPolicy:
+    """所有策略的基底：apply() 回傳整理後的歷史，沒有變動時回傳原本的 list。"""
+
+    def apply(self, history: List[Any], adapter: HistoryAdapter) -> List[Any]:
+        return history
+
+
+class KeepAllPolicy(HistoryPolicy):
+    """保留全部歷史。"""
+
+
+class SlidingWindowPolicy(HistoryPolicy):
+    """
+    超過 token_budget 時，從最舊、未被 pin 的輪次開始丟棄，最近 keep_recent_turns 輪一律保留。
+    """
+
+    def __init__(self, token_budget: int = 120000, keep_recent_turns: int = 2):
+        self.token_budget = token_budget
+        self.keep_recent_turns = keep_recent_turns
+
+    def _turns(self, history: List[Any], adapter: HistoryAdapter) -> List[List[Any]]:
+        """把歷史切成輪次：system 單獨一組，其餘為一個 user 加上後面的 model 回應。"""
+        turns = []
+        for item in history:
+            role = adapter.role(item)
+            if role == "system" or role == "user" or not turns:
+                turns.append([item])
+            elif adapter.role(turns[-1][0]) == "system":
+                turns.append([item])
+            else:
+                turns[-1].append(item)
+        return turns
+
+    def _is_summary(self, turn: List[Any], adapter: HistoryAdapter) -> bool:
+        return adapter.text(turn[0]).startswith(SUMMARY_PREFIX)
+
+    def _pinned(self, turns: List[List[Any]], adapter: HistoryAdapter) -> Set[int]:
+        """系統指令，以及第一次附上某個檔案的輪次。"""
+        pinned = set()
+        seen_files: Set[str] = set()
+        for index, turn in enumerate(turns):
+            if adapter.role(turn[0]) == "system":
+                pinned.add(index)
+                continue
+            keys = set()
+            for item in turn:
+                keys |= adapter.file_keys(item)
+            if keys - seen_files:
+                pinned.add(index)
+                seen_files |= keys
+        return pinned
+
+    def _select(self, history: List[Any], adapter: HistoryAdapter):
+        """回傳 (輪次, 要丟棄的輪次 index 集合)；不需要整理時集合為空。"""
+        turns = self._turns(history, adapter)
+        total = sum(adapter.tokens(item) for item in history)
+        dropped = set()
+        if total <= self.token_budget:
+            return turns, dropped
+
+        pinned = self._pinned(turns, adapter)
+        recent_start = max(0, len(turns) - self.keep_recent_turns)
+        for index, turn in enumerate(turns[:recent_start]):
+            if total <= self.token_budget:
+                break
+            if index in pinned or self._is_summary(turn, adapter):
+                continue
+            dropped.add(index)
+            total -= sum(adapter.tokens(item) for item in turn)
+        return turns, dropped
+
+    def apply(self, history: List[Any], adapter: HistoryAdapter) -> List[Any]:
+        turns, dropped = self._select(history, adapter)
+        if not dropped:
+            return history
+        return [item for index, turn in enumerate(turns) if index not in dropped for item in turn]
+
+
+class SummaryPolicy(SlidingWindowPolicy):
+    """
+    與 SlidingWindowPolicy 相同的挑選方式，但被丟棄的輪次（連同既有的摘要）
+    會由模型濃縮成新的摘要，放在原本最早被丟棄的位置。
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 120000,
+        keep_recent_turns: int = 2,
+        summary_limit: int = 3000,
+    ):
+        super().__init__(token_budget, keep_recent_turns)
+        self.summary_limit = summary_limit
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        # default_history_policy 由多個工作執行緒共用
+        self._lock = threading.Lock()
+
+    def _summarize(self, transcript: str, adapter: HistoryAdapter) -> str:
+        key = hashlib.sha256(transcript.encode("utf-8")).hexdigest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        # 呼叫模型時不持有鎖，其他執行緒的摘要不必排隊等待
+        summary = adapter.summarize(
+            SUMMARY_PROMPT.format(limit=self.summary_limit, transcript=transcript)
+        )
+        with self._lock:
+            self._cache[key] = summary
+            while len(self._cache) > SUMMARY_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return summary
+
+    def apply(self, history: List[Any], adapter: HistoryAdapter) -> List[Any]:
+        turns, dropped = self._select(history, adapter)
+        if not dropped:
+            return history
+
+        # 既有的摘要也併入新的摘要
+        summary_indexes = {
+            index
+            for index, turn in enumerate(turns)
+            if self._is_summary(turn, adapter)
+        }
+        merged = sorted(dropped | summary_indexes)
+        lines = []
+        for index in merged:
+            for item in turns[index]:
+                text = adapter.text(item)
+                if text.startswith(SUMMARY_PREFIX):
+                    lines.append(text[len(SUMMARY_PREFIX):])
+                elif text and text != SUMMARY_ACK:
+                    speaker = "使用者" if adapter.role(item) == "user" else "模型"
+                    lines.append(f"{speaker}：{text}")
+
+        try:
+            summary = self._summarize("\n\n".join(lines), adapter)
+        except Exception as e:
+            # 摘要失敗時退回單純丟棄，至少不會超過預算
+            adapter.log(f"產生歷史摘要失敗，改為直接捨棄舊的對話：{e}")
+            return super().apply(history, adapter)
+
+        result = []
+        for index, turn in enumerate(turns):
+            if index == merged[0]:
+                result.extend(adapter.summary_items(summary))
+            if index not in dropped and index not in summary_indexes:
+                result.extend(turn)
+        return result
+
+
+def policy_from_env() -> HistoryPolicy:
+    """依環境變數建立預設策略。"""
+    name = os.getenv("HISTORY_POLICY", "keep").lower()
+    budget = int(os.getenv("HISTORY_TOKEN_BUDGET", "120000"))
+    keep_turns = int(os.getenv("HISTORY_KEEP_TURNS", "2"))
+    if name == "window":
+        return SlidingWindowPolicy(budget, keep_turns)
+    if name == "summary":
+        return SummaryPolicy(budget, keep_turns)
+    return KeepAllPolicy()
+
+
+# 全域共用的預設策略（SummaryPolicy 的摘要快取因此能跨 session 共用）
+default_history_policy = policy_from_env()
@@ -0,0 +1,296 @@
+# 路線執行的背景工作引擎
+# 執行不再綁在 HTTP 請求上：送出後交給行程內的 worker 池執行，
+# 瀏覽器只是訂閱工作的事件串流，關掉分頁或代理逾時都不會中斷生成，
+# 多個分頁也可以同時觀看同一個工作。
+# 同時執行的工作數可用環境變數 JOB_MAX_WORKERS 設定。
+# 每個事件都有遞增的編號，最近的事件放在記憶體的環狀緩衝區，較舊的寫到磁碟，
+# 斷線的訂閱者可以用 Last-Event-ID 補回漏掉的事件後繼續接收。
+import json
+import os
+import threading
+import time
+import uuid
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "2"))
+# 保留在記憶體中的已結束工作數
+FINISHED_JOBS_KEPT = 50
+# 訂閱者多久沒有收到新事件就送一次心跳（秒）
+HEARTBEAT_INTERVAL = 15
+# 每個工作保留在記憶體中的事件數，超過的寫到 SPILL_DIR
+RING_SIZE = 500
+SPILL_DIR = os.path.join(os.path.dirname(__file__), "job_events")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, ERROR, CANCELLED)
+
+
+class EventLog:
+    """
+    有編號的事件紀錄：最近 ring_size 筆在記憶體，被擠出環狀緩衝區的事件依序附加到磁碟檔。
+    編號從 1 開始連續遞增，磁碟檔中的事件一定比記憶體中的舊。
+    另外記錄每個寫到磁碟的事件在檔案中的位元組位置，補讀舊事件時直接 seek，不必從頭掃描。
+    append / snapshot 需在 Job 的鎖內呼叫；read_spilled 只讀已寫入的部分，可以在鎖外呼叫。
+    """
+
+    def __init__(self, spill_path: str, ring_size: int = RING_SIZE):
+        self.spill_path = spill_path
+        self._ring = deque()
+        self._ring_size = ring_size
+        self.last_id = 0
+        # 第 i 個寫到磁碟的事件（編號 i + 1）在檔案中的起始位置
+        self._offsets = array("q")
+        self._spill_file = None
+
+    def append(self, event: Dict) -> int:
+        self.last_id += 1
+        self._ring.append((self.last_id, event))
+        if len(self._ring) > self._ring_size:
+            self._spill(self._ring.popleft())
+        return self.last_id
+
+    def _spill(self, item: Tuple[int, Dict]):
+        if self._spill_file is None:
+            os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+            self._spill_file = open(self.spill_path, "ab")
+        self._offsets.append(self._spill_file.tell())
+        line = json.dumps({"id": item[0], "event": item[1]}, ensure_ascii=False) + "\n"
+        self._spill_file.write(line.encode("utf-8"))
+        # 讓鎖外的讀取者看得到完整的一行
+        self._spill_file.flush()
+
+    def snapshot(self, after_id: int) -> Tuple[List[Tuple[int, Dict]], Optional[Tuple[int, int]]]:
+        """
+        取出補讀所需的資訊：記憶體中編號大於 after_id 的事件，
+        以及需要從磁碟補讀的範圍 (起始位元組, 結束編號)，不需補讀時為 None。
+        """
+        if after_id >= self.last_id:
+            return [], None
+        first_in_ring = self._ring[0][0] if self._ring else self.last_id + 1
+        spilled = None
+        if after_id + 1 < first_in_ring:
+            spilled = (self._offsets[max(after_id, 0)], first_in_ring)
+        return [item for item in self._ring if item[0] > after_id], spilled
+
+    def read_spilled(self, offset: int, before_id: int) -> List[Tuple[int, Dict]]:
+        """
+        從 offset 開始讀取磁碟上的事件，直到編號 before_id（不含）。
+        暫存檔已被刪除（工作已清除）時視為沒有更多事件。
+        """
+        items = []
+        try:
+            with open(self.spill_path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    if record["id"] >= before_id:
+                        break
+                    items.append((record["id"], record["event"]))
+        except FileNotFoundError:
+            pass
+        return items
+
+    def since(self, after_id: int) -> List[Tuple[int, Dict]]:
+        """回傳編號大於 after_id 的所有事件 (編號, 事件)。"""
+        ring_items, spilled = self.snapshot(after_id)
+        if spilled is None:
+            return ring_items
+        return self.read_spilled(*spilled) + ring_items
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.spill_path):
+            try:
+                os.remove(self.spill_path)
+            except OSError as e:
+                print(f"刪除事件暫存檔失敗：{self.spill_path}，錯誤：{e}")
+
+
+class Job:
+    """
+    一次路線執行。事件為 dict（type / content / ...），依序編號保存在 EventLog 中，
+    訂閱者可以從任何編號之後開始讀取。
+    """
+
+    def __init__(self, meta: Optional[Dict] = None):
+        self.id = uuid.uuid4().hex[:12]
+        self.meta = meta or {}
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.events = EventLog(os.path.join(SPILL_DIR, f"{self.id}.jsonl"))
+        self._cancel = threading.Event()
+        self._cond = threading.Condition()
+        # 正在讀取事件的訂閱者數，有訂閱者時不會被清除
+        self.subscribers = 0
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def publish(self, event: Dict) -> int:
+        with self._cond:
+            event_id = self.events.append(event)
+            self._cond.notify_all()
+        return event_id
+
+    def _set_status(self, status: str):
+        with self._cond:
+            self.status = status
+            if status == RUNNING:
+                self.started_at = time.time()
+            elif status in FINISHED_STATES:
+                self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def subscribe(
+        self, last_event_id: int = 0, idle: float = HEARTBEAT_INTERVAL
+    ) -> Iterator[Tuple[Optional[int], Optional[Dict]]]:
+        """
+        產出編號大於 last_event_id 的事件 (編號, 事件)，先補齊舊的再即時接收，直到工作結束。
+        等待超過 idle 秒仍沒有新事件時產出 (None, None)，讓呼叫端送心跳或送出暫存的內容。
+        """
+        with self._cond:
+            self.subscribers += 1
+        try:
+            yield from self._follow(last_event_id, idle)
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+    def _follow(self, last_event_id: int, idle: float) -> Iterator[Tuple[Optional[int], Optional[Dict]]]:
+        cursor = last_event_id
+        while True:
+            with self._cond:
+                if cursor >= self.events.last_id and not self.finished:
+                    self._cond.wait(idle)
+                batch, spilled = self.events.snapshot(cursor)
+                last_id = self.events.last_id
+                job_finished = self.finished
+
+            # 磁碟上的舊事件在鎖外讀取，補讀很久以前的事件時不會卡住正在發布事件的生成執行緒
+            if spilled is not None:
+                batch = self.events.read_spilled(*spilled) + batch
+            if batch:
+                cursor = batch[-1][0]
+            finished = job_finished and cursor >= last_id
+
+            if not batch and not finished:
+                yield None, None
+            for item in batch:
+                yield item
+            if finished:
+                return
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "meta": self.meta,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "last_event_id": self.events.last_id,
+        }
+
+
+class JobEngine:
+    """
+    以有上限的執行緒池執行工作。task 是一個接收 Job、回傳事件 iterator 的函式；
+    引擎逐一把事件發布給訂閱者，並依最後的事件類型決定工作狀態。
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="route-job"
+        )
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, task: Callable[[Job], Iterable[Dict]], meta: Optional[Dict] = None) -> Job:
+        job = Job(meta)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._run, job, task)
+        return job
+
+    def _run(self, job: Job, task: Callable[[Job], Iterable[Dict]]):
+        if job.cancel_requested:
+            return
+        job._set_status(RUNNING)
+        status = DONE
+        try:
+            for event in task(job):
+                job.publish(event)
+                if event.get("type") == "error":
+                    status = ERROR
+        except Exception as e:
+            print(f"工作 {job.id} 執行失敗：{e}")
+            job.publish({"type": "error", "content": f"工作執行失敗：{e}"})
+            status = ERROR
+        if status == DONE and job.cancel_requested:
+            status = CANCELLED
+        job._set_status(status)
+        with job._cond:
+            job.events.close()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self) -> List[Job]:
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.created_at, reverse=True)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        要求取消工作。排隊中的工作直接結束；執行中的工作會在下一個檢查點（下一個指令之前）停止。
+        """
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return job
+        job._cancel.set()
+        if job.status == QUEUED:
+            job.publish(
+                {
+                    "type": "cancelled",
+                    "content": "工作已在開始前取消。",
+                    "token": job.meta.get("token"),
+                }
+            )
+            job._set_status(CANCELLED)
+        return job
+
+    def _prune(self):
+        # 還有訂閱者在補讀的工作先保留，等下次再清除
+        finished = [job for job in self._jobs.values() if job.finished and not job.subscribers]
+        finished.sort(key=lambda job: job.finished_at or 0)
+        for job in finished[: max(0, len(finished) - FINISHED_JOBS_KEPT)]:
+            job.events.remove()
+            del self._jobs[job.id]
+
+
+# 全域共用的實例
+job_engine = JobEngine()
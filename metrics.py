@@ -0,0 +1,194 @@
+# Prometheus 指標
+# 生成相關的指標都以 provider / model / route 標記，網頁請求以 endpoint / method / status 標記，
+# 由 /metrics 提供給 Prometheus 抓取。
+# prometheus_client 沒有安裝時，所有指標都是不做事的替身，/metrics 回傳 503，其他功能照常。
+# route 標籤由 route_scope() 設定（路線執行期間有效），速率限制器等不知道路線的地方也能取得。
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import Response, request
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST,
+        Counter,
+        Gauge,
+        Histogram,
+        generate_latest,
+    )
+
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+
+LLM_LABELS = ("provider", "model", "route")
+HTTP_LABELS = ("endpoint", "method", "status")
+
+# 目前正在執行的路線，未設定時為空字串
+current_route: ContextVar[str] = ContextVar("current_route", default="")
+
+
+class _NoopMetric:
+    """沒有 prometheus_client 時的替身。"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+
+def _histogram(name, documentation, labelnames, buckets):
+    if not PROMETHEUS_AVAILABLE:
+        return _NoopMetric()
+    return Histogram(name, documentation, labelnames, buckets=buckets)
+
+
+def _counter(name, documentation, labelnames):
+    if not PROMETHEUS_AVAILABLE:
+        return _NoopMetric()
+    return Counter(name, documentation, labelnames)
+
+
+def _gauge(name, documentation, labelnames):
+    if not PROMETHEUS_AVAILABLE:
+        return _NoopMetric()
+    return Gauge(name, documentation, labelnames)
+
+
+time_to_first_token = _histogram(
+    "llm_time_to_first_token_seconds",
+    "送出指令到收到第一個串流片段的時間",
+    LLM_LABELS,
+    (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+tokens_per_second = _histogram(
+    "llm_output_tokens_per_second",
+    "每個指令的輸出速度（輸出與思考 token / 生成時間）",
+    LLM_LABELS,
+    (1, 5, 10, 20, 40, 80, 160, 320),
+)
+prompt_latency = _histogram(
+    "llm_prompt_latency_seconds",
+    "每個指令從送出到回應完成的時間（含重試）",
+    LLM_LABELS,
+    (1, 2, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+retries = _counter(
+    "llm_retries_total",
+    "API 呼叫的重試次數",
+    LLM_LABELS,
+)
+upload_duration = _histogram(
+    "llm_upload_duration_seconds",
+    "路線的檔案上傳到全部可用的時間",
+    LLM_LABELS,
+    (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600),
+)
+rate_limit_wait = _histogram(
+    "llm_rate_limit_wait_seconds",
+    "速率限制器讓請求等待的時間",
+    LLM_LABELS,
+    (0.01, 0.1, 0.5, 1, 5, 10, 30, 60),
+)
+response_cache_lookups = _counter(
+    "llm_response_cache_lookups_total",
+    "回應快取的查詢次數（result 為 hit / miss）",
+    LLM_LABELS + ("result",),
+)
+active_runs = _gauge(
+    "route_active_runs",
+    "執行中的路線數",
+    LLM_LABELS,
+)
+sse_clients = _gauge(
+    "sse_clients",
+    "訂閱工作事件串流的連線數",
+    LLM_LABELS,
+)
+http_request_latency = _histogram(
+    "http_request_duration_seconds",
+    "網頁請求的處理時間（串流回應只計算到開始回傳）",
+    HTTP_LABELS,
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+
+def llm_labels(provider: str, model: str, route: str = None) -> dict:
+    return {
+        "provider": provider or "",
+        "model": model or "",
+        "route": current_route.get() if route is None else (route or ""),
+    }
+
+
+@contextmanager
+def route_scope(route: str):
+    """在這段期間把 route 標籤設為指定的路線。"""
+    token = current_route.set(route or "")
+    try:
+        yield
+    finally:
+        current_route.reset(token)
+
+
+class PromptTimer:
+    """
+    量測單一指令：start() 送出、first_token() 收到第一個片段、finish() 完成。
+    """
+
+    def __init__(self, provider: str, model: str, route: str = None):
+        self.labels = llm_labels(provider, model, route)
+        self.started = time.perf_counter()
+        self.first_token_at = None
+
+    def first_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            time_to_first_token.labels(**self.labels).observe(
+                self.first_token_at - self.started
+            )
+
+    def finish(self, output_tokens: int = 0):
+        now = time.perf_counter()
+        prompt_latency.labels(**self.labels).observe(now - self.started)
+        # 串流時從第一個片段開始計算生成速度，一般模式則以整段時間計算
+        generating = now - (self.first_token_at or self.started)
+        if output_tokens and generating > 0:
+            tokens_per_second.labels(**self.labels).observe(output_tokens / generating)
+
+
+def init_app(app):
+    """註冊網頁請求計時與 /metrics。"""
+
+    @app.before_request
+    def startRequestTimer():
+        request._metrics_started = time.perf_counter()
+
+    @app.after_request
+    def observeRequestLatency(response):
+        started = getattr(request, "_metrics_started", None)
+        if started is not None:
+            http_request_latency.labels(
+                endpoint=request.endpoint or "unknown",
+                method=request.method,
+                status=str(response.status_code),
+            ).observe(time.perf_counter() - started)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        if not PROMETHEUS_AVAILABLE:
+            return Response(
+                "prometheus_client 未安裝，請執行 pip install prometheus-client\n",
+                status=503,
+                mimetype="text/plain",
+            )
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,158 @@
+# 依「供應商 + 模型」共用的速率限制器
+# 以 60 秒滑動視窗追蹤每分鐘請求數 (RPM) 與每分鐘 token 數 (TPM)，
+# 只有在下一次呼叫會超過配額時才等待；同一個行程內的所有執行共用同一份計數。
+# 預設限制可以用 RateLimits.json 覆蓋，格式：
+#   {"gemini:gemini-2.5-pro": {"rpm": 5, "tpm": 250000}, "default": {"rpm": 10, "tpm": 250000}}
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+import metrics
+
+LIMITS_PATH = os.path.join(os.path.dirname(__file__), "RateLimits.json")
+WINDOW_SECONDS = 60
+
+# 預設以免費方案的配額為準
+DEFAULT_LIMITS = {
+    "default": {"rpm": 10, "tpm": 250000},
+    "gemini:gemini-2.5-pro": {"rpm": 2, "tpm": 125000},
+    "gemini:gemini-2.5-flash": {"rpm": 10, "tpm": 250000},
+    "gemini:gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250000},
+    "gemini:gemini-flash-latest": {"rpm": 10, "tpm": 250000},
+    "gemini:gemini-3-flash-preview": {"rpm": 10, "tpm": 250000},
+    "openai:default": {"rpm": 500, "tpm": 200000},
+    "grok:default": {"rpm": 60, "tpm": 100000},
+}
+
+
+def load_limits(path: str = LIMITS_PATH) -> Dict[str, Dict]:
+    limits = {key: dict(value) for key, value in DEFAULT_LIMITS.items()}
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                limits.update(json.load(f))
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"讀取速率限制設定 {path} 失敗，使用預設值：{e}")
+    return limits
+
+
+class RateLimiter:
+    """
+    單一「供應商 + 模型」的 RPM / TPM 滑動視窗限制器。
+    acquire() 會先以估計值佔用額度，呼叫完成後再用 record() 改成實際的 token 數。
+    """
+
+    def __init__(
+        self,
+        rpm: int,
+        tpm: int,
+        window: float = WINDOW_SECONDS,
+        provider: str = "",
+        model_name: str = "",
+    ):
+        self.provider = provider
+        self.model_name = model_name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._events = deque()  # 每筆為 [時間, token 數]
+        self._cond = threading.Condition()
+
+    def _purge(self, now: float):
+        while self._events and self._events[0][0] <= now - self.window:
+            self._events.popleft()
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        self._purge(now)
+        wait = 0.0
+        if self.rpm and len(self._events) >= self.rpm:
+            oldest = self._events[len(self._events) - self.rpm][0]
+            wait = max(wait, oldest + self.window - now)
+
+        if self.tpm and self._events:
+            used = sum(event[1] for event in self._events)
+            # 單次請求就超過 TPM 時，只要求視窗內沒有其他請求
+            over = used + min(tokens, self.tpm) - self.tpm
+            if over > 0:
+                for event in self._events:
+                    over -= event[1]
+                    if over <= 0:
+                        wait = max(wait, event[0] + self.window - now)
+                        break
+        return wait
+
+    def estimate_wait(self, tokens: int = 0) -> float:
+        """預估現在送出 tokens 大小的請求需要等待幾秒（不佔用額度）。"""
+        with self._cond:
+            return self._wait_time(tokens, time.monotonic())
+
+    def acquire(self, tokens: int = 0) -> List:
+        """等到額度足夠後佔用一次請求，回傳的紀錄要交給 record() 更新實際用量。"""
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._wait_time(tokens, now)
+                if wait <= 0:
+                    entry = [now, tokens]
+                    self._events.append(entry)
+                    self._observe_wait(now - started)
+                    return entry
+                self._cond.wait(wait)
+
+    def _observe_wait(self, seconds: float):
+        metrics.rate_limit_wait.labels(
+            **metrics.llm_labels(self.provider, self.model_name)
+        ).observe(seconds)
+
+    async def acquire_async(self, tokens: int = 0) -> List:
+        """acquire() 的 asyncio 版本：等待時讓出事件迴圈，而不是卡住執行緒。"""
+        started = time.monotonic()
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                wait = self._wait_time(tokens, now)
+                if wait <= 0:
+                    entry = [now, tokens]
+                    self._events.append(entry)
+                    self._observe_wait(now - started)
+                    return entry
+            await asyncio.sleep(wait)
+
+    def record(self, entry: List, tokens: Optional[int]):
+        """以實際的 token 用量取代 acquire() 時的估計值。"""
+        if tokens is None:
+            return
+        with self._cond:
+            entry[1] = tokens
+            self._cond.notify_all()
+
+
+_limits = load_limits()
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str, model_name: str) -> RateLimiter:
+    """取得（或建立）某個供應商與模型共用的限制器。"""
+    key = f"{provider}:{model_name}"
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limits = (
+                _limits.get(key)
+                or _limits.get(f"{provider}:default")
+                or _limits["default"]
+            )
+            limiter = RateLimiter(
+                limits.get("rpm", 0),
+                limits.get("tpm", 0),
+                provider=provider,
+                model_name=model_name,
+            )
+            _limiters[key] = limiter
+        return limiter
@@ -0,0 +1,280 @@
+# 模型回應的本機快取（選用）
+# 以「供應商 + 模型 + 生成設定 + 系統指令雜湊 + 對話歷史雜湊 + 指令 + 檔案雜湊」為鍵，
+# 每則回應存成 response_cache/ 下的一個檔案，以檔案的修改時間當作最近使用時間，
+# 總大小超過上限時從最久沒用到的開始刪除 (LRU)。
+# CachedChatSession 包在任一個 session 外面：命中時直接回傳存下的回應並寫進對話歷史，
+# 沒命中時照常呼叫模型，完整收到回應後再存進快取。
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, AsyncGenerator, Callable, Dict, Generator, List, Optional
+
+from file_registry import ManifestLock
+from retry_policy import StreamReset
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "response_cache")
+# 預設是否啟用（每次執行也可以用 useCache 指定）
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "0") == "1"
+# 快取總大小上限（MB）
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", "256"))
+# 命中時串流回傳的每個片段字數（不等待）
+HIT_CHUNK_CHARS = 2000
+ENTRY_SUFFIX = ".json"
+
+
+def _hash_json(value: Any) -> str:
+    text = json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def response_key(
+    provider: str,
+    model: str,
+    config: Any,
+    system_instruction: str,
+    history: List,
+    prompt: str,
+    file_hashes: List[str],
+) -> str:
+    """快取鍵：系統指令與歷史先各自取雜湊，再與其他欄位一起取雜湊。"""
+    return _hash_json(
+        {
+            "provider": provider,
+            "model": model,
+            "config": config,
+            "system": hashlib.sha256((system_instruction or "").encode("utf-8")).hexdigest(),
+            "history": _hash_json(history),
+            "prompt": prompt,
+            "files": file_hashes,
+        }
+    )
+
+
+class ResponseCache:
+    """
+    存在磁碟上的回應快取，多個 worker 共用同一個資料夾。
+    寫入時先寫暫存檔再改名，清理時以檔案鎖避免同時刪除。
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = int(RESPONSE_CACHE_MAX_MB * 1024 * 1024)):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock_path = os.path.join(cache_dir, ".lock")
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ENTRY_SUFFIX)
+
+    def get(self, key: str) -> Optional[str]:
+        """回傳快取的回應，沒有則回傳 None；命中時更新最近使用時間。"""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"讀取回應快取 {path} 失敗，視為未命中：{e}")
+            return None
+        return entry.get("response")
+
+    def put(self, key: str, response: str, meta: Optional[Dict] = None):
+        """存入一則回應，之後依總大小清理最久沒用到的項目。"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = dict(meta or {})
+        entry["response"] = response
+        entry["created"] = time.time()
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"寫入回應快取失敗：{e}")
+            return
+        self.evict()
+
+    def evict(self):
+        """總大小超過 max_bytes 時，依最近使用時間由舊到新刪除。"""
+        with self._lock, ManifestLock(self.lock_path):
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(ENTRY_SUFFIX):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self) -> Dict:
+        if not os.path.isdir(self.cache_dir):
+            return {"entries": 0, "bytes": 0, "max_bytes": self.max_bytes}
+        sizes = [
+            os.path.getsize(os.path.join(self.cache_dir, name))
+            for name in os.listdir(self.cache_dir)
+            if name.endswith(ENTRY_SUFFIX)
+        ]
+        return {"entries": len(sizes), "bytes": sum(sizes), "max_bytes": self.max_bytes}
+
+
+class CachedChatSession:
+    """
+    在 session 前面加上回應快取，介面與原本的 session 相同，其餘屬性直接轉給原 session。
+    原 session 需提供 cache_identity()（鍵的內容）與 record_exchange()（命中時寫入歷史）。
+
+    Args:
+        session: GeminiChatSession、ChatGPTChatSession 等。
+        cache (ResponseCache): 使用的快取。
+        force_fresh (bool): 不讀取快取，一律呼叫模型（結果仍會寫回快取）。
+        file_hashes (Optional[Dict[str, str]]): 已上傳檔案的 URI -> 內容雜湊；
+            檔案重新上傳後 URI 會改變，鍵改用內容雜湊才能命中。
+        should_store (Optional[Callable[[str], bool]]): 判斷回應能否存入快取（例如排除錯誤訊息）。
+    """
+
+    def __init__(
+        self,
+        session: Any,
+        cache: Optional[ResponseCache] = None,
+        force_fresh: bool = False,
+        file_hashes: Optional[Dict[str, str]] = None,
+        should_store: Optional[Callable[[str], bool]] = None,
+    ):
+        self.__dict__["session"] = session
+        self.__dict__["cache"] = cache or response_cache
+        self.__dict__["force_fresh"] = force_fresh
+        self.__dict__["file_hashes"] = dict(file_hashes or {})
+        self.__dict__["should_store"] = should_store or (lambda text: bool(text))
+        # 最近一次送出是否由快取回應
+        self.__dict__["last_cached"] = False
+        self.__dict__["hits"] = 0
+        self.__dict__["misses"] = 0
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def __setattr__(self, name, value):
+        # on_retry 等設定要設在原 session 上
+        if name in self.__dict__:
+            self.__dict__[name] = value
+        else:
+            setattr(self.session, name, value)
+
+    def _file_hash(self, file_obj: Any) -> str:
+        uri = file_obj.get("uri") if isinstance(file_obj, dict) else getattr(file_obj, "uri", None)
+        if uri in self.file_hashes:
+            return self.file_hashes[uri]
+        if isinstance(file_obj, dict):
+            # OpenAI 的檔案直接內嵌在訊息中
+            return _hash_json(file_obj)
+        return uri or ""
+
+    def _stable_history(self, history: Any) -> Any:
+        """把歷史中的檔案 URI 換成內容雜湊。"""
+        if isinstance(history, dict):
+            return {
+                k: self.file_hashes.get(v, v) if k == "uri" else self._stable_history(v)
+                for k, v in history.items()
+            }
+        if isinstance(history, list):
+            return [self._stable_history(item) for item in history]
+        return history
+
+    def _key(self, prompt: str, uploaded_files: Optional[List]) -> str:
+        identity = self.session.cache_identity()
+        return response_key(
+            identity["provider"],
+            identity["model"],
+            identity["config"],
+            identity["system_instruction"],
+            self._stable_history(identity["history"]),
+            prompt,
+            [self._file_hash(f) for f in uploaded_files or []],
+        )
+
+    def _lookup(self, prompt: str, uploaded_files: Optional[List]):
+        """回傳 (鍵, 快取的回應)；不使用快取或未命中時回應為 None。"""
+        key = self._key(prompt, uploaded_files)
+        cached = None if self.force_fresh else self.cache.get(key)
+        self.__dict__["last_cached"] = cached is not None
+        if cached is not None:
+            self.__dict__["hits"] += 1
+            self.session.record_exchange(prompt, uploaded_files, cached)
+        else:
+            self.__dict__["misses"] += 1
+        return key, cached
+
+    def _store(self, key: str, response: Optional[str]):
+        if response and self.should_store(response):
+            identity = self.session.cache_identity()
+            self.cache.put(key, response, {"provider": identity["provider"], "model": identity["model"]})
+
+    def _pieces(self, text: str) -> List[str]:
+        return [text[i : i + HIT_CHUNK_CHARS] for i in range(0, len(text), HIT_CHUNK_CHARS)]
+
+    def send_message(self, prompt: str, uploaded_files: Optional[List] = None):
+        key, cached = self._lookup(prompt, uploaded_files)
+        if cached is not None:
+            return cached
+        response = self.session.send_message(prompt, uploaded_files)
+        self._store(key, response)
+        return response
+
+    def send_message_stream(self, prompt: str, uploaded_files: Optional[List] = None) -> Generator:
+        key, cached = self._lookup(prompt, uploaded_files)
+        if cached is not None:
+            yield from self._pieces(cached)
+            return
+        received = []
+        for chunk in self.session.send_message_stream(prompt, uploaded_files):
+            if isinstance(chunk, StreamReset):
+                received = []
+            elif chunk:
+                received.append(chunk)
+            yield chunk
+        # 只有完整收完的回應才存（呼叫端中途停止時不會走到這裡）
+        self._store(key, "".join(received))
+
+    async def send_message_async(self, prompt: str, uploaded_files: Optional[List] = None):
+        key, cached = self._lookup(prompt, uploaded_files)
+        if cached is not None:
+            return cached
+        response = await self.session.send_message_async(prompt, uploaded_files)
+        self._store(key, response)
+        return response
+
+    async def send_message_stream_async(self, prompt: str, uploaded_files: Optional[List] = None) -> AsyncGenerator:
+        key, cached = self._lookup(prompt, uploaded_files)
+        if cached is not None:
+            for piece in self._pieces(cached):
+                yield piece
+            return
+        received = []
+        async for chunk in self.session.send_message_stream_async(prompt, uploaded_files):
+            if isinstance(chunk, StreamReset):
+                received = []
+            elif chunk:
+                received.append(chunk)
+            yield chunk
+        self._store(key, "".join(received))
+
+
+# 全域共用的實例
+response_cache = ResponseCache()
@@ -0,0 +1,188 @@
+# 每條路線 Response 資料夾的索引（路線資料夾下的 response_manifest.json）
+# 記錄每個回應檔的檔名、建立時間、大小、字數、回應段數、模型與 token 總數，
+# 歷史清單直接讀索引分頁排序，不必每次 listdir + getctime 再重新解析時間。
+# 執行寫完回應檔時呼叫 record() 更新；資料夾有其他異動（手動刪檔、複製）時，
+# 下次讀取會發現資料夾的修改時間不同，只補算新增的檔案、移除消失的檔案。
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from file_registry import ManifestLock
+from response_writer import PARTIAL_SUFFIX, SEPARATOR, is_partial
+from token_usage import usage_path
+
+# 放在 Response 的上一層，寫入索引時不會改變 Response 資料夾的修改時間
+MANIFEST_NAME = "response_manifest.json"
+# 可排序的欄位
+SORT_KEYS = ("createtime", "filename", "size", "chars", "segments", "tokens")
+
+
+def is_response_file(filename: str) -> bool:
+    lower_name = filename.lower()
+    return lower_name.endswith(".txt") or lower_name.endswith(".txt" + PARTIAL_SUFFIX)
+
+
+def scan_response(path: str) -> Dict:
+    """讀取單一回應檔（與用量紀錄）產生索引項目。"""
+    filename = os.path.basename(path)
+    stat = os.stat(path)
+    entry = {
+        "filename": filename,
+        "ctime": stat.st_ctime,
+        "createtime": datetime.fromtimestamp(stat.st_ctime).strftime("%Y-%m-%d %H:%M:%S"),
+        "size": stat.st_size,
+        "chars": None,
+        "segments": None,
+        "model": None,
+        "tokens": None,
+        "incomplete": is_partial(filename),
+    }
+    if entry["incomplete"]:
+        # 執行中的檔案還會變動，等完成後再計算
+        return entry
+
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        content = f.read()
+    entry["segments"] = content.count(SEPARATOR)
+    entry["chars"] = len(content) - entry["segments"] * len(SEPARATOR)
+
+    usage_file = usage_path(path)
+    if os.path.exists(usage_file):
+        try:
+            with open(usage_file, "r", encoding="utf-8") as f:
+                usage = json.load(f)
+            entry["model"] = usage.get("model")
+            entry["tokens"] = usage.get("summary", {}).get("totals", {}).get("total")
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"讀取用量紀錄 {usage_file} 失敗：{e}")
+    return entry
+
+
+class ResponseIndex:
+    """
+    各路線 Response 資料夾的 response_manifest.json，多個 worker 以檔案鎖共用。
+    同一個行程內另外保留已載入的索引與排序結果，資料夾與 manifest 都沒變時直接沿用。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 資料夾路徑 -> {"stamp": (資料夾 mtime, manifest mtime), "entries": {...}, "sorted": {...}}
+        self._loaded: Dict[str, Dict] = {}
+
+    def _manifest_path(self, response_dir: str) -> str:
+        return os.path.join(os.path.dirname(os.path.abspath(response_dir)), MANIFEST_NAME)
+
+    def _read(self, response_dir: str) -> Dict:
+        path = self._manifest_path(response_dir)
+        if not os.path.exists(path):
+            return {"dir_mtime": None, "entries": {}}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"讀取回應索引 {path} 失敗，將重新建立：{e}")
+            return {"dir_mtime": None, "entries": {}}
+
+    def _write(self, response_dir: str, manifest: Dict):
+        path = self._manifest_path(response_dir)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _reconcile(self, response_dir: str, manifest: Dict):
+        """讓索引與資料夾內容一致：補算新增或未完成的檔案，移除已消失的檔案。"""
+        # 先取時間再列出檔案，列出期間若有異動，下次讀取時會再補一次
+        manifest["dir_mtime"] = os.stat(response_dir).st_mtime
+        entries = manifest["entries"]
+        present = {name for name in os.listdir(response_dir) if is_response_file(name)}
+        for name in list(entries):
+            if name not in present:
+                del entries[name]
+        for name in present:
+            if name in entries and not entries[name]["incomplete"]:
+                continue
+            try:
+                entries[name] = scan_response(os.path.join(response_dir, name))
+            except FileNotFoundError:
+                entries.pop(name, None)
+
+    def _load(self, response_dir: str) -> Optional[Dict]:
+        """回傳最新的索引，資料夾有異動時先補齊；資料夾不存在時回傳 None。"""
+        if not os.path.isdir(response_dir):
+            return None
+        dir_mtime = os.stat(response_dir).st_mtime
+        manifest_path = self._manifest_path(response_dir)
+        with self._lock:
+            loaded = self._loaded.get(response_dir)
+            if loaded is not None and os.path.exists(manifest_path):
+                if loaded["stamp"] == (dir_mtime, os.stat(manifest_path).st_mtime):
+                    return loaded
+        with ManifestLock(manifest_path + ".lock"):
+            manifest = self._read(response_dir)
+            if manifest.get("dir_mtime") != dir_mtime:
+                self._reconcile(response_dir, manifest)
+                self._write(response_dir, manifest)
+            stamp = (manifest["dir_mtime"], os.stat(manifest_path).st_mtime)
+        loaded = {"stamp": stamp, "entries": manifest["entries"], "sorted": {}}
+        with self._lock:
+            self._loaded[response_dir] = loaded
+        return loaded
+
+    def record(self, response_path: str):
+        """執行完成、回應檔改名為正式檔後呼叫，更新這個檔案的索引。"""
+        response_dir = os.path.dirname(response_path)
+        manifest_path = self._manifest_path(response_dir)
+        try:
+            with ManifestLock(manifest_path + ".lock"):
+                manifest = self._read(response_dir)
+                # 先補齊其他異動，再以這次的檔案覆寫（含 .partial 改名）
+                self._reconcile(response_dir, manifest)
+                manifest["entries"].pop(os.path.basename(response_path) + PARTIAL_SUFFIX, None)
+                manifest["entries"][os.path.basename(response_path)] = scan_response(response_path)
+                self._write(response_dir, manifest)
+        except Exception as e:
+            print(f"更新回應索引失敗，下次讀取時重建：{e}")
+
+    def remove(self, response_dir: str, filenames: List[str]):
+        """刪除檔案後同步移除索引項目。"""
+        manifest_path = self._manifest_path(response_dir)
+        if not os.path.exists(manifest_path):
+            return
+        with ManifestLock(manifest_path + ".lock"):
+            manifest = self._read(response_dir)
+            for name in filenames:
+                manifest["entries"].pop(name, None)
+            self._write(response_dir, manifest)
+
+    def page(
+        self,
+        response_dir: str,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        sort: str = "createtime",
+        descending: bool = True,
+    ) -> Dict:
+        """依 sort 排序後取出 offset 起的 limit 筆；同一份索引的排序結果會保留重用。"""
+        if sort not in SORT_KEYS:
+            raise ValueError(f"不支援的排序欄位：{sort}")
+        loaded = self._load(response_dir)
+        if loaded is None:
+            return {"total": 0, "offset": offset, "items": []}
+        order = loaded["sorted"].get((sort, descending))
+        if order is None:
+            field = "ctime" if sort == "createtime" else sort
+            # 沒有數值的項目（例如未完成的檔案）一律排在最後
+            present = [e for e in loaded["entries"].values() if e[field] is not None]
+            missing = [e for e in loaded["entries"].values() if e[field] is None]
+            present.sort(key=lambda e: (e[field], e["filename"]), reverse=descending)
+            order = present + missing
+            loaded["sorted"][(sort, descending)] = order
+        end = None if limit is None else offset + limit
+        return {"total": len(order), "offset": offset, "items": order[offset:end]}
+
+
+# 全域共用的實例
+response_index = ResponseIndex()
@@ -0,0 +1,229 @@
+# 大型回應檔的分段讀取
+# 以 mmap 掃描回應檔中的分隔線，記錄每一段（每則回應）的位元組起訖，並每 64KB 記錄一次累計字數，
+# 之後可以只讀取第 N 段、某個位元組範圍或字元範圍，不必把整本小說讀進記憶體再轉成一個 JSON 字串。
+# 索引依 (路徑, 大小, 修改時間) 快取，檔案有變動（例如仍在寫入的 .partial）時自動重建。
+import bisect
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Generator, List, Optional, Tuple
+
+from response_writer import SEPARATOR
+
+SEPARATOR_BYTES = SEPARATOR.encode("utf-8")
+# 每隔多少位元組記錄一次累計字數
+CHAR_BLOCK = 64 * 1024
+# 串流回傳時每個片段的位元組數
+STREAM_CHUNK = 64 * 1024
+# 同時保留幾個檔案的索引
+SEGMENT_INDEX_CACHE_SIZE = 64
+# UTF-8 的後續位元組 (10xxxxxx)，不算一個字元
+_CONTINUATION = bytes(range(0x80, 0xC0))
+
+
+def _char_count(data: bytes) -> int:
+    """UTF-8 位元組中的字元數（去掉後續位元組後的長度）。"""
+    return len(data.translate(None, _CONTINUATION))
+
+
+def _is_continuation(byte: int) -> bool:
+    return 0x80 <= byte < 0xC0
+
+
+class SegmentIndex:
+    """單一回應檔的索引：各段的位元組起訖，以及每個 CHAR_BLOCK 開頭之前的累計字數。"""
+
+    def __init__(self, path: str, size: int, mtime: float, segments: List[Tuple[int, int]], block_chars: List[int], total_chars: int):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.segments = segments
+        self.block_chars = block_chars
+        self.total_chars = total_chars
+
+    @classmethod
+    def build(cls, path: str, mm, size: int, mtime: float) -> "SegmentIndex":
+        segments = []
+        start = 0
+        while True:
+            found = mm.find(SEPARATOR_BYTES, start)
+            if found < 0:
+                break
+            segments.append((start, found))
+            start = found + len(SEPARATOR_BYTES)
+        # 最後一個分隔線之後還有內容（例如執行中的檔案）也算一段
+        if start < size:
+            segments.append((start, size))
+
+        block_chars = []
+        total = 0
+        for block_start in range(0, size, CHAR_BLOCK):
+            block_chars.append(total)
+            total += _char_count(mm[block_start : block_start + CHAR_BLOCK])
+        return cls(path, size, mtime, segments, block_chars, total)
+
+    def byte_to_char(self, mm, offset: int) -> int:
+        """位元組位置之前有幾個字元。"""
+        if offset >= self.size:
+            return self.total_chars
+        block = offset // CHAR_BLOCK
+        return self.block_chars[block] + _char_count(mm[block * CHAR_BLOCK : offset])
+
+    def char_to_byte(self, mm, char_offset: int) -> int:
+        """第 char_offset 個字元在檔案中的位元組位置。"""
+        if char_offset >= self.total_chars:
+            return self.size
+        block = bisect.bisect_right(self.block_chars, char_offset) - 1
+        remaining = char_offset - self.block_chars[block]
+        position = block * CHAR_BLOCK
+        # 在區塊內逐一找字元開頭的位元組（區塊開頭可能是上一個字元的後續位元組）
+        while True:
+            if not _is_continuation(mm[position]):
+                if remaining == 0:
+                    return position
+                remaining -= 1
+            position += 1
+
+    def describe(self, mm) -> List[dict]:
+        """每一段的位元組與字元範圍，給前端決定要載入哪一段。"""
+        return [
+            {
+                "index": i,
+                "start": start,
+                "end": end,
+                "char_start": self.byte_to_char(mm, start),
+                "char_end": self.byte_to_char(mm, end),
+            }
+            for i, (start, end) in enumerate(self.segments)
+        ]
+
+
+class ResponseReader:
+    """
+    以 mmap 讀取回應檔的一段或一個範圍，並快取各檔案的 SegmentIndex。
+    """
+
+    def __init__(self, max_entries: int = SEGMENT_INDEX_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._indexes: "OrderedDict[str, SegmentIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _open(self, path: str):
+        """回傳 (檔案, mmap)；空檔案無法 mmap，回傳的 mmap 為 b""。"""
+        f = open(path, "rb")
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                return f, b""
+            return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            f.close()
+            raise
+
+    def _close(self, f, mm):
+        if isinstance(mm, mmap.mmap):
+            mm.close()
+        f.close()
+
+    def _index(self, path: str, f, mm) -> SegmentIndex:
+        stat = os.fstat(f.fileno())
+        with self._lock:
+            index = self._indexes.get(path)
+            if index is not None and index.size == stat.st_size and index.mtime == stat.st_mtime:
+                self._indexes.move_to_end(path)
+                return index
+        index = SegmentIndex.build(path, mm, stat.st_size, stat.st_mtime)
+        with self._lock:
+            self._indexes[path] = index
+            self._indexes.move_to_end(path)
+            while len(self._indexes) > self.max_entries:
+                self._indexes.popitem(last=False)
+        return index
+
+    def _align(self, mm, size: int, offset: int) -> int:
+        """把位元組位置往後移到字元開頭，避免切在 UTF-8 字元中間。"""
+        offset = min(max(offset, 0), size)
+        while offset < size and _is_continuation(mm[offset]):
+            offset += 1
+        return offset
+
+    def outline(self, path: str) -> dict:
+        f, mm = self._open(path)
+        try:
+            index = self._index(path, f, mm)
+            return {
+                "size": index.size,
+                "chars": index.total_chars,
+                "segments": index.describe(mm),
+            }
+        finally:
+            self._close(f, mm)
+
+    def read_segment(self, path: str, number: int) -> Optional[dict]:
+        """第 number 段（從 0 開始）的內容；超出範圍時回傳 None。"""
+        f, mm = self._open(path)
+        try:
+            index = self._index(path, f, mm)
+            if not 0 <= number < len(index.segments):
+                return None
+            start, end = index.segments[number]
+            return {
+                "index": number,
+                "count": len(index.segments),
+                "start": start,
+                "end": end,
+                "content": mm[start:end].decode("utf-8", errors="replace"),
+            }
+        finally:
+            self._close(f, mm)
+
+    def read_range(self, path: str, start: int, end: Optional[int] = None, unit: str = "byte") -> dict:
+        """
+        讀取一個範圍。unit 為 "byte" 時 start / end 是位元組位置（會對齊到字元開頭），
+        為 "char" 時是字元位置。回傳的 start / end 與 unit 相同，可直接當作下一頁的起點。
+        """
+        if unit not in ("byte", "char"):
+            raise ValueError(f"不支援的單位：{unit}")
+        f, mm = self._open(path)
+        try:
+            index = self._index(path, f, mm)
+            if unit == "char":
+                total = index.total_chars
+                start = min(max(start, 0), total)
+                end = total if end is None else min(max(end, start), total)
+                byte_start = index.char_to_byte(mm, start)
+                byte_end = index.char_to_byte(mm, end)
+            else:
+                total = index.size
+                start = byte_start = self._align(mm, index.size, start)
+                end = byte_end = self._align(mm, index.size, index.size if end is None else max(end, start))
+            return {
+                "unit": unit,
+                "start": start,
+                "end": end,
+                "total": total,
+                "content": mm[byte_start:byte_end].decode("utf-8", errors="replace"),
+            }
+        finally:
+            self._close(f, mm)
+
+    def iter_chunks(self, path: str, segment: Optional[int] = None, chunk_size: int = STREAM_CHUNK) -> Generator[bytes, None, None]:
+        """逐塊產生整個檔案（或第 segment 段）的內容，用於串流回應；每塊都在字元邊界切開。"""
+        f, mm = self._open(path)
+        try:
+            index = self._index(path, f, mm)
+            start, end = 0, index.size
+            if segment is not None:
+                if not 0 <= segment < len(index.segments):
+                    return
+                start, end = index.segments[segment]
+            while start < end:
+                stop = min(self._align(mm, end, start + chunk_size), end)
+                yield bytes(mm[start:stop])
+                start = stop
+        finally:
+            self._close(f, mm)
+
+
+# 全域共用的實例
+response_reader = ResponseReader()
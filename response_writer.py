@@ -0,0 +1,120 @@
+# 執行中逐段寫入回應檔
+# 生成的文字一收到就附加到 response_*.txt.partial，不再整份留在記憶體；
+# fsync 依累積位元組數或間隔時間批次進行，每個指令完成後寫入分隔線，
+# 全部完成時再以 os.replace 原子地改名成正式檔名。
+# 中途當掉時 .partial 會留在 Response 資料夾，歷史清單會標示為未完成。
+import os
+import time
+
+SEPARATOR = "\n\n====================回應分隔線====================\n\n"
+PARTIAL_SUFFIX = ".partial"
+# 累積超過這麼多位元組或經過這麼多秒就 fsync 一次
+FSYNC_BYTES = 64 * 1024
+FSYNC_INTERVAL = 2.0
+
+
+def is_partial(filename: str) -> bool:
+    return filename.endswith(PARTIAL_SUFFIX)
+
+
+class ResponseWriter:
+    """
+    單次執行的回應檔。write() 附加目前回應的片段，end_response() 結束一則回應並寫入分隔線，
+    rollback_response() 丟棄尚未結束的那則回應，commit() 完成後改名為正式檔。
+    """
+
+    def __init__(
+        self,
+        final_path: str,
+        fsync_bytes: int = FSYNC_BYTES,
+        fsync_interval: float = FSYNC_INTERVAL,
+    ):
+        self.final_path = final_path
+        self.partial_path = final_path + PARTIAL_SUFFIX
+        self.fsync_bytes = fsync_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        self._file = open(self.partial_path, "wb")
+        # 目前這則回應在檔案中的起點
+        self._response_start = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self.response_count = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._file is None or self._file.closed
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def write(self, text: str):
+        if not text:
+            return
+        data = text.encode("utf-8")
+        self._file.write(data)
+        self._unsynced += len(data)
+        if (
+            self._unsynced >= self.fsync_bytes
+            or time.monotonic() - self._last_sync >= self.fsync_interval
+        ):
+            self._sync()
+
+    def end_response(self):
+        """目前的回應已完整，寫入分隔線並落盤。"""
+        self.write(SEPARATOR)
+        self._sync()
+        self._response_start = self._file.tell()
+        self.response_count += 1
+
+    @property
+    def completed_bytes(self) -> int:
+        """已完成（含分隔線）的回應在檔案中的位元組數。"""
+        return self._response_start
+
+    def prefill(self, source_path: str, length: int, count: int):
+        """接續執行時，先把先前完成的 length 位元組回應（共 count 則）複製進來。"""
+        with open(source_path, "rb") as src:
+            remaining = length
+            while remaining > 0:
+                data = src.read(min(remaining, 1024 * 1024))
+                if not data:
+                    raise ValueError(f"{source_path} 的內容比檢查點記錄的短")
+                self._file.write(data)
+                remaining -= len(data)
+        self._sync()
+        self._response_start = self._file.tell()
+        self.response_count += count
+
+    def rollback_response(self):
+        """丟棄目前尚未結束的回應（串流重來或回應判定為錯誤時）。"""
+        self._file.flush()
+        self._file.truncate(self._response_start)
+        self._file.seek(self._response_start)
+
+    def commit(self) -> str:
+        """丟棄未完成的回應後，把 .partial 改名成正式檔，回傳正式檔路徑。"""
+        self.rollback_response()
+        self._sync()
+        self._file.close()
+        os.replace(self.partial_path, self.final_path)
+        return self.final_path
+
+    def discard(self):
+        """沒有任何完成的回應時，直接刪除 .partial。"""
+        self.close()
+        try:
+            os.remove(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        """保留 .partial（例如發生未預期錯誤時），只關閉檔案。"""
+        if not self.closed:
+            try:
+                self._sync()
+            finally:
+                self._file.close()
@@ -0,0 +1,250 @@
+# 三個 ChatSession 共用的重試策略
+# 依供應商分類錯誤是否可重試，採指數退避加上隨機抖動 (jitter)，
+# 並優先採用伺服器回傳的 retry_delay / Retry-After；整體另有總時限。
+# 每次重試都會產生一筆結構化事件，交給呼叫端（例如 SSE 日誌）顯示。
+import random
+import re
+import time
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# 可重試的 HTTP 狀態碼
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# 連線層級的錯誤（httpx / requests / 內建），以類別名稱判斷，避免硬性相依
+TRANSPORT_ERRORS = {
+    "TimeoutException",
+    "TransportError",
+    "ConnectError",
+    "ReadError",
+    "RemoteProtocolError",
+    "APIConnectionError",
+    "APITimeoutError",
+    "ConnectionError",
+    "TimeoutError",
+}
+# 舊版 google.api_core 的可重試例外
+LEGACY_GOOGLE_RETRYABLE = {
+    "InternalServerError",
+    "DeadlineExceeded",
+    "ResourceExhausted",
+    "ServiceUnavailable",
+    "TooManyRequests",
+}
+# 就算重試也不會成功的配額錯誤
+NON_RETRYABLE_MARKERS = (
+    "PerDay",
+    "insufficient_quota",
+)
+
+
+def _parse_duration(value: Any) -> Optional[float]:
+    """把 '37s'、'1.5s'、數字或 timedelta 轉成秒數。"""
+    if value is None:
+        return None
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    if hasattr(value, "total_seconds"):
+        return value.total_seconds()
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r"\s*([0-9.]+)\s*s?\s*", str(value))
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def _find_retry_delay(details: Any) -> Optional[float]:
+    """在 Google API 的錯誤細節中遞迴尋找 RetryInfo.retryDelay。"""
+    if isinstance(details, dict):
+        for key in ("retryDelay", "retry_delay"):
+            if key in details:
+                return _parse_duration(details[key])
+        for value in details.values():
+            found = _find_retry_delay(value)
+            if found is not None:
+                return found
+    elif isinstance(details, list):
+        for value in details:
+            found = _find_retry_delay(value)
+            if found is not None:
+                return found
+    return None
+
+
+def _retry_after_header(response: Any) -> Optional[float]:
+    """讀取 HTTP 回應的 retry-after-ms / retry-after 標頭。"""
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+                return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+def _class_names(exc: BaseException):
+    return {cls.__name__ for cls in type(exc).__mro__}
+
+
+def classify_error(provider: str, exc: BaseException) -> Tuple[bool, Optional[float], str]:
+    """
+    判斷錯誤是否值得重試。
+
+    Returns:
+        Tuple[bool, Optional[float], str]: (是否可重試, 伺服器建議的等待秒數, 原因說明)
+    """
+    message = str(exc)
+    if any(marker in message for marker in NON_RETRYABLE_MARKERS):
+        return False, None, "配額已用盡"
+
+    names = _class_names(exc)
+
+    if provider == "gemini":
+        # google.genai.errors.APIError：code 為 HTTP 狀態碼，details 為錯誤內容
+        code = getattr(exc, "code", None)
+        if isinstance(code, int):
+            hint = _find_retry_delay(getattr(exc, "details", None))
+            if hint is None:
+                hint = _retry_after_header(getattr(exc, "response", None))
+            return code in RETRYABLE_STATUS, hint, f"HTTP {code}"
+        # 舊版 google.api_core 的例外
+        if names & LEGACY_GOOGLE_RETRYABLE:
+            return True, _parse_duration(getattr(exc, "retry_delay", None)), type(exc).__name__
+    else:
+        # openai.APIStatusError：status_code 為 HTTP 狀態碼
+        status = getattr(exc, "status_code", None)
+        if isinstance(status, int):
+            hint = _retry_after_header(getattr(exc, "response", None))
+            return status in RETRYABLE_STATUS, hint, f"HTTP {status}"
+
+    if names & TRANSPORT_ERRORS:
+        return True, None, type(exc).__name__
+    return False, None, type(exc).__name__
+
+
+class RetryPolicy:
+    """
+    指數退避 + 抖動的重試策略。
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 2.0,
+        max_delay: float = 60.0,
+        max_server_delay: float = 120.0,
+        deadline: float = 600.0,
+        jitter: float = 0.5,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_server_delay = max_server_delay
+        self.deadline = deadline
+        self.jitter = jitter
+
+    def compute_delay(self, attempt: int, server_hint: Optional[float] = None) -> float:
+        """第 attempt 次失敗後要等待的秒數；有伺服器建議時以其為準。"""
+        if server_hint is not None:
+            delay = min(server_hint, self.max_server_delay)
+            return delay + random.uniform(0, self.base_delay * self.jitter)
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+
+    def begin(
+        self,
+        provider: str,
+        model_name: str = "",
+        on_retry: Optional[Callable[[Dict], None]] = None,
+    ) -> "RetryState":
+        """開始一次呼叫的重試追蹤。"""
+        return RetryState(self, provider, model_name, on_retry)
+
+
+class RetryState:
+    """
+    單次呼叫的重試狀態：記錄失敗次數與開始時間，決定下一次要等多久。
+    """
+
+    def __init__(self, policy: RetryPolicy, provider: str, model_name: str, on_retry):
+        self.policy = policy
+        self.provider = provider
+        self.model_name = model_name
+        self.on_retry = on_retry
+        self.attempt = 0
+        self.started = time.monotonic()
+        # 放棄的原因為「重試次數或時限用完」時為 True，「錯誤本身不可重試」時為 False
+        self.exhausted = False
+
+    def next_delay(self, exc: BaseException) -> Optional[float]:
+        """
+        記錄一次失敗並回傳下一次重試前要等待的秒數；不應再重試時回傳 None。
+        """
+        self.attempt += 1
+        retryable, hint, reason = classify_error(self.provider, exc)
+        if not retryable:
+            return None
+
+        if self.attempt >= self.policy.max_attempts:
+            self.exhausted = True
+            return None
+
+        delay = self.policy.compute_delay(self.attempt, hint)
+        elapsed = time.monotonic() - self.started
+        if elapsed + delay > self.policy.deadline:
+            self.exhausted = True
+            return None
+
+        event = {
+            "provider": self.provider,
+            "model": self.model_name,
+            "attempt": self.attempt,
+            "max_attempts": self.policy.max_attempts,
+            "delay": round(delay, 2),
+            "server_delay": hint,
+            "reason": reason,
+            "error": str(exc)[:500],
+        }
+        if self.on_retry is not None:
+            try:
+                self.on_retry(event)
+            except Exception as e:
+                print(f"回報重試事件時發生錯誤: {e}")
+        return delay
+
+
+class StreamReset:
+    """
+    串流在中途失敗、準備從頭重試時送出的標記。
+    呼叫端收到後應丟棄這次回應已經收到的部分內容。
+    """
+
+    def __repr__(self):
+        return "StreamReset()"
+
+
+# 串流中途失敗時的處理方式：
+#   "continue"：保留已收到的內容，請模型從中斷處接續
+#   "reset"：送出 StreamReset，丟棄已收到的內容後整段重來
+STREAM_RESUME_MODES = ("continue", "reset")
+DEFAULT_STREAM_RESUME_MODE = "continue"
+# 接續生成時附加的指示
+CONTINUATION_PROMPT = "（連線中斷）請從上一則回應最後一個字之後直接接續輸出，不要重複已經寫過的內容，也不要加上任何說明。"
+
+
+# 預設共用的策略
+default_retry_policy = RetryPolicy()
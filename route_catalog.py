@@ -0,0 +1,83 @@
+# 路線資料的共用載入器
+# 資料來源為 route_store (SQLite) 加上 route_journal 中尚未壓縮的異動，
+# 組合後的路線會保留在記憶體中並以 id 建立索引；
+# 只有在資料庫的 revision 或日誌大小改變時才會重新讀取。
+import copy
+import threading
+from typing import Any, Dict, List, Optional
+
+from route_journal import RouteJournal, route_journal
+from route_store import RouteStore, route_store
+
+
+class RouteCatalog:
+    """
+    路線資料的行程內快取。
+    所有 Blueprint 都透過這個類別取得路線資料，避免每次請求都重新讀取整份資料。
+    """
+
+    def __init__(
+        self, store: RouteStore = route_store, journal: RouteJournal = route_journal
+    ):
+        self.store = store
+        self.journal = journal
+        self._lock = threading.Lock()
+        self._signature = None
+        self._routes: List[Dict] = []
+        self._index: Dict[str, Dict] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _reload_if_changed(self):
+        """資料有變動時重新載入，回傳目前的路線清單；讀取失敗時回傳 None。"""
+        try:
+            signature = (self.store.revision(), self.journal.signature())
+        except Exception as e:
+            print(f"錯誤：讀取路線資料庫 {self.store.db_path} 失敗：{e}")
+            return None
+
+        with self._lock:
+            if signature == self._signature:
+                self.hits += 1
+                return self._routes
+
+            self.misses += 1
+            try:
+                routes = self.journal.apply_pending(self.store.list_routes())
+            except Exception as e:
+                print(f"錯誤：讀取路線資料庫 {self.store.db_path} 失敗：{e}")
+                return None
+
+            self._routes = routes
+            self._index = {str(item["id"]): item for item in routes}
+            self._signature = signature
+            return self._routes
+
+    def get_routes(self) -> Optional[List[Dict]]:
+        """回傳所有路線；回傳的是共用物件，呼叫端不可修改。"""
+        return self._reload_if_changed()
+
+    def get_route(self, route_id: Any) -> Optional[Dict]:
+        """依 id 取得單一路線的複本，找不到時回傳 None。"""
+        if self._reload_if_changed() is None:
+            return None
+        route = self._index.get(str(route_id))
+        if route is None:
+            return None
+        return copy.deepcopy(route)
+
+    def invalidate(self):
+        """強制下次讀取時重新載入資料。"""
+        with self._lock:
+            self._signature = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "routes": len(self._routes),
+        }
+
+
+# 全域共用的實例
+route_catalog = RouteCatalog()
@@ -0,0 +1,217 @@
+# 路線 prompts 的增量異動日誌
+# 單一 prompt 的新增 / 編輯 / 排序 / 刪除只會附加一行 JSON 到日誌檔，
+# 不必重寫整條路線；累積到一定數量或時間後再壓縮 (compact) 回 route_store。
+# 附加與壓縮都在 routes.journal.jsonl.lock 檔案鎖內進行，壓縮改寫日誌時不會弄丟其他行程的異動。
+# 每筆異動帶有遞增的序號 (seq)，壓縮時與路線一起把最後的序號寫進資料庫，
+# 序號不大於它的異動已經在資料庫中，重新載入時略過，不會重複套用。
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from file_registry import ManifestLock
+from route_store import RouteStore, route_store
+
+JOURNAL_PATH = "routes.journal.jsonl"
+# 累積多少筆異動後壓縮回資料庫
+COMPACT_THRESHOLD = 200
+# 最舊的異動超過多少秒後壓縮回資料庫
+COMPACT_MAX_AGE = 300
+
+EDITABLE_FIELDS = ("content", "type", "mode", "isSend")
+
+
+class JournalError(Exception):
+    """異動內容不合法（路線不存在、索引超出範圍等）。"""
+
+
+def apply_op(route: Dict, op: Dict):
+    """把一筆異動套用到路線上（直接修改 route）。"""
+    prompts = route.setdefault("prompts", [])
+    kind = op["op"]
+
+    if kind == "add":
+        index = op.get("index")
+        if index is None:
+            index = len(prompts)
+        elif not isinstance(index, int) or isinstance(index, bool) or not 0 <= index <= len(prompts):
+            raise JournalError(f"prompt 索引 {index} 超出範圍")
+        prompts.insert(index, op["prompt"])
+    elif kind == "edit":
+        index = op["index"]
+        if not 0 <= index < len(prompts):
+            raise JournalError(f"prompt 索引 {index} 超出範圍")
+        prompts[index].update(op["fields"])
+    elif kind == "move":
+        src, dst = op["from"], op["to"]
+        if not (0 <= src < len(prompts) and 0 <= dst < len(prompts)):
+            raise JournalError(f"prompt 索引 {src} -> {dst} 超出範圍")
+        prompts.insert(dst, prompts.pop(src))
+    elif kind == "delete":
+        index = op["index"]
+        if not 0 <= index < len(prompts):
+            raise JournalError(f"prompt 索引 {index} 超出範圍")
+        prompts.pop(index)
+    else:
+        raise JournalError(f"未知的異動類型: {kind}")
+
+
+class RouteJournal:
+    """
+    附加式 (append-only) 的 JSONL 異動日誌。
+    讀取端以「資料庫快照 + 尚未壓縮的異動」組合出目前的路線內容。
+    同一行程內以 _lock 互斥，跨行程以 ManifestLock 互斥。
+    """
+
+    def __init__(
+        self,
+        journal_path: str = JOURNAL_PATH,
+        store: RouteStore = route_store,
+        compact_threshold: int = COMPACT_THRESHOLD,
+        compact_max_age: float = COMPACT_MAX_AGE,
+    ):
+        self.journal_path = journal_path
+        self.store = store
+        self.compact_threshold = compact_threshold
+        self.compact_max_age = compact_max_age
+        self.lock_path = f"{journal_path}.lock"
+        self._lock = threading.RLock()
+        self._ops: List[Dict] = []
+        self._size = 0
+
+    def signature(self) -> int:
+        """日誌檔目前的大小，用來判斷是否有新的異動。"""
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    def _journal_ops(self) -> List[Dict]:
+        """日誌檔中的所有異動；檔案大小沒變就直接用記憶體中的結果。"""
+        size = self.signature()
+        if size != self._size:
+            self._ops, self._size = self._read_ops()
+        return self._ops
+
+    def pending_ops(self) -> List[Dict]:
+        """回傳尚未壓縮的異動（略過序號已寫入資料庫的部分）。"""
+        with self._lock:
+            ops = self._journal_ops()
+            compacted_seq = self.store.journal_seq()
+            # 舊版日誌的異動沒有序號，一律視為尚未壓縮
+            return [op for op in ops if op.get("seq") is None or op["seq"] > compacted_seq]
+
+    def _read_ops(self):
+        ops = []
+        if not os.path.exists(self.journal_path):
+            return ops, 0
+        with open(self.journal_path, "rb") as f:
+            data = f.read()
+        # 只採用完整的行，最後一行若還沒寫完就留到下次
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                ops.append(json.loads(line))
+        return ops, end
+
+    def apply_pending(self, routes: List[Dict]) -> List[Dict]:
+        """把尚未壓縮的異動套用到一份路線清單上（直接修改傳入的清單）。"""
+        index = {str(route["id"]): route for route in routes}
+        for op in self.pending_ops():
+            route = index.get(str(op["route_id"]))
+            if route is None:
+                continue
+            try:
+                apply_op(route, op)
+            except JournalError as e:
+                print(f"略過無法套用的異動 {op}: {e}")
+        return routes
+
+    def append(self, route: Dict, op: Dict) -> Dict:
+        """
+        驗證並寫入一筆異動。
+        route 是套用所有既有異動後的路線複本，驗證成功後會同步被修改。
+        """
+        op = dict(op)
+        op["route_id"] = str(route["id"])
+        op["ts"] = time.time()
+        apply_op(route, op)
+
+        with self._lock, ManifestLock(self.lock_path):
+            # 先把其他行程寫入的異動讀進來，再接著編號附加自己的這一筆
+            ops = self._journal_ops()
+            last_seq = max((o.get("seq") or 0 for o in ops), default=0)
+            op["seq"] = max(last_seq, self.store.journal_seq()) + 1
+            line = (json.dumps(op, ensure_ascii=False) + "\n").encode("utf-8")
+            with open(self.journal_path, "ab") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._ops.append(op)
+            self._size += len(line)
+
+            if self._should_compact():
+                self._compact()
+        return op
+
+    def _should_compact(self) -> bool:
+        if not self._ops:
+            return False
+        if len(self._ops) >= self.compact_threshold:
+            return True
+        return time.time() - self._ops[0].get("ts", 0) >= self.compact_max_age
+
+    def compact(self, route_id: Optional[str] = None) -> int:
+        """
+        把日誌中的異動寫回資料庫並清空日誌，回傳壓縮的異動筆數。
+        route_id 有值時只在該路線有待處理異動時才執行。
+        """
+        with self._lock, ManifestLock(self.lock_path):
+            return self._compact(route_id)
+
+    def _compact(self, route_id: Optional[str] = None) -> int:
+        """compact 的本體，呼叫端需持有 _lock 與檔案鎖。"""
+        ops = self.pending_ops()
+        if route_id is not None and not any(
+            str(op["route_id"]) == str(route_id) for op in ops
+        ):
+            return 0
+
+        if not ops and not self._ops:
+            return 0
+
+        touched = {}
+        for op in ops:
+            rid = str(op["route_id"])
+            if rid not in touched:
+                route = self.store.get_route(rid)
+                if route is None:
+                    continue
+                touched[rid] = route
+            try:
+                apply_op(touched[rid], op)
+            except JournalError as e:
+                print(f"略過無法套用的異動 {op}: {e}")
+
+        # 路線與壓縮到的序號在同一個交易內寫入；之後清空日誌前若中斷，重新載入時會依序號略過
+        last_seq = max((op.get("seq") or 0 for op in self._ops), default=0)
+        self.store.save_routes(
+            list(touched.values()), max(last_seq, self.store.journal_seq())
+        )
+
+        # 持有檔案鎖期間沒有其他行程能附加異動，日誌中的內容都已寫入資料庫，可以直接清空
+        tmp_path = f"{self.journal_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        self._ops, self._size = [], 0
+
+        if ops:
+            print(f"已將 {len(ops)} 筆 prompt 異動壓縮回路線資料庫。")
+        return len(ops)
+
+
+# 全域共用的實例
+route_journal = RouteJournal()
@@ -0,0 +1,286 @@
+# 路線資料的 SQLite 儲存後端
+# 以 WAL 模式的嵌入式資料庫取代整份重寫的 data.json：
+# 依 id 的查詢走索引，單一路線的更新在同一個交易內完成，
+# 讀取端不會看到寫到一半的檔案。
+# 另外提供 data.json 的匯入/匯出，方便與舊流程相容：
+#   python route_store.py import [data.json]
+#   python route_store.py export [data.json]
+import json
+import os
+import sqlite3
+import sys
+import threading
+from typing import Any, Dict, List, Optional
+
+DB_PATH = "routes.db"
+JSON_PATH = "data.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS routes (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    dir TEXT NOT NULL DEFAULT '',
+    sort_order INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS prompts (
+    route_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (route_id, idx)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class RouteStore:
+    """
+    路線與其 prompts 的 SQLite 儲存。
+    每個執行緒使用自己的連線；寫入一律包在交易內，並遞增 revision 讓快取得知資料已變動。
+    """
+
+    def __init__(self, db_path: str = DB_PATH, json_path: str = JSON_PATH):
+        self.db_path = db_path
+        self.json_path = json_path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        if not self._initialized:
+            self._initialize(conn)
+        return conn
+
+    def _initialize(self, conn: sqlite3.Connection):
+        with self._init_lock:
+            if self._initialized:
+                return
+            conn.executescript(SCHEMA)
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', '0')"
+            )
+            self._initialized = True
+
+            # 第一次啟動時，若資料庫是空的就把既有的 data.json 匯入
+            count = conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+            if count == 0 and os.path.exists(self.json_path):
+                print(f"資料庫為空，從 {self.json_path} 匯入路線資料...")
+                self.import_json(self.json_path)
+
+    # --- 讀取 ---
+    def revision(self) -> int:
+        """資料版本號，每次寫入都會遞增。"""
+        row = (
+            self._connect()
+            .execute("SELECT value FROM meta WHERE key = 'revision'")
+            .fetchone()
+        )
+        return int(row[0]) if row else 0
+
+    def journal_seq(self) -> int:
+        """最後一次壓縮回資料庫的日誌序號，序號不大於它的異動都已經寫入資料庫。"""
+        row = (
+            self._connect()
+            .execute("SELECT value FROM meta WHERE key = 'journal_seq'")
+            .fetchone()
+        )
+        return int(row[0]) if row else 0
+
+    def _load_prompts(self, conn, route_id: str) -> List[Dict]:
+        rows = conn.execute(
+            "SELECT data FROM prompts WHERE route_id = ? ORDER BY idx", (route_id,)
+        ).fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    def list_routes(self) -> List[Dict]:
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            prompts_by_route: Dict[str, List[Dict]] = {}
+            for row in conn.execute(
+                "SELECT route_id, data FROM prompts ORDER BY route_id, idx"
+            ):
+                prompts_by_route.setdefault(row["route_id"], []).append(
+                    json.loads(row["data"])
+                )
+
+            routes = []
+            for row in conn.execute(
+                "SELECT id, name, dir FROM routes ORDER BY sort_order, CAST(id AS INTEGER)"
+            ).fetchall():
+                routes.append(
+                    {
+                        "id": row["id"],
+                        "name": row["name"],
+                        "dir": row["dir"],
+                        "prompts": prompts_by_route.get(row["id"], []),
+                    }
+                )
+        finally:
+            conn.execute("COMMIT")
+        return routes
+
+    def get_route(self, route_id: Any) -> Optional[Dict]:
+        conn = self._connect()
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute(
+                "SELECT id, name, dir FROM routes WHERE id = ?", (str(route_id),)
+            ).fetchone()
+            if row is None:
+                return None
+            return {
+                "id": row["id"],
+                "name": row["name"],
+                "dir": row["dir"],
+                "prompts": self._load_prompts(conn, row["id"]),
+            }
+        finally:
+            conn.execute("COMMIT")
+
+    # --- 寫入 ---
+    def _bump_revision(self, conn):
+        conn.execute(
+            "UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'revision'"
+        )
+
+    def _next_id(self, conn) -> str:
+        row = conn.execute("SELECT MAX(CAST(id AS INTEGER)) FROM routes").fetchone()
+        return str((row[0] or 0) + 1)
+
+    def _write_route(self, conn, route: Dict, sort_order: Optional[int] = None):
+        route_id = str(route["id"])
+        if sort_order is None:
+            existing = conn.execute(
+                "SELECT sort_order FROM routes WHERE id = ?", (route_id,)
+            ).fetchone()
+            if existing is not None:
+                sort_order = existing[0]
+            else:
+                row = conn.execute("SELECT MAX(sort_order) FROM routes").fetchone()
+                sort_order = (row[0] or 0) + 1
+
+        conn.execute(
+            "INSERT INTO routes (id, name, dir, sort_order) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET name = excluded.name, dir = excluded.dir, "
+            "sort_order = excluded.sort_order",
+            (route_id, route.get("name", ""), route.get("dir", ""), sort_order),
+        )
+        conn.execute("DELETE FROM prompts WHERE route_id = ?", (route_id,))
+        conn.executemany(
+            "INSERT INTO prompts (route_id, idx, data) VALUES (?, ?, ?)",
+            [
+                (route_id, idx, json.dumps(prompt, ensure_ascii=False))
+                for idx, prompt in enumerate(route.get("prompts") or [])
+            ],
+        )
+
+    def save_route(self, route: Dict) -> str:
+        """
+        新增或更新單一路線（含 prompts），於同一個交易中完成。
+        route["id"] 為空字串時視為新增，回傳實際使用的 id。
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            route = dict(route)
+            if not route.get("id"):
+                route["id"] = self._next_id(conn)
+            self._write_route(conn, route)
+            self._bump_revision(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return str(route["id"])
+
+    def save_routes(self, routes: List[Dict], journal_seq: Optional[int] = None):
+        """
+        在同一個交易中更新多條既有路線。
+        journal_seq 有值時一併記錄已壓縮到的日誌序號（見 route_journal）。
+        """
+        if not routes and journal_seq is None:
+            return
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for route in routes:
+                self._write_route(conn, route)
+            if journal_seq is not None:
+                conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('journal_seq', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (str(journal_seq),),
+                )
+            self._bump_revision(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete_route(self, route_id: Any):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM prompts WHERE route_id = ?", (str(route_id),))
+            conn.execute("DELETE FROM routes WHERE id = ?", (str(route_id),))
+            self._bump_revision(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    # --- data.json 相容 ---
+    def import_json(self, json_path: Optional[str] = None) -> int:
+        """把 data.json 的所有路線匯入資料庫（同 id 會覆蓋），回傳匯入筆數。"""
+        json_path = json_path or self.json_path
+        with open(json_path, "r", encoding="utf-8") as f:
+            routes = json.load(f)
+
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sort_order, route in enumerate(routes):
+                self._write_route(conn, route, sort_order)
+            self._bump_revision(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(routes)
+
+    def export_json(self, json_path: Optional[str] = None) -> int:
+        """把資料庫內容匯出成 data.json 格式（先寫暫存檔再置換），回傳匯出筆數。"""
+        json_path = json_path or self.json_path
+        routes = self.list_routes()
+        tmp_path = f"{json_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(routes, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, json_path)
+        return len(routes)
+
+
+# 全域共用的實例
+route_store = RouteStore()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("import", "export"):
+        print("用法：python route_store.py [import|export] [data.json]")
+        sys.exit(1)
+
+    path = sys.argv[2] if len(sys.argv) > 2 else JSON_PATH
+    if sys.argv[1] == "import":
+        print(f"已從 {path} 匯入 {route_store.import_json(path)} 筆路線。")
+    else:
+        print(f"已匯出 {route_store.export_json(path)} 筆路線至 {path}。")
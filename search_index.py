@@ -0,0 +1,387 @@
+# 生成的小說與 gaibackup 備份的全文檢索 (search.db)
+# 中文沒有空白斷詞，寫入 SQLite FTS5 前先把連續的中日韓文字拆成兩字一組 (bigram)，
+# 英數字則保留整個單字；查詢時以同樣方式拆開，組成相鄰的片語查詢，命中即等於原文包含這段文字。
+# 每段連續中文的最後一個字另外寫在 tails 欄位，只給單一中文字的查詢使用，不會打斷 grams 欄位的相鄰關係。
+# 每個檔案依分隔線切成段，每段再切成約 CHUNK_CHARS 字、彼此重疊 CHUNK_OVERLAP 字的區塊，
+# 索引只記錄區塊在檔案中的位元組位置，摘要在查詢時直接從原檔讀取。
+# 檔案依 (大小, 修改時間) 判斷是否需要重建，寫入回應檔或下載備份時呼叫 index_file() 即時更新；
+# 其他異動（手動加入或刪除的檔案）由背景執行緒在啟動時與每 SYNC_INTERVAL 秒補齊，不在查詢時進行。
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from response_writer import SEPARATOR
+
+DB_PATH = "search.db"
+# 各種檔案的分段分隔線（備份檔的格式見 backup.doPraseFileContent）
+SEGMENT_SEPARATORS = {
+    "response": SEPARATOR,
+    "backup": "\n\n" + "=" * 50 + "\n\n",
+}
+CHUNK_CHARS = 800
+# 相鄰區塊重疊的字數，長度不超過這個數字的查詢不會因為切在區塊邊界而漏掉
+CHUNK_OVERLAP = 40
+# 摘要在命中位置前後各取幾個字
+SNIPPET_CHARS = 60
+# 背景全面掃描的間隔秒數
+SYNC_INTERVAL = 300
+# 斷詞方式的版本，改變時重建資料表讓背景同步全部重建（記錄在 PRAGMA user_version）
+GRAMS_VERSION = 3
+
+# 中日韓文字（平假名、片假名、漢字、諺文）
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_TOKEN_RE = re.compile(f"[{_CJK}]+|[^\\W{_CJK}]+")
+_CJK_RE = re.compile(f"[{_CJK}]")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    source TEXT NOT NULL DEFAULT '',
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL,
+    segment INTEGER NOT NULL,
+    char_offset INTEGER NOT NULL,
+    byte_start INTEGER NOT NULL,
+    byte_end INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_file ON chunks (file_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunk_text USING fts5 (grams, tails, tokenize = 'unicode61');
+"""
+
+
+def _bigrams(token: str) -> List[str]:
+    if _CJK_RE.match(token) and len(token) > 1:
+        return [token[i : i + 2] for i in range(len(token) - 1)]
+    return [token]
+
+
+def to_grams(text: str) -> str:
+    """寫入索引用：中日韓文字拆成兩字一組（單獨一個字則保留單字），英數字保留單字，以空白分隔。"""
+    grams = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        grams.extend(_bigrams(match.group()))
+    return " ".join(grams)
+
+
+def to_tails(text: str) -> str:
+    """
+    寫入 tails 欄位：每段連續中文（兩字以上）的最後一個字。
+    單字查詢以前綴比對 bigram 時找不到段尾的字，改由這個欄位補上。
+    """
+    return " ".join(
+        match.group()[-1]
+        for match in _TOKEN_RE.finditer(text.lower())
+        if _CJK_RE.match(match.group()) and len(match.group()) > 1
+    )
+
+
+def to_query(query: str) -> Optional[str]:
+    """
+    把使用者輸入轉成 FTS5 查詢：以空白分開的每個詞都必須出現（AND），
+    每個詞拆成 bigram 後在 grams 欄位組成相鄰片語；
+    只有一個中文字時比對 grams 的 bigram 前綴或 tails 的段尾單字。
+    """
+    terms = []
+    for word in query.split():
+        tokens = []
+        for match in _TOKEN_RE.finditer(word.lower()):
+            tokens.extend(_bigrams(match.group()))
+        if not tokens:
+            continue
+        if len(tokens) == 1 and _CJK_RE.match(tokens[0]) and len(tokens[0]) == 1:
+            terms.append(f'(grams : "{tokens[0]}"* OR tails : "{tokens[0]}")')
+        else:
+            terms.append('grams : "' + " ".join(tokens) + '"')
+    return " ".join(terms) if terms else None
+
+
+def split_chunks(text: str, separator: str) -> List[Tuple[int, int, int, int, str]]:
+    """切成 (段, 段內字元位置, 起始位元組, 結束位元組, 文字) 的區塊。"""
+    chunks = []
+    separator_bytes = len(separator.encode("utf-8"))
+    segment_byte = 0
+    for segment, part in enumerate(text.split(separator)):
+        step = CHUNK_CHARS - CHUNK_OVERLAP
+        position = 0
+        byte_position = segment_byte
+        while position < len(part):
+            piece = part[position : position + CHUNK_CHARS]
+            if piece.strip():
+                chunks.append(
+                    (segment, position, byte_position, byte_position + len(piece.encode("utf-8")), piece)
+                )
+            if position + CHUNK_CHARS >= len(part):
+                break
+            byte_position += len(part[position : position + step].encode("utf-8"))
+            position += step
+        segment_byte += len(part.encode("utf-8")) + separator_bytes
+    return chunks
+
+
+def collect_files(routes: List[Dict], run_dir: str, response_dir: str, backup_dir: str) -> List[Tuple[str, str, str]]:
+    """要建立索引的檔案：每條路線 Response 中完成的回應檔，以及備份資料夾中的所有備份。"""
+    files = []
+    for route in routes or []:
+        folder = os.path.join(run_dir, route["dir"], response_dir)
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            if name.lower().endswith(".txt"):
+                files.append((os.path.join(folder, name), "response", str(route["id"])))
+    if os.path.isdir(backup_dir):
+        for root, _, names in os.walk(backup_dir):
+            for name in names:
+                if name.lower().endswith(".text"):
+                    files.append((os.path.join(root, name), "backup", os.path.basename(root)))
+    return files
+
+
+class SearchIndex:
+    """
+    全文檢索的 SQLite 資料庫。每個執行緒使用自己的連線，單一檔案的重建在同一個交易內完成。
+    全面掃描同一時間只有一個在進行，由 start_background_sync() 啟動的執行緒定期執行。
+    """
+
+    def __init__(self, db_path: str = DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        self._sync_lock = threading.Lock()
+        self._sync_thread = None
+        self.last_sync = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(SCHEMA)
+                    self._upgrade(conn)
+                    self._initialized = True
+        return conn
+
+    def _upgrade(self, conn: sqlite3.Connection):
+        """舊版斷詞建立的索引格式不同（沒有 tails 欄位），重建資料表後由背景同步重建。"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < GRAMS_VERSION:
+                conn.execute("DROP TABLE IF EXISTS chunk_text")
+                conn.execute(
+                    "CREATE VIRTUAL TABLE chunk_text USING fts5 (grams, tails, tokenize = 'unicode61')"
+                )
+                conn.execute("DELETE FROM chunks")
+                conn.execute("DELETE FROM files")
+                conn.execute(f"PRAGMA user_version = {GRAMS_VERSION}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _delete_file(self, conn: sqlite3.Connection, file_id: int):
+        conn.execute(
+            "DELETE FROM chunk_text WHERE rowid IN (SELECT id FROM chunks WHERE file_id = ?)",
+            (file_id,),
+        )
+        conn.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,))
+        conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def index_file(self, path: str, kind: str, source: str = "") -> bool:
+        """建立或更新單一檔案的索引；內容沒變時略過，回傳是否重建。"""
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+            conn = self._connect()
+            row = conn.execute("SELECT id, size, mtime FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None and row["size"] == stat.st_size and row["mtime"] == stat.st_mtime:
+                return False
+
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            chunks = split_chunks(text, SEGMENT_SEPARATORS[kind])
+            rows = [(chunk, to_grams(chunk[4]), to_tails(chunk[4])) for chunk in chunks]
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 取得寫入鎖後重新查詢，其他執行緒或 worker 可能已經寫入同一個檔案
+                row = conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+                if row is not None:
+                    self._delete_file(conn, row["id"])
+                file_id = conn.execute(
+                    "INSERT INTO files (path, kind, source, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                    (path, kind, source, stat.st_size, stat.st_mtime),
+                ).lastrowid
+                for (segment, char_offset, byte_start, byte_end, _), grams, tails in rows:
+                    chunk_id = conn.execute(
+                        "INSERT INTO chunks (file_id, segment, char_offset, byte_start, byte_end) VALUES (?, ?, ?, ?, ?)",
+                        (file_id, segment, char_offset, byte_start, byte_end),
+                    ).lastrowid
+                    conn.execute(
+                        "INSERT INTO chunk_text (rowid, grams, tails) VALUES (?, ?, ?)",
+                        (chunk_id, grams, tails),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return True
+        except Exception as e:
+            print(f"建立全文索引失敗：{path}，{e}")
+            return False
+
+    def remove_file(self, path: str):
+        path = os.path.abspath(path)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None:
+                self._delete_file(conn, row["id"])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def sync(self, files: List[Tuple[str, str, str]]) -> Optional[Dict]:
+        """
+        讓索引與檔案清單一致：建立新增或修改過的檔案，移除已不存在的檔案。
+        已經有其他執行緒在同步時直接略過，回傳 None。
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return None
+        try:
+            wanted = {os.path.abspath(path): (kind, source) for path, kind, source in files}
+            indexed = [row["path"] for row in self._connect().execute("SELECT path FROM files")]
+            removed = 0
+            for path in indexed:
+                if path not in wanted:
+                    self.remove_file(path)
+                    removed += 1
+            updated = sum(self.index_file(path, kind, source) for path, (kind, source) in wanted.items())
+            self.last_sync = time.time()
+            return {"files": len(wanted), "updated": updated, "removed": removed}
+        finally:
+            self._sync_lock.release()
+
+    @property
+    def syncing(self) -> bool:
+        return self._sync_lock.locked()
+
+    def start_background_sync(self, list_files: Callable[[], List[Tuple[str, str, str]]], interval: float = SYNC_INTERVAL):
+        """啟動背景執行緒：立即同步一次，之後每 interval 秒再同步；重複呼叫不會多開執行緒。"""
+        if self._sync_thread is not None and self._sync_thread.is_alive():
+            return
+
+        def run():
+            while True:
+                try:
+                    result = self.sync(list_files())
+                    if result and (result["updated"] or result["removed"]):
+                        print(f"全文索引已同步：更新 {result['updated']} 個檔案，移除 {result['removed']} 個檔案。")
+                except Exception as e:
+                    print(f"同步全文索引失敗：{e}")
+                time.sleep(interval)
+
+        self._sync_thread = threading.Thread(target=run, name="search-index-sync", daemon=True)
+        self._sync_thread.start()
+
+    def _snippet(self, path: str, byte_start: int, byte_end: int, needles: List[str]) -> Tuple[str, int]:
+        """從原檔讀出區塊，回傳 (命中位置前後的摘要, 命中位置在區塊中的字元位置)。"""
+        with open(path, "rb") as f:
+            f.seek(byte_start)
+            text = f.read(byte_end - byte_start).decode("utf-8", errors="replace")
+        lowered = text.lower()
+        positions = [lowered.find(needle) for needle in needles]
+        position = min((p for p in positions if p >= 0), default=0)
+        start = max(position - SNIPPET_CHARS, 0)
+        end = position + SNIPPET_CHARS + max(len(n) for n in needles)
+        snippet = text[start:end]
+        if start > 0:
+            snippet = "…" + snippet
+        if end < len(text):
+            snippet = snippet + "…"
+        return snippet, position
+
+    def search(
+        self,
+        query: str,
+        limit: int = 20,
+        offset: int = 0,
+        kind: Optional[str] = None,
+        source: Optional[str] = None,
+    ) -> List[Dict]:
+        """
+        依 bm25 排序回傳命中的位置：檔案、段、段內字元位置與摘要。
+        重疊的區塊可能重複命中同一處，offset / limit 以去除重複後的結果計算。
+        """
+        expression = to_query(query)
+        if expression is None:
+            return []
+        sql = """
+            SELECT c.segment, c.char_offset, c.byte_start, c.byte_end,
+                   f.path, f.kind, f.source, bm25(chunk_text) AS score
+            FROM chunk_text
+            JOIN chunks c ON c.id = chunk_text.rowid
+            JOIN files f ON f.id = c.file_id
+            WHERE chunk_text MATCH ?
+        """
+        params: list = [expression]
+        if kind:
+            sql += " AND f.kind = ?"
+            params.append(kind)
+        if source:
+            sql += " AND f.source = ?"
+            params.append(source)
+        sql += " ORDER BY score"
+
+        needles = [word.lower() for word in query.split()]
+        results = []
+        seen = set()
+        skipped = 0
+        for row in self._connect().execute(sql, params):
+            try:
+                snippet, position = self._snippet(row["path"], row["byte_start"], row["byte_end"], needles)
+            except OSError:
+                # 檔案已被刪除，等下次同步時移除
+                continue
+            key = (row["path"], row["segment"], row["char_offset"] + position)
+            if key in seen:
+                continue
+            seen.add(key)
+            if skipped < offset:
+                skipped += 1
+                continue
+            results.append(
+                {
+                    "file": os.path.basename(row["path"]),
+                    "kind": row["kind"],
+                    "source": row["source"],
+                    "segment": row["segment"],
+                    "offset": row["char_offset"] + position,
+                    "snippet": snippet,
+                    "score": row["score"],
+                }
+            )
+            if len(results) >= limit:
+                break
+        return results
+
+
+# 全域共用的實例
+search_index = SearchIndex()
@@ -0,0 +1,49 @@
+# SystemInstruction.txt 的系統指令快取
+# GeminiChatSession 從 SystemInstruction.txt 取得系統指令；內容快取在記憶體，
+# 檔案的修改時間改變時才重新讀取，不必每建立一個 session 就讀一次磁碟。
+import os
+import threading
+
+SYSTEM_INSTRUCTION_PATH = os.path.join(os.path.dirname(__file__), "SystemInstruction.txt")
+
+DEFAULT_SYSTEM_INSTRUCTION = """小說產生原則
+沒有字數限制，但是要在保證文章品質的情況下盡可能的輸出更多文字與延長篇幅，你需要寫得非常詳細，且避免重複和無聊内容。
+盡可能的像人與人之間的對話，包含對話和聲音描寫，描寫心理變化和感受，使用通俗易懂的語言，且要有一定對話內容與連續性。
+角色之間的互動更具臨場感。若角色之間有衝突或情感波動，務必鋪陳心理變化與反應過程，讓讀者能感受到角色內心的拉扯與真實性。
+避免過度文藝化表達，使用直白具體的描述方式，甚至允許部分粗俗描述方式。
+場景要夠震撼，多細節才能顯得真實，給人身臨其境的感受。
+故事要符合邏輯。所有內容融為一體,不分點輸出,但可以分段，不要自作主張地分章節，我需要連續的文章，上下的對話可以貫通的那種。
+只需要產生我要求的小說內容，不要提供其他多餘回復或建議內容
+使用繁體中文產生小說"""
+
+
+class SystemInstructionCache:
+    """
+    以檔案 mtime 判斷是否需要重新讀取的系統指令快取。
+    """
+
+    def __init__(self, path: str = SYSTEM_INSTRUCTION_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._text = None
+
+    def get(self) -> str:
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                # 如果 SystemInstruction.txt 不存在，則建立並寫入預設內容
+                with open(self.path, "w", encoding="utf-8") as f:
+                    f.write(DEFAULT_SYSTEM_INSTRUCTION)
+                mtime = os.stat(self.path).st_mtime_ns
+
+            if self._text is None or mtime != self._mtime:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._text = f.read()
+                self._mtime = mtime
+            return self._text
+
+
+# 全域共用的實例
+system_instruction = SystemInstructionCache()
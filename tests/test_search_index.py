@@ -0,0 +1,39 @@
+# search_index 斷詞與查詢的回歸測試
+# 中英混合、含標點的查詢都必須保持 grams 欄位的相鄰關係，段尾的單字也要查得到。
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_index import SearchIndex, to_grams, to_tails  # noqa: E402
+
+TEXT = "他說話alice很好，你好，世界。龍\n他寫文字。"
+
+
+@pytest.fixture
+def index(tmp_path):
+    path = tmp_path / "response_1.txt"
+    path.write_text(TEXT, encoding="utf-8")
+    search_index = SearchIndex(str(tmp_path / "search.db"))
+    search_index.index_file(str(path), "response", "1")
+    return search_index
+
+
+def test_tails_kept_out_of_grams():
+    assert to_grams("世界。龍") == "世界 龍"
+    assert to_tails("世界。龍") == "界"
+
+
+@pytest.mark.parametrize(
+    "query",
+    ["說話alice", "alice很好", "你好，世界", "世界。龍", "他說話", "寫文字", "字", "龍", "界", "alice"],
+)
+def test_mixed_script_and_punctuated_queries(index, query):
+    assert index.search(query), query
+
+
+@pytest.mark.parametrize("query", ["說alice", "好世", "字他", "bob"])
+def test_non_matching_queries(index, query):
+    assert index.search(query) == [], query
@@ -0,0 +1,225 @@
+# Token 用量統計
+# 各供應商回傳的 usage 欄位名稱不同，這裡統一成
+#   {"input", "cached", "output", "thinking", "total"}
+# 並提供：每個 session 的逐輪累計 (UsageTracker)、依單價估算費用、
+# 單次執行的 token / 費用上限 (TokenBudget)，以及依內容雜湊快取的 count_tokens 結果 (TokenCountCache)。
+# 單價可用環境變數 TOKEN_PRICES_FILE 指定 JSON 檔覆蓋，格式同 PRICES。
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+# 每百萬 token 的美元單價（以模型名稱前綴比對，取最長的相符項目）
+PRICES = {
+    "gemini-2.5-pro": {"input": 1.25, "cached": 0.31, "output": 10.0},
+    "gemini-2.5-flash": {"input": 0.30, "cached": 0.075, "output": 2.50},
+    "gemini-2.5-flash-lite": {"input": 0.10, "cached": 0.025, "output": 0.40},
+    "gpt-4o-mini": {"input": 0.15, "cached": 0.075, "output": 0.60},
+    "gpt-4o": {"input": 2.50, "cached": 1.25, "output": 10.0},
+    "grok-4": {"input": 3.00, "cached": 0.75, "output": 15.0},
+}
+USAGE_FIELDS = ("input", "cached", "output", "thinking", "total")
+USAGE_SUFFIX = ".usage.json"
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+
+def _load_prices() -> Dict[str, Dict[str, float]]:
+    prices = dict(PRICES)
+    path = os.getenv("TOKEN_PRICES_FILE")
+    if path:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                prices.update(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"讀取單價檔 {path} 失敗，使用內建單價：{e}")
+    return prices
+
+
+def empty_usage() -> Dict[str, int]:
+    return {field: 0 for field in USAGE_FIELDS}
+
+
+def gemini_usage(usage_metadata) -> Dict[str, int]:
+    """google.genai 的 usage_metadata。candidates 不含思考 token，思考另外列在 thoughts。"""
+    usage = empty_usage()
+    if usage_metadata is None:
+        return usage
+    usage["input"] = usage_metadata.prompt_token_count or 0
+    usage["cached"] = usage_metadata.cached_content_token_count or 0
+    usage["output"] = usage_metadata.candidates_token_count or 0
+    usage["thinking"] = getattr(usage_metadata, "thoughts_token_count", None) or 0
+    usage["total"] = usage_metadata.total_token_count or (
+        usage["input"] + usage["output"] + usage["thinking"]
+    )
+    return usage
+
+
+def openai_usage(usage_obj) -> Dict[str, int]:
+    """OpenAI 相容 API 的 usage。completion_tokens 已包含推理 token，這裡拆開列出。"""
+    usage = empty_usage()
+    if usage_obj is None:
+        return usage
+    prompt_details = getattr(usage_obj, "prompt_tokens_details", None)
+    completion_details = getattr(usage_obj, "completion_tokens_details", None)
+    reasoning = getattr(completion_details, "reasoning_tokens", None) or 0
+    usage["input"] = usage_obj.prompt_tokens or 0
+    usage["cached"] = getattr(prompt_details, "cached_tokens", None) or 0
+    usage["output"] = (usage_obj.completion_tokens or 0) - reasoning
+    usage["thinking"] = reasoning
+    usage["total"] = usage_obj.total_tokens or (usage["input"] + usage["output"] + reasoning)
+    return usage
+
+
+def price_for(model_name: str, prices: Optional[Dict] = None) -> Optional[Dict[str, float]]:
+    prices = prices if prices is not None else _load_prices()
+    matches = [name for name in prices if model_name and model_name.startswith(name)]
+    if not matches:
+        return None
+    return prices[max(matches, key=len)]
+
+
+def estimate_cost(model_name: str, usage: Dict[str, int], prices: Optional[Dict] = None) -> Optional[float]:
+    """依單價估算美元費用；找不到模型單價時回傳 None。思考 token 以輸出單價計算。"""
+    price = price_for(model_name, prices)
+    if price is None:
+        return None
+    fresh = usage["input"] - usage["cached"]
+    cost = (
+        fresh * price["input"]
+        + usage["cached"] * price.get("cached", price["input"])
+        + (usage["output"] + usage["thinking"]) * price["output"]
+    )
+    return round(cost / 1_000_000, 6)
+
+
+class UsageTracker:
+    """
+    一個 session 的逐輪 token 用量與累計。
+    """
+
+    def __init__(self, provider: str, model_name: str):
+        self.provider = provider
+        self.model_name = model_name
+        self.prices = _load_prices()
+        self.turns: List[Dict] = []
+        self.totals = empty_usage()
+        self._lock = threading.Lock()
+
+    def record(self, usage: Dict[str, int]) -> Dict:
+        turn = dict(usage)
+        turn["cost"] = estimate_cost(self.model_name, usage, self.prices)
+        with self._lock:
+            self.turns.append(turn)
+            for field in USAGE_FIELDS:
+                self.totals[field] += usage[field]
+        return turn
+
+    @property
+    def last(self) -> Optional[Dict]:
+        return self.turns[-1] if self.turns else None
+
+    def summary(self) -> Dict:
+        with self._lock:
+            totals = dict(self.totals)
+            calls = len(self.turns)
+        return {
+            "provider": self.provider,
+            "model": self.model_name,
+            "calls": calls,
+            "totals": totals,
+            "cost": estimate_cost(self.model_name, totals, self.prices),
+        }
+
+
+class TokenBudget:
+    """
+    單次執行的上限；max_tokens 以累計總 token 計算，max_cost 以估算費用（美元）計算。
+    兩者都是 None 時不限制。
+    """
+
+    def __init__(self, max_tokens: Optional[int] = None, max_cost: Optional[float] = None):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+
+    @classmethod
+    def from_request(cls, request_data: Dict) -> "TokenBudget":
+        """請求中的 maxTokens / maxCost 優先，否則使用環境變數 RUN_MAX_TOKENS / RUN_MAX_COST。"""
+        max_tokens = request_data.get("maxTokens") or os.getenv("RUN_MAX_TOKENS")
+        max_cost = request_data.get("maxCost") or os.getenv("RUN_MAX_COST")
+        return cls(
+            int(max_tokens) if max_tokens else None,
+            float(max_cost) if max_cost else None,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_tokens is not None or self.max_cost is not None
+
+    def to_dict(self) -> Dict:
+        return {"max_tokens": self.max_tokens, "max_cost": self.max_cost}
+
+    def exceeded(self, summary: Dict, next_tokens: int = 0) -> Optional[str]:
+        """已經（或加上下一次請求的 next_tokens 後）超過上限時，回傳原因；否則回傳 None。"""
+        total = summary["totals"]["total"] + next_tokens
+        if self.max_tokens is not None and total > self.max_tokens:
+            return f"累計 token {total} 超過上限 {self.max_tokens}"
+        cost = summary.get("cost")
+        if self.max_cost is not None and cost is not None and cost > self.max_cost:
+            return f"估算費用 ${cost:.4f} 超過上限 ${self.max_cost:.4f}"
+        return None
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TokenCountCache:
+    """
+    count_tokens 的結果依 (供應商, 模型, 內容雜湊) 快取，同一份檔案與指令不必重算。
+    """
+
+    def __init__(self, max_entries: int = TOKEN_COUNT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._counts: "OrderedDict[tuple, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_count(self, provider: str, model_name: str, content_hash: str, counter: Callable[[], int]) -> int:
+        key = (provider, model_name, content_hash)
+        with self._lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                return self._counts[key]
+        count = counter()
+        with self._lock:
+            self._counts[key] = count
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return count
+
+
+def usage_path(response_path: str) -> str:
+    """回應檔對應的用量紀錄：response_xxx.txt -> response_xxx.usage.json"""
+    return os.path.splitext(response_path)[0] + USAGE_SUFFIX
+
+
+def write_usage_file(response_path: str, data: Dict) -> str:
+    path = usage_path(response_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+# 全域共用的實例
+token_count_cache = TokenCountCache()